@@ -0,0 +1,233 @@
+## In-memory audio conversion for http_seamless.py.
+## Uploads are piped through ffmpeg and come back as 16 kHz mono s16 PCM, so a
+## request never writes its audio to disk (on Cloud Run the filesystem is RAM).
+## Translated PCM can be streamed back out through ffmpeg as Opus or AAC.
+
+import io
+import os
+import struct
+import subprocess
+import threading
+import wave
+
+SAMPLE_RATE = 16000
+
+
+class AudioDecodeError(Exception):
+    """Raised when ffmpeg cannot decode an upload."""
+
+
+class AudioEncodeError(Exception):
+    """Raised when ffmpeg cannot encode a response."""
+
+
+def _canonical_wav_pcm(data):
+    """Return the PCM frames if `data` is already a 16 kHz mono s16 WAV, else None."""
+    if data[:4] != b"RIFF" or data[8:12] != b"WAVE":
+        return None
+    try:
+        with wave.open(io.BytesIO(data), "rb") as wav_in:
+            if (wav_in.getnchannels(), wav_in.getsampwidth(), wav_in.getframerate()) != (1, 2, SAMPLE_RATE):
+                return None
+            return wav_in.readframes(wav_in.getnframes())
+    except (wave.Error, EOFError):
+        return None
+
+
+def _is_mp4(data):
+    # ISO BMFF (m4a/mp4/mov) starts with a box whose type is 'ftyp'. Its index
+    # ('moov') is often at the end of the file, so ffmpeg needs a seekable input.
+    return data[4:8] == b"ftyp"
+
+
+def _ffmpeg_decode_cmd(input_url, sample_rate):
+    return [
+        "ffmpeg", "-hide_banner", "-loglevel", "error",
+        "-i", input_url,
+        "-ar", str(sample_rate), "-ac", "1", "-f", "s16le", "-acodec", "pcm_s16le",
+        "pipe:1",
+    ]
+
+
+def _run_decode(cmd, **kwargs):
+    try:
+        return subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, **kwargs)
+    except OSError as e:
+        # ffmpeg missing or not executable
+        raise AudioDecodeError(f"Could not start ffmpeg: {e}") from e
+
+
+def decode_to_pcm(data, sample_rate=SAMPLE_RATE):
+    """
+    Decode an uploaded audio file (bytes) into mono s16 PCM at `sample_rate`.
+
+    Canonical 16 kHz mono WAVs skip ffmpeg entirely. Everything else is piped
+    through ffmpeg's stdin/stdout. MP4-family containers need seeking, so they go
+    through an anonymous in-memory file (memfd) instead of a pipe.
+    """
+    if sample_rate == SAMPLE_RATE:
+        pcm = _canonical_wav_pcm(data)
+        if pcm is not None:
+            return pcm
+
+    if _is_mp4(data) and hasattr(os, "memfd_create"):
+        fd = os.memfd_create("upload")
+        try:
+            with os.fdopen(os.dup(fd), "wb") as memfile:
+                memfile.write(data)
+            os.lseek(fd, 0, os.SEEK_SET)
+            proc = _run_decode(
+                _ffmpeg_decode_cmd(f"/dev/fd/{fd}", sample_rate),
+                stdin=subprocess.DEVNULL, pass_fds=(fd,),
+            )
+        finally:
+            os.close(fd)
+    else:
+        proc = _run_decode(_ffmpeg_decode_cmd("pipe:0", sample_rate), input=data)
+
+    if proc.returncode != 0:
+        raise AudioDecodeError(proc.stderr.decode(errors="ignore"))
+    if not proc.stdout:
+        raise AudioDecodeError("ffmpeg produced no audio")
+    return proc.stdout
+
+
+def wav_header(num_data_bytes, sample_rate, channels=1, sample_width=2):
+    """44-byte RIFF/WAVE header for PCM data, so PCM can be streamed without re-wrapping it."""
+    byte_rate = sample_rate * channels * sample_width
+    return struct.pack(
+        "<4sI4s4sIHHIIHH4sI",
+        b"RIFF", 36 + num_data_bytes, b"WAVE",
+        b"fmt ", 16, 1, channels, sample_rate, byte_rate, channels * sample_width, sample_width * 8,
+        b"data", num_data_bytes,
+    )
+
+
+class ResponseEncoding:
+    """
+    An audio format the translated speech can be sent in.
+
+    Args:
+        name: Short name used in logs
+        content_type: Content-Type of the response
+        extension: File extension of the attachment
+        media_types: Accept media types this encoding satisfies
+        ffmpeg_args: ffmpeg output options (None for WAV, which needs no encoder)
+    """
+
+    def __init__(self, name, content_type, extension, media_types, ffmpeg_args=None):
+        self.name = name
+        self.content_type = content_type
+        self.extension = extension
+        self.media_types = media_types
+        self.ffmpeg_args = ffmpeg_args
+
+
+def response_encodings(opus_bitrate="24k", aac_bitrate="48k"):
+    """Supported response encodings, in server preference order. WAV comes last: it is the fallback."""
+    return [
+        ResponseEncoding("opus", "audio/ogg", ".ogg", ("audio/ogg", "audio/opus"),
+                         ["-c:a", "libopus", "-b:a", opus_bitrate, "-application", "voip", "-f", "ogg"]),
+        ResponseEncoding("aac", "audio/aac", ".aac", ("audio/aac", "audio/aacp", "audio/x-aac"),
+                         ["-c:a", "aac", "-b:a", aac_bitrate, "-f", "adts"]),
+        ResponseEncoding("wav", "audio/wav", ".wav", ("audio/wav", "audio/x-wav", "audio/wave")),
+    ]
+
+
+def negotiate_encoding(accept, encodings):
+    """
+    Pick the encoding for an Accept header value.
+
+    Only media types named explicitly select a compressed encoding; wildcards
+    (*/* and audio/*) and a missing header keep the WAV fallback, so clients that
+    do not ask for compression get the same response as before. Among explicit
+    matches the highest q-value wins, then server preference order.
+    """
+    fallback = encodings[-1]
+    if not accept:
+        return fallback
+    qualities = {}
+    for entry in accept.split(","):
+        params = entry.strip().split(";")
+        media_type = params[0].strip().lower()
+        q = 1.0
+        for param in params[1:]:
+            key, _, value = param.strip().partition("=")
+            if key.strip().lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        qualities[media_type] = max(q, qualities.get(media_type, 0.0))
+
+    best, best_q = fallback, 0.0
+    for encoding in encodings:
+        q = max((qualities.get(media_type, 0.0) for media_type in encoding.media_types), default=0.0)
+        if q > best_q:
+            best, best_q = encoding, q
+    return best
+
+
+def encode_pcm(pcm, sample_rate, encoding, chunk_size=64 * 1024):
+    """
+    Encode mono s16 PCM with ffmpeg, yielding the output as it is produced.
+
+    `pcm` is a bytes-like object or an iterable of them (e.g. chunks still being
+    translated). It is fed to ffmpeg's stdin from a helper thread while the caller
+    drains stdout, so encoding overlaps sending the response. Raises
+    AudioEncodeError if ffmpeg fails, or re-raises the error of a failing `pcm`
+    iterable; when that happens before the first chunk, nothing has been yielded.
+    """
+    cmd = [
+        "ffmpeg", "-hide_banner", "-loglevel", "error",
+        "-f", "s16le", "-ar", str(sample_rate), "-ac", "1", "-i", "pipe:0",
+        *encoding.ffmpeg_args, "pipe:1",
+    ]
+    try:
+        proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except OSError as e:
+        raise AudioEncodeError(f"Could not start ffmpeg: {e}")
+
+    if isinstance(pcm, (bytes, bytearray, memoryview)):
+        view = memoryview(pcm)
+        parts = (view[offset:offset + chunk_size] for offset in range(0, len(view), chunk_size))
+    else:
+        parts = pcm
+    feed_errors = []
+
+    def feed():
+        try:
+            for part in parts:
+                try:
+                    proc.stdin.write(part)
+                except (BrokenPipeError, ValueError):
+                    return # ffmpeg exited early, its return code tells why
+        except Exception as e:
+            feed_errors.append(e)
+            proc.kill() # Do not let a truncated input pass for a complete encode
+        finally:
+            try:
+                proc.stdin.close()
+            except BrokenPipeError:
+                pass
+
+    feeder = threading.Thread(target=feed, name="pcm-encoder-feed", daemon=True)
+    feeder.start()
+    try:
+        while True:
+            chunk = proc.stdout.read1(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+        feeder.join()
+        if feed_errors:
+            raise feed_errors[0]
+        stderr = proc.stderr.read()
+        if proc.wait() != 0:
+            raise AudioEncodeError(stderr.decode(errors="ignore"))
+    finally:
+        if proc.poll() is None:
+            proc.kill() # The client went away mid-stream
+            proc.wait()
+        proc.stdout.close()
+        proc.stderr.close()
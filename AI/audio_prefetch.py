@@ -0,0 +1,108 @@
+## Decodificación de audio en paralelo con la inferencia.
+## Un pool de hilos decodifica y remuestrea los audios siguientes (librosa,
+## torchaudio y ffmpeg sueltan el GIL mientras decodifican) mientras el modelo
+## procesa los actuales. Como mucho hay `queue_size` audios decodificados o en
+## curso esperando al modelo, así la memoria no crece con el número de ficheros.
+##
+##   for path, embedding in embed_files(paths, tagger.decode_audio, tagger.get_audio_embeddings):
+##       ...
+
+import collections
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+# Por defecto la mitad de los núcleos: la otra mitad queda para el modelo
+DEFAULT_WORKERS = int(os.environ.get("AUDIO_DECODE_WORKERS", 0)) or max(1, (os.cpu_count() or 2) // 2)
+_END = object() # Fin de `items` (None puede ser un item válido)
+
+
+def prefetch(items, load, workers=DEFAULT_WORKERS, queue_size=None):
+    """
+    Aplicar `load` a `items` en un pool de hilos, adelantándose hasta `queue_size`
+    elementos (por defecto 2 * workers). Devuelve (item, resultado, error) en el
+    orden de `items`; si `load` falla, resultado es None y error la excepción.
+    """
+    queue_size = queue_size or 2 * workers
+    items = iter(items)
+    pending = collections.deque()
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="audio-decode") as pool:
+        for item in items:
+            pending.append((item, pool.submit(load, item)))
+            if len(pending) >= queue_size:
+                break
+        while pending:
+            item, future = pending.popleft()
+            # Rellenar la cola antes de esperar, para que el pool no se quede parado
+            next_item = next(items, _END)
+            if next_item is not _END:
+                pending.append((next_item, pool.submit(load, next_item)))
+            try:
+                yield item, future.result(), None
+            except Exception as e:
+                yield item, None, e
+
+
+def batch_by_length(stream, batch_size, length=len, max_buffered=None):
+    """
+    Agrupar los (item, forma de onda) de `stream` en lotes de hasta `batch_size`
+    con la misma longitud (`length(forma de onda)`), para pasarlos al modelo sin
+    relleno. Si hay más de `max_buffered` (por defecto 4 * batch_size) esperando,
+    se entrega el grupo más antiguo aunque no esté lleno.
+    Solo sirve si muchas formas de onda tienen la misma longitud (p. ej. las
+    entradas de tamaño fijo de CLAP); con audios de longitud libre casi nunca
+    coinciden, y lo razonable es batch_size=1, que entrega cada audio al llegar.
+    Devuelve listas de (item, forma de onda).
+    """
+    max_buffered = max_buffered or 4 * batch_size
+    groups = collections.OrderedDict()
+    buffered = 0
+    for item, waveform in stream:
+        group = groups.setdefault(length(waveform), [])
+        group.append((item, waveform))
+        buffered += 1
+        if len(group) >= batch_size:
+            buffered -= len(group)
+            yield groups.pop(length(waveform))
+        elif buffered > max_buffered:
+            _, oldest = groups.popitem(last=False)
+            buffered -= len(oldest)
+            yield oldest
+    yield from groups.values()
+
+
+def embed_files(paths, decode, embed, batch_size=8, length=len, workers=DEFAULT_WORKERS):
+    """
+    Decodificar `paths` con `decode` en paralelo y calcular sus embeddings por
+    lotes de la misma longitud con `embed(lista de formas de onda)`.
+    Devuelve (ruta, embedding) a medida que se calculan, no en el orden de
+    `paths`; embedding es None si el audio no se pudo decodificar o procesar.
+    Si falla un lote, sus audios se procesan uno a uno.
+    """
+    failed = []
+
+    def decoded():
+        for path, waveform, error in prefetch(paths, decode, workers):
+            if error is None:
+                yield path, waveform
+            else:
+                print(f"Error al cargar {path}: {error}")
+                failed.append(path)
+
+    for batch in batch_by_length(decoded(), batch_size, length):
+        while failed:
+            yield failed.pop(0), None
+        batch_paths, waveforms = zip(*batch)
+        try:
+            embeddings = embed(list(waveforms))
+        except Exception as e:
+            print(f"Error en el lote de {len(batch)} audios, se procesan uno a uno: {e}")
+            embeddings = []
+            for path, waveform in batch:
+                try:
+                    embeddings.append(embed([waveform])[0])
+                except Exception as e:
+                    print(f"Error al procesar {path}: {e}")
+                    embeddings.append(None)
+        yield from zip(batch_paths, embeddings)
+    while failed:
+        yield failed.pop(0), None
@@ -0,0 +1,129 @@
+## Dynamic micro-batching for http_seamless.py.
+## Requests that arrive within a short window for the same model and tgt_lang
+## are grouped and run as one batched inference; each waiting handler gets its
+## own result back through a Future.
+
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+
+
+class _Group:
+    def __init__(self, backend, tgt_lang):
+        self.backend = backend
+        self.tgt_lang = tgt_lang
+        self.opened = time.monotonic()
+        self.items = [] # (pcm, Future)
+
+
+class BatchScheduler:
+    """
+    Groups translation requests by (backend, tgt_lang).
+
+    A group is dispatched when it reaches `max_batch_size` or when `window_ms`
+    has passed since its first request. Each backend has its own runner thread,
+    so batches for different backends run in parallel and a backlog on one never
+    delays another; batches for the same backend run one after the other, and new
+    requests keep accumulating into the next batch meanwhile. With
+    `window_ms` = 0 requests go straight to the backend, unbatched.
+    """
+
+    def __init__(self, router, window_ms=0, max_batch_size=4):
+        self.router = router
+        self.window = window_ms / 1000.0
+        self.max_batch_size = max(1, max_batch_size)
+        self._groups = OrderedDict() # (backend name, tgt_lang) -> _Group, oldest first
+        self._cond = threading.Condition()
+        self._closed = False
+        self._executors = {} # backend name -> single-worker executor
+        self._dispatcher = None
+        if self.enabled:
+            for backend in router.backends:
+                self._executors[backend.name] = ThreadPoolExecutor(
+                    max_workers=1, thread_name_prefix=f"batch-runner-{backend.name}")
+            self._dispatcher = threading.Thread(target=self._dispatch_loop, name="batch-dispatcher", daemon=True)
+            self._dispatcher.start()
+
+    @property
+    def enabled(self):
+        return self.window > 0 and self.max_batch_size > 1
+
+    def translate(self, pcm, tgt_lang):
+        """Translate one request, possibly as part of a batch. Blocks until done."""
+        if not self.enabled:
+            return self.router.translate(pcm, tgt_lang)
+        return self.submit(pcm, tgt_lang).result()
+
+    def submit(self, pcm, tgt_lang):
+        backend = self.router.select(tgt_lang)
+        future = Future()
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("Batch scheduler is closed")
+            key = (backend.name, tgt_lang)
+            group = self._groups.get(key)
+            if group is None:
+                group = self._groups[key] = _Group(backend, tgt_lang)
+            group.items.append((pcm, future))
+            self._cond.notify()
+        return future
+
+    def pending(self):
+        with self._cond:
+            return sum(len(group.items) for group in self._groups.values())
+
+    def _dispatch_loop(self):
+        while True:
+            with self._cond:
+                while True:
+                    if self._closed and not self._groups:
+                        return
+                    ready = self._pop_ready_group()
+                    if ready is not None:
+                        break
+                    timeout = None
+                    if self._groups:
+                        oldest = next(iter(self._groups.values()))
+                        timeout = max(0.0, oldest.opened + self.window - time.monotonic())
+                    self._cond.wait(timeout)
+            self._executors[ready.backend.name].submit(self._run, ready)
+
+    def _pop_ready_group(self):
+        now = time.monotonic()
+        for key, group in self._groups.items():
+            if (len(group.items) >= self.max_batch_size
+                    or now - group.opened >= self.window or self._closed):
+                batch = group.items[:self.max_batch_size]
+                group.items = group.items[self.max_batch_size:]
+                if group.items:
+                    group.opened = now # Overflow starts a fresh window
+                    self._groups.move_to_end(key)
+                else:
+                    del self._groups[key]
+                ready = _Group(group.backend, group.tgt_lang)
+                ready.items = batch
+                return ready
+        return None
+
+    def _run(self, group):
+        futures = [future for _, future in group.items]
+        try:
+            results = group.backend.translate_batch([pcm for pcm, _ in group.items], group.tgt_lang)
+            if len(group.items) > 1:
+                print(f"Ran batch of {len(group.items)} for '{group.tgt_lang}' on backend '{group.backend.name}'")
+        except BaseException as e:
+            for future in futures:
+                future.set_exception(e)
+            return
+        for future, result in zip(futures, results):
+            future.set_result(result)
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        if self._dispatcher is not None:
+            self._dispatcher.join() # Flushes the groups still waiting
+            for executor in self._executors.values():
+                executor.shutdown(wait=True)
@@ -0,0 +1,16 @@
+## Git revision of the working tree, recorded in the JSON results of the
+## benchmark and evaluation scripts so runs can be compared across commits.
+
+import os
+import subprocess
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def git_commit():
+    """Short hash of HEAD, or None outside a git checkout or without git."""
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=HERE,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
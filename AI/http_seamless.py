@@ -1,212 +1,736 @@
 ## Build a python http server that listens for audio requests and returns the same audio.
 
 import http.server
-import socketserver
-import cgi
-import io
+import itertools
+import json
+import mimetypes
 import os # Import os to access environment variables
-import subprocess # For running shell commands
-import tempfile # For creating temporary files
-import shutil # For cleaning up directories
+import queue # Bounded admission queue for incoming connections
+import socket
+import threading
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+
+from audio_pipeline import (SAMPLE_RATE, AudioDecodeError, AudioEncodeError, decode_to_pcm, encode_pcm,
+                            negotiate_encoding, response_encodings, wav_header)
+from batching import BatchScheduler
+from jobs import DONE, QUEUED, RUNNING, JobManager, JobQueueFull
+from language_id import create_language_detector
+from metrics import (RTF_BUCKETS, Registry, RequestScope, current_scope, log, request_scope,
+                     sanitize_request_id, timed)
+from multipart_upload import UploadError, parse_multipart
+from segmentation import split_at_silences, stitch, translate_segments
+from seamless_backends import create_router
+from translation_cache import create_cache
+from waveform_cache import create_waveform_cache, to_pcm
+from warmup import StartupState, warm_up
 
 # PORT will be set by Cloud Run, default to 8080 for local testing
 PORT = int(os.environ.get("PORT", 8080))
 HOST = '0.0.0.0' # Listen on all available interfaces
 
-class AudioTranslationHandler(http.server.SimpleHTTPRequestHandler):
+# Concurrency settings (Cloud Run sends at most --concurrency requests per instance)
+SERVER_WORKERS = int(os.environ.get("SERVER_WORKERS", 8)) # Connections served in parallel
+SERVER_QUEUE_SIZE = int(os.environ.get("SERVER_QUEUE_SIZE", 16)) # Connections waiting for a worker
+KEEPALIVE_TIMEOUT = float(os.environ.get("KEEPALIVE_TIMEOUT", 15)) # Idle seconds before closing a connection
+RETRY_AFTER = int(os.environ.get("RETRY_AFTER", 5)) # Seconds suggested to clients rejected with 503
+REJECT_QUEUE_SIZE = int(os.environ.get("REJECT_QUEUE_SIZE", 64)) # Rejected connections waiting for their 503
+REJECT_DRAIN_SECONDS = float(os.environ.get("REJECT_DRAIN_SECONDS", 1)) # Longest time spent answering one of them
+
+# Upload and response limits
+MAX_UPLOAD_BYTES = int(os.environ.get("MAX_UPLOAD_BYTES", 50 * 1024 * 1024)) # Larger bodies are rejected with 413
+UPLOAD_SPOOL_BYTES = int(os.environ.get("UPLOAD_SPOOL_BYTES", 8 * 1024 * 1024)) # Uploads above this spill to a temp file
+RESPONSE_CHUNK_SIZE = 64 * 1024
+
+# Response encoding, negotiated from the Accept header (WAV unless Opus or AAC is asked for)
+RESPONSE_OPUS_BITRATE = os.environ.get("RESPONSE_OPUS_BITRATE", "24k")
+RESPONSE_AAC_BITRATE = os.environ.get("RESPONSE_AAC_BITRATE", "48k")
+RESPONSE_ENCODINGS = response_encodings(opus_bitrate=RESPONSE_OPUS_BITRATE, aac_bitrate=RESPONSE_AAC_BITRATE)
+
+# Micro-batching: requests for the same model and tgt_lang arriving within the
+# window run as one batched inference (0 disables batching)
+BATCH_WINDOW_MS = float(os.environ.get("BATCH_WINDOW_MS", 0))
+BATCH_MAX_SIZE = int(os.environ.get("BATCH_MAX_SIZE", 4))
+
+# Asynchronous jobs: POST with mode=async returns a job id, GET /jobs/<id> returns the result
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", 2)) # Background threads running jobs
+JOB_MAX_PENDING = int(os.environ.get("JOB_MAX_PENDING", 64)) # Queued + running jobs before 503
+JOB_RESULT_TTL = float(os.environ.get("JOB_RESULT_TTL", 600)) # Seconds a finished job is kept
+JOB_MAX_WAIT = float(os.environ.get("JOB_MAX_WAIT", 60)) # Longest long-poll on GET /jobs/<id>
+
+# Segmented translation of long recordings ('segment=1' in the form, 'stream=1' to stream chunks as they finish)
+SEGMENT_MAX_SECONDS = float(os.environ.get("SEGMENT_MAX_SECONDS", 20)) # Longest chunk handed to the model
+SEGMENT_MIN_SECONDS = float(os.environ.get("SEGMENT_MIN_SECONDS", 5)) # Shortest chunk, except the last one
+SEGMENT_IN_FLIGHT = int(os.environ.get("SEGMENT_IN_FLIGHT", 4)) # Chunks of one request translated at once
+SEGMENT_WORKERS = int(os.environ.get("SEGMENT_WORKERS", 8)) # Threads shared by all segmented requests
+
+# Same-language short-circuit: uploads detected to be in tgt_lang already are sent back untouched
+LANGUAGE_MIN_PROBABILITY = float(os.environ.get("LANGUAGE_MIN_PROBABILITY", 0.8)) # Detector confidence required
+TASKS = ("s2st", "s2tt") # 'task' form field: speech (default) or text-only translation
+
+# Startup: /readyz stays 503 until every backend is loaded and has run a synthetic inference
+WARMUP_SECONDS = float(os.environ.get("WARMUP_SECONDS", 2)) # Length of the synthetic audio (0 skips the inference)
+
+# Translation models are loaded once per worker and kept in memory
+router = create_router()
+# Results are cached by (audio hash, tgt_lang, model), see translation_cache.py
+cache = create_cache()
+# Decoded uploads shared with the taggers (WAVEFORM_CACHE_DIR, off by default), see waveform_cache.py
+waveform_cache = create_waveform_cache()
+# Concurrent requests for the same model and tgt_lang are batched, see batching.py
+scheduler = BatchScheduler(router, window_ms=BATCH_WINDOW_MS, max_batch_size=BATCH_MAX_SIZE)
+# Long translations can run as background jobs, see jobs.py
+jobs = JobManager(workers=JOB_WORKERS, result_ttl=JOB_RESULT_TTL, max_pending=JOB_MAX_PENDING)
+
+startup = StartupState()
+
+# Spoken language identification (LANGUAGE_DETECTOR), see language_id.py; None when off
+language_detector = create_language_detector()
+
+# Chunks of segmented requests run here; with batching on, concurrent chunks share batches
+segment_pool = ThreadPoolExecutor(max_workers=SEGMENT_WORKERS, thread_name_prefix="segment")
+
+# Metrics exposed on GET /metrics, see metrics.py
+registry = Registry()
+STAGE_SECONDS = registry.histogram(
+    "translation_stage_seconds",
+    "Latency of each request stage (queue, parse, cache, decode, language_id, inference, first_chunk, encode, write)",
+    labelnames=("stage",))
+REQUEST_SECONDS = registry.histogram(
+    "http_request_seconds", "End-to-end request latency", labelnames=("method", "status"))
+TRANSLATION_RTF = registry.histogram(
+    "translation_rtf", "Inference seconds per second of input audio", buckets=RTF_BUCKETS, labelnames=("tgt_lang",))
+BYTES_IN = registry.counter("http_request_bytes_total", "Request body bytes received")
+BYTES_OUT = registry.counter("http_response_bytes_total", "Response body bytes sent")
+in_flight = 0
+in_flight_lock = threading.Lock()
+registry.gauge("server_ready", "1 once the models are loaded and warmed up", lambda: int(startup.ready))
+registry.gauge("http_requests_in_flight", "Requests currently being handled", lambda: in_flight)
+registry.gauge("batch_pending_requests", "Requests waiting for a batch", scheduler.pending)
+registry.gauge("jobs_pending", "Async jobs queued or running",
+               lambda: sum(n for status, n in jobs.counts().items() if status in (QUEUED, RUNNING)))
+for stat in cache.stats.as_dict():
+    registry.gauge(f"translation_cache_{stat}", f"Translation cache {stat.replace('_', ' ')}",
+                   lambda stat=stat: getattr(cache.stats, stat))
+if waveform_cache is not None:
+    for stat in ("hits", "misses", "evictions"):
+        registry.gauge(f"waveform_cache_{stat}", f"Decoded-waveform cache {stat}",
+                       lambda stat=stat: getattr(waveform_cache, stat))
+
+def cache_lookup(file_item, tgt_lang, segmented=False):
+    """
+    Look the upload up in the result cache. Returns (cache key, cached
+    TranslationResult or None); `file_item` is closed on a hit.
+    """
+    # The router picks the expressive model for expressive_langs and M4T otherwise
+    backend = router.select(tgt_lang)
+    # Segmented output differs from whole-file output, so it is cached separately
+    model_id = f"{backend.cache_id}:segmented" if segmented else backend.cache_id
+
+    # Replayed translations are served from the cache without ffmpeg or the model
+    cache_key = cache.make_key(file_item.sha256, tgt_lang, model_id)
+    with timed(STAGE_SECONDS, "cache"):
+        cached = cache.get(cache_key)
+    if cached is not None:
+        file_item.close()
+        log(f"Cache hit for '{file_item.filename}' -> '{tgt_lang}' ({backend.name}). Stats: {cache.stats.as_dict()}")
+    return cache_key, cached
+
+
+class SameLanguage(Exception):
+    """The upload is already in the target language, so it is sent back as it is."""
+
+    def __init__(self, src_lang, probability=None):
+        super().__init__(f"Source audio is already in '{src_lang}'")
+        self.src_lang = src_lang
+        self.probability = probability
+
+
+def decode_upload(file_item, detect_language=False, tgt_lang=None):
+    """
+    Decode the upload into 16 kHz mono s16 PCM, closing `file_item` as soon as it
+    has been decoded. With `detect_language`, raises SameLanguage (leaving
+    `file_item` open, to be sent back) when the speech is already in `tgt_lang`.
+    """
+    # Decode the upload in memory: the bytes are piped through ffmpeg and come
+    # back as 16 kHz mono s16 PCM. The upload is released as soon as it is decoded.
+    log(f"Decoding upload '{file_item.filename}' ({file_item.size} bytes) to 16 kHz mono PCM")
+    try:
+        with timed(STAGE_SECONDS, "decode"):
+            if waveform_cache is None:
+                pcm = decode_to_pcm(file_item.getbuffer())
+            else:
+                samples = waveform_cache.load(file_item.sha256, SAMPLE_RATE,
+                                              lambda: decode_to_pcm(file_item.getbuffer()))
+                pcm = to_pcm(samples)
+    except BaseException:
+        file_item.close()
+        raise
+    log(f"Audio preprocessing successful. PCM size: {len(pcm)} bytes ({len(pcm) / (2 * SAMPLE_RATE):.2f}s)")
+
+    if detect_language and language_detector is not None:
+        try:
+            with timed(STAGE_SECONDS, "language_id"):
+                src_lang, probability = language_detector.detect(pcm)
+        except BaseException:
+            file_item.close()
+            raise
+        log(f"Detected source language '{src_lang}' (p={probability:.2f})")
+        if src_lang == tgt_lang and probability >= LANGUAGE_MIN_PROBABILITY:
+            raise SameLanguage(src_lang, probability)
+    file_item.close()
+    return pcm
+
+
+def segment_results(pcm, tgt_lang):
+    """Split `pcm` at silences and translate the chunks in parallel; yields their results in order."""
+    bounds = split_at_silences(pcm, max_seconds=SEGMENT_MAX_SECONDS, min_seconds=SEGMENT_MIN_SECONDS)
+    log(f"Translating {len(pcm)} bytes of PCM to '{tgt_lang}' as {len(bounds)} chunks")
+    return translate_segments(
+        pcm, tgt_lang, lambda chunk, lang: segment_pool.submit(scheduler.translate, chunk, lang),
+        bounds, max_in_flight=SEGMENT_IN_FLIGHT)
+
+
+def translate_upload(file_item, tgt_lang, segmented=False, detect_language=False):
+    """
+    Run the translation pipeline for one uploaded file: cache lookup, in-memory
+    decode, (batched) inference, whole or in chunks split at silences.
+    Closes `file_item` as soon as it has been decoded.
+    Returns (TranslationResult, cache status "HIT" or "MISS"); raises SameLanguage
+    when `detect_language` finds the upload already in `tgt_lang`.
+    """
+    cache_key, cached = cache_lookup(file_item, tgt_lang, segmented)
+    if cached is not None:
+        return cached, "HIT"
+
+    pcm = decode_upload(file_item, detect_language, tgt_lang)
+    audio_seconds = len(pcm) / (2 * SAMPLE_RATE)
+    start = time.perf_counter()
+    with timed(STAGE_SECONDS, "inference"):
+        if segmented:
+            result = stitch(segment_results(pcm, tgt_lang))
+        else:
+            log(f"Translating {len(pcm)} bytes of PCM to '{tgt_lang}' with backend '{router.select(tgt_lang).name}'")
+            result = scheduler.translate(pcm, tgt_lang)
+    if audio_seconds > 0:
+        TRANSLATION_RTF.observe((time.perf_counter() - start) / audio_seconds, tgt_lang=tgt_lang)
+    del pcm
+    log(f"Translation successful. Text: {result.text}")
+    cache.put(cache_key, result)
+    return result, "MISS"
+
+
+def translate_upload_text(file_item, tgt_lang):
+    """Speech-to-text translation (S2TT) of one uploaded file: no unit decoder, no vocoder."""
+    pcm = decode_upload(file_item)
+    backend = router.select_text(tgt_lang)
+    log(f"Translating {len(pcm)} bytes of PCM to '{tgt_lang}' text with backend '{backend.name}'")
+    with timed(STAGE_SECONDS, "inference"):
+        text = backend.translate_text(pcm, tgt_lang)
+    log(f"Translation successful. Text: {text}")
+    return text
+
+
+class OriginalAudio:
+    """Job result for an upload already in the target language: a copy of its bytes, sent back as they are."""
+
+    def __init__(self, file_item, src_lang):
+        self.filename = file_item.filename
+        self.content_type = file_item.content_type
+        self.src_lang = src_lang
+        self._body = bytes(file_item.getbuffer())
+
+    def getbuffer(self):
+        return self._body
+
+
+def run_job(request_id, file_item, tgt_lang, segmented=False, detect_language=False):
+    """
+    Job body: the translation pipeline under the id of the request that queued it.
+    Returns (TranslationResult or OriginalAudio, cache status).
+    """
+    with request_scope(RequestScope(request_id)) as scope:
+        try:
+            result = translate_upload(file_item, tgt_lang, segmented, detect_language)
+        except SameLanguage as e:
+            try:
+                result = OriginalAudio(file_item, e.src_lang), None
+            finally:
+                file_item.close()
+        log(f"Job finished ({scope.timings_summary()})")
+        return result
+
+
+class AudioTranslationHandler(http.server.BaseHTTPRequestHandler):
+    # HTTP/1.1 keeps connections alive between requests; idle connections are
+    # closed after KEEPALIVE_TIMEOUT seconds so they do not pin a worker forever.
+    protocol_version = "HTTP/1.1"
+    timeout = KEEPALIVE_TIMEOUT
+
+    def send_response(self, code, message=None):
+        super().send_response(code, message)
+        self.response_status = code
+        scope = current_scope()
+        if scope is not None:
+            self.send_header("X-Request-ID", scope.id)
+
+    def log_message(self, format, *args):
+        log(f"{self.address_string()} - {format % args}")
+
+    def handle_request(self, method, handler):
+        """Run `handler` under a request scope and record its latency and outcome."""
+        global in_flight
+        scope = RequestScope(sanitize_request_id(self.headers.get("X-Request-ID")))
+        self.response_status = None
+        with in_flight_lock:
+            in_flight += 1
+        try:
+            with request_scope(scope):
+                handler()
+                summary = scope.timings_summary()
+                log(f"{method} {self.path} -> {self.response_status} in {scope.elapsed() * 1000:.1f}ms"
+                    + (f" ({summary})" if summary else ""))
+        finally:
+            with in_flight_lock:
+                in_flight -= 1
+            REQUEST_SECONDS.observe(scope.elapsed(), method=method, status=self.response_status)
+
+    def send_text(self, status, message, content_type="text/plain"):
+        """Send a plain text response with an explicit Content-Length (required for keep-alive)."""
+        body = message.encode() if isinstance(message, str) else message
+        self.send_response(status)
+        self.send_header("Content-type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        BYTES_OUT.inc(len(body))
+
+    def send_json(self, status, data, headers=None):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+        BYTES_OUT.inc(len(body))
+
+    def do_GET(self):
+        self.handle_request("GET", self.route_get)
+
+    def route_get(self):
+        url = urllib.parse.urlsplit(self.path)
+        if url.path == "/healthz":
+            # Liveness: the process is up and serving HTTP, models or not
+            self.send_json(200, {"status": "ok"})
+            return
+        if url.path == "/readyz":
+            self.send_json(200 if startup.ready else 503, startup.as_dict())
+            return
+        if url.path == "/metrics":
+            self.send_text(200, registry.render(), content_type="text/plain; version=0.0.4")
+            return
+        if url.path.startswith("/jobs/"):
+            self.get_job(url.path[len("/jobs/"):], urllib.parse.parse_qs(url.query))
+            return
+        self.send_text(404, "Error: not found.")
+
+    def get_job(self, job_id, query):
+        """
+        Job status as JSON while the job is queued or running (or has failed), the
+        translated audio once it is done. `?wait=<seconds>` long-polls until the job
+        finishes or the wait (capped at JOB_MAX_WAIT) runs out.
+        """
+        job = jobs.get(job_id)
+        if job is None:
+            self.send_json(404, {"job_id": job_id, "status": "unknown",
+                                 "error": "Job not found or its result has expired."})
+            return
+        try:
+            wait = min(float(query.get("wait", ["0"])[0]), JOB_MAX_WAIT)
+        except ValueError:
+            self.send_text(400, "Error: 'wait' must be a number of seconds.")
+            return
+        if wait > 0:
+            job.wait(wait)
+        if job.status == DONE:
+            result, cache_status = job.result
+            if isinstance(result, OriginalAudio):
+                self.send_original(result, result.src_lang)
+            else:
+                self.send_audio(result, job.output_name, cache_status=cache_status)
+        else:
+            self.send_json(200, job.as_dict())
+
     def do_POST(self):
-        temp_dir = None # Initialize to None for cleanup
+        self.handle_request("POST", self.translate_request)
+
+    def translate_request(self):
+        form = None
         try:
-            # Parse the form data posted
-            form = cgi.FieldStorage(
-                fp=self.rfile,
-                headers=self.headers,
-                environ={'REQUEST_METHOD': 'POST',
-                         'CONTENT_TYPE': self.headers['Content-Type']}
-            )
+            # Parse the form data posted, streaming it from the socket
+            try:
+                with timed(STAGE_SECONDS, "parse"):
+                    form = parse_multipart(self.rfile, self.headers, MAX_UPLOAD_BYTES, UPLOAD_SPOOL_BYTES)
+            except UploadError as e:
+                # The rest of the body was not read, so this connection cannot be reused
+                self.close_connection = True
+                self.send_text(e.status, str(e))
+                log(f"Rejected upload: {e}")
+                return
+            BYTES_IN.inc(int(self.headers.get("Content-Length", 0)))
 
             # Look for a file in the form
-            if "audio_file" not in form:
-                self.send_response(400)
-                self.send_header("Content-type", "text/plain")
-                self.end_headers()
-                self.wfile.write(b"Error: 'audio_file' not found in form data.")
+            if "audio_file" not in form.files:
+                self.send_text(400, "Error: 'audio_file' not found in form data.")
                 return
 
-            file_item = form["audio_file"]
+            file_item = form.files["audio_file"]
+            filename = file_item.filename
 
-            if not file_item.filename:
-                self.send_response(400)
-                self.send_header("Content-type", "text/plain")
-                self.end_headers()
-                self.wfile.write(b"Error: No file selected or file has no name.")
+            if not filename:
+                self.send_text(400, "Error: No file selected or file has no name.")
                 return
 
             # Get target language
-            if "tgt_lang" not in form:
-                self.send_response(400)
-                self.send_header("Content-type", "text/plain")
-                self.end_headers()
-                self.wfile.write(b"Error: 'tgt_lang' not found in form data.")
+            if "tgt_lang" not in form.fields:
+                self.send_text(400, "Error: 'tgt_lang' not found in form data.")
                 return
             
             tgt_lang = form.getvalue("tgt_lang")
             # Basic validation for tgt_lang (e.g., 3-letter code)
             if not isinstance(tgt_lang, str) or len(tgt_lang) != 3:
-                self.send_response(400)
-                self.send_header("Content-type", "text/plain")
-                self.end_headers()
-                self.wfile.write(b"Error: 'tgt_lang' must be a 3-letter code.")
-                print(f"Invalid tgt_lang received: {tgt_lang}")
+                self.send_text(400, "Error: 'tgt_lang' must be a 3-letter code.")
+                log(f"Invalid tgt_lang received: {tgt_lang}")
                 return
 
-            # Create a temporary directory to store input and output files
-            temp_dir = tempfile.mkdtemp()
-            
-            # Save uploaded file to a temporary file
-            input_filename = os.path.join(temp_dir, file_item.filename)
-            with open(input_filename, 'wb') as f_in:
-                f_in.write(file_item.file.read())
-
-            print(f"DEBUG: Attempting to use input file: {input_filename}")
-            print(f"DEBUG: Does input file exist? {os.path.exists(input_filename)}")
-            print(f"DEBUG: Is input file a file? {os.path.isfile(input_filename)}")
-            if os.path.exists(input_filename):
-                print(f"DEBUG: Input file size: {os.path.getsize(input_filename)} bytes")
-
-            # Preprocess: Convert to 16kHz, 16-bit, mono WAV using ffmpeg
-            preprocessed_filename = os.path.join(temp_dir, "preprocessed_input.wav")
-            ffmpeg_cmd = [
-                "ffmpeg", "-y", "-i", input_filename,
-                "-ar", "16000", "-ac", "1", "-sample_fmt", "s16",
-                preprocessed_filename
-            ]
-            print(f"Running ffmpeg command: {' '.join(ffmpeg_cmd)}")
-            ffmpeg_proc = subprocess.Popen(ffmpeg_cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            ffmpeg_stdout, ffmpeg_stderr = ffmpeg_proc.communicate()
-            if ffmpeg_proc.returncode != 0:
-                self.send_response(500)
-                self.send_header("Content-type", "text/plain")
-                self.end_headers()
-                error_message = f"Error during audio preprocessing: {ffmpeg_stderr.decode()}"
-                self.wfile.write(error_message.encode())
-                print(error_message)
-                return
-            print(f"Audio preprocessing successful. Preprocessed file: {preprocessed_filename}")
-
-            # Choose which model to use based on tgt_lang
-            expressive_langs = ["spa", "fra", "deu", "eng", "cmn", "ita"]
-            use_expressive = tgt_lang in expressive_langs
-
-            # Define the output file path (extension might change based on m4t, but .wav is common)
-            base_name, original_ext = os.path.splitext(file_item.filename)
-            output_filename = os.path.join(temp_dir, f"{base_name}_translated.wav") # Assume .wav output for now
-
-            if use_expressive:
-                # Use expressivity_predict
-                cmd = [
-                    "expressivity_predict", preprocessed_filename,
-                    "--tgt_lang", tgt_lang,
-                    "--model_name", "seamless_expressivity",
-                    "--vocoder_name", "vocoder_pretssel",
-                    "--gated-model-dir", "/app/seamless_expressive_pts",
-                    "--output_path", output_filename
-                ]
-            else:
-                # Use m4t_predict
-                cmd = [
-                    "m4t_predict", preprocessed_filename,
-                    "--task", "S2ST",
-                    "--tgt_lang", tgt_lang,
-                    "--output_path", output_filename
-                ]
-
-            print(f"Executing command: {' '.join(cmd)}")
-            
-            # Run the command
-            process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            stdout, stderr = process.communicate()
-
-            if process.returncode != 0:
-                self.send_response(500)
-                self.send_header("Content-type", "text/plain")
-                self.end_headers()
-                error_message = f"Error during translation: {stderr.decode()}"
-                self.wfile.write(error_message.encode())
-                print(error_message)
-                print(f"Stdout: {stdout.decode()}")
+            task = form.getvalue("task", "s2st").lower()
+            if task not in TASKS:
+                self.send_text(400, f"Error: 'task' must be one of {', '.join(TASKS)}.")
                 return
-            
-            print(f"Translation successful. Stdout: {stdout.decode()}")
-            print(f"Checking for output file: {output_filename}")
-
-
-            # Check if the output file was created
-            if not os.path.exists(output_filename):
-                # m4t_predict might create output in a subdirectory if output_path is a dir,
-                # or use a different naming convention.
-                # Let's list the temp_dir to find the output if direct path fails.
-                possible_outputs = [f for f in os.listdir(temp_dir) if f.endswith(('.wav', '.mp3', '.m4a')) and f != os.path.basename(input_filename)]
-                if not possible_outputs:
-                    self.send_response(500)
-                    self.send_header("Content-type", "text/plain")
-                    self.end_headers()
-                    self.wfile.write(b"Error: Translated audio file not found after processing.")
-                    print(f"Translated file not found at {output_filename}. Contents of {temp_dir}: {os.listdir(temp_dir)}")
+            src_lang = form.getvalue("src_lang")
+            if src_lang is not None and len(src_lang) != 3:
+                self.send_text(400, "Error: 'src_lang' must be a 3-letter code.")
+                return
+
+            base_name, original_ext = os.path.splitext(filename)
+            output_name = f"{base_name}_translated.wav"
+            segmented = form.getvalue("segment", "").lower() in ("1", "true", "yes")
+            stream = segmented and form.getvalue("stream", "").lower() in ("1", "true", "yes")
+
+            # Text-only translation is cheap enough to always answer synchronously
+            if task == "s2tt":
+                try:
+                    text = translate_upload_text(file_item, tgt_lang)
+                except AudioDecodeError as e:
+                    error_message = f"Error during audio preprocessing: {e}"
+                    self.send_text(500, error_message)
+                    log(error_message)
                     return
-                # If multiple, pick the first one. This might need refinement.
-                output_filename = os.path.join(temp_dir, possible_outputs[0])
-                print(f"Found translated file: {output_filename}")
-
-
-            # Read the translated file content
-            with open(output_filename, 'rb') as f_out:
-                translated_audio_data = f_out.read()
-
-            # Send the response
-            self.send_response(200)
-            # Determine content type for the translated audio (assuming .wav for now)
-            content_type = 'audio/wav' 
-            lower_output_filename = output_filename.lower()
-            if '.mp3' in lower_output_filename:
-                content_type = 'audio/mpeg'
-            elif '.m4a' in lower_output_filename:
-                content_type = 'audio/mp4'
-            
-            self.send_header("Content-type", content_type)
-            # Use a generic name or derive from original
-            self.send_header("Content-Disposition", f'attachment; filename="translated_{os.path.basename(output_filename)}"')
-            self.end_headers()
-            self.wfile.write(translated_audio_data)
-            print(f"Sent translated file: {os.path.basename(output_filename)}, size: {len(translated_audio_data)} bytes, type: {content_type}")
+                self.send_json(200, {"task": task, "tgt_lang": tgt_lang, "text": text})
+                return
+
+            # A client that knows the recording is already in tgt_lang gets it back at once
+            if src_lang == tgt_lang:
+                self.send_original(file_item, src_lang)
+                return
+
+            # Without a declared src_lang, the detector (if any) checks for the same-language case
+            detect_language = src_lang is None
+
+            # Asynchronous mode: 'mode=async' in the form or 'Prefer: respond-async'
+            if form.getvalue("mode") == "async" or "respond-async" in self.headers.get("Prefer", ""):
+                # The job takes ownership of the uploaded file and closes it after decoding
+                form.files.pop("audio_file")
+                try:
+                    job = jobs.submit(run_job, current_scope().id, file_item, tgt_lang, segmented, detect_language,
+                                      output_name=output_name)
+                except JobQueueFull as e:
+                    file_item.close()
+                    self.send_json(503, {"error": f"Job queue full: {e}"}, {"Retry-After": str(RETRY_AFTER)})
+                    return
+                log(f"Queued job {job.id} for '{filename}' -> '{tgt_lang}'")
+                status_url = f"/jobs/{job.id}"
+                self.send_json(202, dict(job.as_dict(), status_url=status_url), {"Location": status_url})
+                return
+
+            try:
+                if stream:
+                    self.stream_translation(file_item, tgt_lang, output_name, detect_language)
+                    return
+                result, cache_status = translate_upload(file_item, tgt_lang, segmented, detect_language)
+            except SameLanguage as e:
+                self.send_original(file_item, e.src_lang)
+                return
+            except AudioDecodeError as e:
+                error_message = f"Error during audio preprocessing: {e}"
+                self.send_text(500, error_message)
+                log(error_message)
+                return
+
+            self.send_audio(result, output_name, cache_status=cache_status)
 
         except Exception as e:
-            self.send_response(500)
-            self.send_header("Content-type", "text/plain")
-            self.end_headers()
             error_msg = f"Server Error: {e}"
-            self.wfile.write(error_msg.encode())
-            print(error_msg)
-            # Also print stdout/stderr from subprocess if available and relevant
-            if 'process' in locals() and hasattr(process, 'stdout') and process.stdout:
-                 print(f"Subprocess STDOUT: {stdout.decode(errors='ignore') if stdout else 'N/A'}")
-            if 'process' in locals() and hasattr(process, 'stderr') and process.stderr:
-                 print(f"Subprocess STDERR: {stderr.decode(errors='ignore') if stderr else 'N/A'}")
+            self.send_text(500, error_msg)
+            log(error_msg)
 
+        finally:
+            if form is not None:
+                form.close()
+
+    def stream_translation(self, file_item, tgt_lang, output_name, detect_language=False):
+        """
+        Segmented translation with progressive output: each chunk is sent as soon
+        as it and every chunk before it are translated, so neither the client nor
+        the server waits for, or holds, the whole translated recording.
+        """
+        cache_key, cached = cache_lookup(file_item, tgt_lang, segmented=True)
+        if cached is not None:
+            self.send_audio(cached, output_name, cache_status="HIT")
+            return
+        pcm = decode_upload(file_item, detect_language, tgt_lang)
+        results = segment_results(pcm, tgt_lang)
+        try:
+            # Errors up to the first chunk still get a proper error response
+            with timed(STAGE_SECONDS, "first_chunk"):
+                first = next(results)
+        except StopIteration:
+            self.send_audio(stitch([]), output_name, cache_status="MISS")
+            return
+        pcm_chunks = itertools.chain([first.pcm], (result.pcm for result in results))
 
+        encoding = negotiate_encoding(self.headers.get("Accept"), RESPONSE_ENCODINGS)
+        if encoding.ffmpeg_args is None:
+            # Streamed WAV: the sizes in the header are unknown, so they are set to the maximum
+            header = wav_header(0xFFFFFFFF - 36, first.sample_rate)
+            body = itertools.chain([header], pcm_chunks)
+        else:
+            encoded = encode_pcm(pcm_chunks, first.sample_rate, encoding, RESPONSE_CHUNK_SIZE)
+            try:
+                with timed(STAGE_SECONDS, "encode"):
+                    body = itertools.chain([next(encoded, b"")], encoded)
+            except AudioEncodeError as e:
+                results.close()
+                error_message = f"Error encoding the response as {encoding.name}: {e}"
+                self.send_text(500, error_message)
+                log(error_message)
+                return
+        try:
+            self.send_stream(encoding, output_name, body, cache_status="MISS")
         finally:
-            # Clean up the temporary directory
-            if temp_dir and os.path.exists(temp_dir):
-                try:
-                    shutil.rmtree(temp_dir)
-                    print(f"Successfully removed temporary directory: {temp_dir}")
-                except Exception as e_clean:
-                    print(f"Error cleaning up temporary directory {temp_dir}: {e_clean}")
+            if encoding.ffmpeg_args is not None:
+                encoded.close() # Stops ffmpeg; its feeder thread stops at the next chunk
+            else:
+                results.close() # Cancels the chunks not started yet
+
+    def send_original(self, file_item, src_lang):
+        """Send the uploaded audio back byte for byte: it is already in the target language."""
+        content_type = mimetypes.guess_type(file_item.filename)[0] or file_item.content_type
+        body = file_item.getbuffer()
+        self.send_response(200)
+        self.send_header("Content-type", content_type)
+        self.send_header("Content-Disposition", f'attachment; filename="{file_item.filename}"')
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("X-Source-Lang", src_lang)
+        self.end_headers()
+        with timed(STAGE_SECONDS, "write"):
+            view = memoryview(body)
+            for offset in range(0, len(view), RESPONSE_CHUNK_SIZE):
+                self.wfile.write(view[offset:offset + RESPONSE_CHUNK_SIZE])
+        BYTES_OUT.inc(len(body))
+        log(f"Source already in '{src_lang}', sent the original file: {file_item.filename}, size: {len(body)} bytes")
+
+    def send_audio(self, result, output_name, cache_status=None):
+        """
+        Send translated PCM in the encoding negotiated from the Accept header.
+
+        Opus and AAC are encoded by ffmpeg while the response is being written, with
+        chunked transfer encoding since the size is not known up front. WAV is the
+        fallback, also when the encoder fails before anything was sent.
+        """
+        encoding = negotiate_encoding(self.headers.get("Accept"), RESPONSE_ENCODINGS)
+        if encoding.ffmpeg_args is None:
+            self.send_wav(result, output_name, cache_status)
+            return
+
+        chunks = encode_pcm(result.pcm, result.sample_rate, encoding, RESPONSE_CHUNK_SIZE)
+        try:
+            try:
+                with timed(STAGE_SECONDS, "encode"):
+                    first = next(chunks, b"")
+            except AudioEncodeError as e:
+                log(f"Encoding to {encoding.name} failed, sending WAV instead: {e}")
+                self.send_wav(result, output_name, cache_status)
+                return
+            self.send_stream(encoding, output_name, itertools.chain([first], chunks), cache_status)
+        finally:
+            chunks.close() # Stops ffmpeg if the client went away
+
+    def send_stream(self, encoding, output_name, chunks, cache_status=None):
+        """
+        Send a response body of unknown length from the `chunks` iterable, with
+        chunked transfer encoding (or until the connection closes for HTTP/1.0).
+        """
+        output_name = os.path.splitext(output_name)[0] + encoding.extension
+        chunked = self.request_version != "HTTP/1.0"
+        self.send_response(200)
+        self.send_header("Content-type", encoding.content_type)
+        self.send_header("Content-Disposition", f'attachment; filename="translated_{output_name}"')
+        self.send_header("Vary", "Accept")
+        if chunked:
+            self.send_header("Transfer-Encoding", "chunked")
+        else:
+            self.close_connection = True # HTTP/1.0: the end of the body is the end of the connection
+        if cache_status:
+            self.send_header("X-Cache", cache_status)
+        self.end_headers()
+
+        sent = 0
+        try:
+            with timed(STAGE_SECONDS, "write"):
+                for chunk in chunks:
+                    if not chunk:
+                        continue
+                    if chunked:
+                        self.wfile.write(b"%x\r\n" % len(chunk))
+                    self.wfile.write(chunk)
+                    if chunked:
+                        self.wfile.write(b"\r\n")
+                    sent += len(chunk)
+                if chunked:
+                    self.wfile.write(b"0\r\n\r\n")
+        except Exception as e:
+            # The headers are out, so drop the connection without the final chunk:
+            # the client sees an incomplete body rather than a truncated file
+            self.close_connection = True
+            log(f"Response failed mid-stream after {sent} bytes: {e}")
+            return
+        finally:
+            BYTES_OUT.inc(sent)
+        log(f"Sent translated file: {output_name}, size: {sent} bytes, type: {encoding.content_type}")
+
+    def send_wav(self, result, output_name, cache_status=None):
+        """Send translated PCM as a WAV file: the header is built in place, the PCM is written as-is."""
+        header = wav_header(len(result.pcm), result.sample_rate)
+        content_type = 'audio/wav'
+        self.send_response(200)
+        self.send_header("Content-type", content_type)
+        # Use a generic name or derive from original
+        self.send_header("Content-Disposition", f'attachment; filename="translated_{output_name}"')
+        self.send_header("Content-Length", str(len(header) + len(result.pcm)))
+        self.send_header("Vary", "Accept")
+        if cache_status:
+            self.send_header("X-Cache", cache_status)
+        self.end_headers()
+        with timed(STAGE_SECONDS, "write"):
+            self.wfile.write(header)
+            # Stream the PCM out in chunks rather than handing the socket one large buffer
+            pcm = memoryview(result.pcm)
+            for offset in range(0, len(pcm), RESPONSE_CHUNK_SIZE):
+                self.wfile.write(pcm[offset:offset + RESPONSE_CHUNK_SIZE])
+        BYTES_OUT.inc(len(header) + len(result.pcm))
+        log(f"Sent translated file: {output_name}, size: {len(header) + len(result.pcm)} bytes, type: {content_type}")
+
+
+class BoundedThreadPoolHTTPServer(http.server.HTTPServer):
+    """
+    HTTP server that hands accepted connections to a fixed pool of worker threads.
+
+    Connections wait in a bounded admission queue while all workers are busy. When
+    the queue is full the connection is answered at once with 503 and Retry-After
+    instead of piling up behind long translations. The 503 is written and the
+    socket drained by a reaper thread, so a slow client never stalls accept().
+    """
+
+    def __init__(self, server_address, handler_class, workers=SERVER_WORKERS,
+                 queue_size=SERVER_QUEUE_SIZE, retry_after=RETRY_AFTER):
+        self.request_queue_size = max(queue_size, 5) # listen() backlog
+        super().__init__(server_address, handler_class)
+        self.retry_after = retry_after
+        self.pending = queue.Queue(maxsize=queue_size)
+        self.workers = []
+        for i in range(workers):
+            worker = threading.Thread(target=self._worker_loop, name=f"http-worker-{i}", daemon=True)
+            worker.start()
+            self.workers.append(worker)
+        self.rejected = queue.Queue(maxsize=REJECT_QUEUE_SIZE)
+        threading.Thread(target=self._reaper_loop, name="http-reaper", daemon=True).start()
+
+    def process_request(self, request, client_address):
+        try:
+            self.pending.put_nowait((request, client_address, time.perf_counter()))
+        except queue.Full:
+            self._reject(request, client_address)
+
+    def _worker_loop(self):
+        while True:
+            item = self.pending.get()
+            if item is None:
+                return
+            request, client_address, enqueued = item
+            STAGE_SECONDS.observe(time.perf_counter() - enqueued, stage="queue")
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    def _reject(self, request, client_address):
+        log(f"Admission queue full ({self.pending.maxsize}), rejecting {client_address[0]}")
+        try:
+            self.rejected.put_nowait(request)
+        except queue.Full:
+            # The reaper is behind too: close without a response rather than block accept()
+            self.close_request(request)
+
+    def _reaper_loop(self):
+        body = b"Server busy, retry later."
+        response = (
+            b"HTTP/1.1 503 Service Unavailable\r\n"
+            b"Content-type: text/plain\r\n"
+            b"Content-Length: %d\r\n"
+            b"Retry-After: %d\r\n"
+            b"Connection: close\r\n\r\n" % (len(body), self.retry_after)
+        ) + body
+        while True:
+            request = self.rejected.get()
+            if request is None:
+                return
+            try:
+                request.settimeout(REJECT_DRAIN_SECONDS)
+                request.sendall(response)
+                request.shutdown(socket.SHUT_WR)
+                # Drain what the client already sent so close() does not turn into a reset
+                request.settimeout(0.05)
+                deadline = time.monotonic() + REJECT_DRAIN_SECONDS
+                drained = 0
+                while drained < 1 << 20 and time.monotonic() < deadline:
+                    chunk = request.recv(65536)
+                    if not chunk:
+                        break
+                    drained += len(chunk)
+            except OSError:
+                pass
+            self.close_request(request)
+
+    def server_close(self):
+        super().server_close()
+        for _ in self.workers:
+            self.pending.put(None)
+        self.rejected.put(None)
 
 
 Handler = AudioTranslationHandler # Changed handler name
 
 if __name__ == '__main__': # Ensure this runs only when script is executed directly
-    with socketserver.TCPServer((HOST, PORT), Handler) as httpd:
-        print(f"Serving at host {HOST} port {PORT}")
-        httpd.serve_forever()
\ No newline at end of file
+    with BoundedThreadPoolHTTPServer((HOST, PORT), Handler) as httpd:
+        registry.gauge("http_queue_depth", "Connections waiting for a worker", httpd.pending.qsize)
+        print(f"Serving at host {HOST} port {PORT} with {SERVER_WORKERS} workers, queue size {SERVER_QUEUE_SIZE}")
+        # Translations that arrive before warm-up is done wait for the model load
+        threading.Thread(target=warm_up, args=(router, startup, WARMUP_SECONDS, language_detector),
+                         name="warm-up", daemon=True).start()
+        httpd.serve_forever()
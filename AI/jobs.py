@@ -0,0 +1,104 @@
+## Asynchronous translation jobs for http_seamless.py.
+## A POST can hand its work to a background pool and return a job id at once;
+## the client then polls (or long-polls) GET /jobs/<id> for the result, so long
+## recordings survive client and Cloud Run request timeouts.
+
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+
+class JobQueueFull(Exception):
+    """Raised when too many jobs are already waiting."""
+
+
+class Job:
+    def __init__(self, output_name):
+        self.id = uuid.uuid4().hex
+        self.output_name = output_name
+        self.status = QUEUED
+        self.created = time.time()
+        self.finished = None
+        self.result = None
+        self.error = None
+        self._done = threading.Event()
+
+    @property
+    def is_finished(self):
+        return self._done.is_set()
+
+    def wait(self, timeout):
+        return self._done.wait(timeout)
+
+    def as_dict(self):
+        info = {"job_id": self.id, "status": self.status}
+        if self.error is not None:
+            info["error"] = self.error
+        return info
+
+
+class JobManager:
+    """
+    Runs jobs on `workers` background threads and keeps finished jobs for
+    `result_ttl` seconds. At most `max_pending` jobs may be queued or running.
+    """
+
+    def __init__(self, workers=2, result_ttl=600, max_pending=64):
+        self.result_ttl = result_ttl
+        self.max_pending = max_pending
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="job-worker")
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def submit(self, fn, *args, output_name=None):
+        """Schedule `fn(*args)`; its return value becomes the job result."""
+        with self._lock:
+            self._purge_expired()
+            pending = sum(1 for job in self._jobs.values() if not job.is_finished)
+            if pending >= self.max_pending:
+                raise JobQueueFull(f"{pending} jobs already pending")
+            job = Job(output_name)
+            self._jobs[job.id] = job
+        self._executor.submit(self._run, job, fn, args)
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            self._purge_expired()
+            return self._jobs.get(job_id)
+
+    def counts(self):
+        with self._lock:
+            counts = {QUEUED: 0, RUNNING: 0, DONE: 0, FAILED: 0}
+            for job in self._jobs.values():
+                counts[job.status] += 1
+            return counts
+
+    def _run(self, job, fn, args):
+        job.status = RUNNING
+        try:
+            job.result = fn(*args)
+            job.status = DONE
+        except Exception as e:
+            job.error = str(e)
+            job.status = FAILED
+            print(f"Job {job.id} failed: {e}")
+        finally:
+            job.finished = time.time()
+            job._done.set()
+
+    def _purge_expired(self):
+        now = time.time()
+        expired = [job_id for job_id, job in self._jobs.items()
+                   if job.finished is not None and now - job.finished > self.result_ttl]
+        for job_id in expired:
+            del self._jobs[job_id]
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
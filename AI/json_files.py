@@ -0,0 +1,28 @@
+## Escritura atómica de ficheros JSON, solo con la biblioteca estándar para que
+## el cliente ligero (tagger_client.py) no tenga que importar numpy ni los modelos.
+
+import json
+import os
+import tempfile
+
+
+def write_json_atomic(path, data):
+    """
+    Escribir `data` como JSON en `path` de forma atómica: se escribe en un fichero
+    temporal del mismo directorio y se renombra, así quien lee nunca ve un JSON a medias.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(prefix=".tmp_", suffix=".json", dir=directory)
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
@@ -0,0 +1,89 @@
+## Spoken language identification for http_seamless.py.
+## Used to send the original audio back untouched when a recording is already
+## in the requested target language, instead of re-synthesising it.
+
+import os
+import threading
+import time
+
+from seamless_backends import SAMPLE_RATE
+
+# Whisper language codes -> ISO 639-3 codes as used for tgt_lang by Seamless
+WHISPER_TO_ISO3 = {
+    "ar": "arb", "ca": "cat", "cs": "ces", "cy": "cym", "da": "dan", "de": "deu", "en": "eng",
+    "es": "spa", "et": "est", "eu": "eus", "fa": "pes", "fi": "fin", "fr": "fra", "gl": "glg",
+    "hi": "hin", "id": "ind", "it": "ita", "ja": "jpn", "ko": "kor", "mt": "mlt", "nl": "nld",
+    "pl": "pol", "pt": "por", "ro": "ron", "ru": "rus", "sk": "slk", "sv": "swe", "sw": "swh",
+    "te": "tel", "th": "tha", "tl": "tgl", "tr": "tur", "uk": "ukr", "ur": "urd", "uz": "uzn",
+    "vi": "vie", "zh": "cmn",
+}
+
+
+class WhisperLanguageDetector:
+    """
+    Language identification with Whisper's language head (the encoder plus a
+    single decoder step), on at most the first `max_seconds` of the audio.
+    """
+    name = "whisper"
+
+    def __init__(self, model_name="tiny", max_seconds=30):
+        self.model_name = model_name
+        self.max_seconds = max_seconds
+        self.model = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        with self._lock:
+            if self.model is not None:
+                return
+            import torch
+            import whisper
+            start = time.time()
+            device = "cuda" if torch.cuda.is_available() else "cpu"
+            self.model = whisper.load_model(self.model_name, device=device)
+            print(f"Language detector 'whisper-{self.model_name}' loaded in {time.time() - start:.2f}s")
+
+    def detect(self, pcm):
+        """Return (ISO 639-3 code or None, probability) for 16 kHz mono s16 PCM."""
+        import numpy as np
+        import torch
+        import whisper
+        self.load()
+        pcm = pcm[:int(self.max_seconds * SAMPLE_RATE) * 2]
+        audio = whisper.pad_or_trim(np.frombuffer(pcm, dtype=np.int16).astype(np.float32) / 32768.0)
+        with self._lock, torch.inference_mode():
+            mel = whisper.log_mel_spectrogram(audio, n_mels=self.model.dims.n_mels).to(self.model.device)
+            _, probs = self.model.detect_language(mel)
+        code = max(probs, key=probs.get)
+        return WHISPER_TO_ISO3.get(code), probs[code]
+
+
+class FixedLanguageDetector:
+    """Reports the same language for every input; for tests and load tests with the fake backend."""
+    name = "fixed"
+
+    def __init__(self, lang):
+        self.lang = lang
+
+    def load(self):
+        pass
+
+    def detect(self, pcm):
+        return self.lang, 1.0
+
+
+def create_language_detector():
+    """
+    Build the language detector from environment variables:
+      LANGUAGE_DETECTOR: "none" (default), "whisper" or "fixed:<lang>"
+      WHISPER_LID_MODEL: Whisper model size for the detector (default "tiny")
+    Returns None when detection is off.
+    """
+    kind = os.environ.get("LANGUAGE_DETECTOR", "none")
+    if kind in ("", "none"):
+        return None
+    if kind == "whisper":
+        return WhisperLanguageDetector(os.environ.get("WHISPER_LID_MODEL", "tiny"))
+    if kind.startswith("fixed:"):
+        return FixedLanguageDetector(kind[len("fixed:"):])
+    raise ValueError(f"Unknown LANGUAGE_DETECTOR: {kind}")
@@ -0,0 +1,273 @@
+## Load generator for http_seamless.py.
+## Replays the files in audios_test as concurrent multipart POSTs, by default
+## against a local server started with the fake backend (which sleeps in
+## proportion to audio length instead of running a model), and reports latency
+## percentiles, throughput and error rate per concurrency level. Results are
+## also written as JSON so runs can be compared across commits.
+##
+##   python load_test.py --concurrency 1,4,8 --requests 64
+##   python load_test.py --url http://localhost:8080/ --concurrency 2
+
+import argparse
+import datetime
+import http.client
+import io
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+import urllib.parse
+import uuid
+import wave
+from concurrent.futures import ThreadPoolExecutor
+
+from git_info import git_commit
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+AUDIO_EXTENSIONS = (".wav", ".mp3", ".m4a", ".mp4", ".ogg", ".aac", ".flac", ".webm")
+
+
+def load_payloads(audio_dir, tgt_lang, accept=None):
+    """Pre-build one multipart body per audio file, so the client side costs nothing per request."""
+    payloads = []
+    for name in sorted(os.listdir(audio_dir)):
+        if not name.lower().endswith(AUDIO_EXTENSIONS):
+            continue
+        with open(os.path.join(audio_dir, name), "rb") as f:
+            data = f.read()
+        boundary = uuid.uuid4().hex
+        body = b"".join([
+            f"--{boundary}\r\n".encode(),
+            f'Content-Disposition: form-data; name="tgt_lang"\r\n\r\n{tgt_lang}\r\n'.encode(),
+            f"--{boundary}\r\n".encode(),
+            f'Content-Disposition: form-data; name="audio_file"; filename="{name}"\r\n'.encode(),
+            b"Content-Type: application/octet-stream\r\n\r\n",
+            data,
+            f"\r\n--{boundary}--\r\n".encode(),
+        ])
+        headers = {"Content-Type": f"multipart/form-data; boundary={boundary}"}
+        if accept:
+            headers["Accept"] = accept
+        payloads.append({"name": name, "body": body, "headers": headers, "seconds": audio_seconds(data)})
+    return payloads
+
+
+def audio_seconds(data):
+    """Duration of a WAV file, or None for other formats."""
+    try:
+        with wave.open(io.BytesIO(data), "rb") as wav_in:
+            return wav_in.getnframes() / wav_in.getframerate()
+    except (wave.Error, EOFError):
+        return None
+
+
+class Client:
+    """One keep-alive connection per worker thread, reopened after errors and closes."""
+
+    def __init__(self, url, timeout):
+        self.url = urllib.parse.urlsplit(url)
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = http.client.HTTPConnection(
+                self.url.hostname, self.url.port or 80, timeout=self.timeout)
+        return conn
+
+    def _reset(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+        self._local.conn = None
+
+    def post(self, payload):
+        start = time.perf_counter()
+        status, error, size = None, None, 0
+        try:
+            conn = self._connection()
+            conn.request("POST", self.url.path or "/", body=payload["body"], headers=payload["headers"])
+            response = conn.getresponse()
+            size = len(response.read())
+            status = response.status
+            if response.will_close:
+                self._reset()
+        except (OSError, http.client.HTTPException) as e:
+            error = f"{type(e).__name__}: {e}"
+            self._reset()
+        return {
+            "file": payload["name"],
+            "status": status,
+            "error": error,
+            "latency": time.perf_counter() - start,
+            "response_bytes": size,
+            "audio_seconds": payload["seconds"],
+        }
+
+
+def percentile(sorted_values, p):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return None
+    rank = max(1, -(-len(sorted_values) * p // 100)) # ceil(n * p / 100)
+    return sorted_values[int(rank) - 1]
+
+
+def run_level(client, payloads, concurrency, num_requests):
+    """Send `num_requests` POSTs, cycling through the payloads, from `concurrency` threads."""
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(client.post, (payloads[i % len(payloads)] for i in range(num_requests))))
+    wall = time.perf_counter() - start
+
+    ok = [r for r in results if r["status"] == 200]
+    latencies = sorted(r["latency"] for r in ok)
+    status_counts = {}
+    for r in results:
+        key = str(r["status"]) if r["status"] is not None else "connection_error"
+        status_counts[key] = status_counts.get(key, 0) + 1
+    audio_done = sum(r["audio_seconds"] or 0 for r in ok)
+    return {
+        "concurrency": concurrency,
+        "requests": num_requests,
+        "succeeded": len(ok),
+        "error_rate": round(1 - len(ok) / num_requests, 4) if num_requests else 0.0,
+        "status_counts": status_counts,
+        "wall_seconds": round(wall, 3),
+        "throughput_rps": round(len(ok) / wall, 3) if wall > 0 else None,
+        "audio_seconds_per_second": round(audio_done / wall, 3) if wall > 0 else None,
+        "latency_seconds": {
+            "p50": percentile(latencies, 50),
+            "p95": percentile(latencies, 95),
+            "p99": percentile(latencies, 99),
+            "mean": sum(latencies) / len(latencies) if latencies else None,
+            "max": latencies[-1] if latencies else None,
+        },
+        "errors": sorted({r["error"] for r in results if r["error"]})[:10],
+    }
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_server(port, delay_factor, extra_env, log_path):
+    """Start http_seamless.py with the fake backend and the result cache off, and wait until it is ready."""
+    env = dict(os.environ)
+    env.update({
+        "PORT": str(port),
+        "SEAMLESS_BACKEND": "fake",
+        "FAKE_DELAY_FACTOR": str(delay_factor),
+        "CACHE_MEMORY_BYTES": "0", # Replayed files would otherwise all be cache hits
+        "CACHE_DIR": "",
+        "WARMUP_SECONDS": "0",
+    })
+    env.update(extra_env)
+    log_file = open(log_path, "wb")
+    proc = subprocess.Popen([sys.executable, os.path.join(HERE, "http_seamless.py")],
+                            cwd=HERE, env=env, stdout=log_file, stderr=subprocess.STDOUT)
+    deadline = time.time() + 60
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"Server exited with code {proc.returncode}, see {log_path}")
+        try:
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=1)
+            conn.request("GET", "/readyz")
+            if conn.getresponse().status == 200:
+                conn.close()
+                return proc, log_file
+            conn.close()
+        except OSError:
+            pass
+        time.sleep(0.2)
+    proc.terminate()
+    raise RuntimeError(f"Server not ready after 60s, see {log_path}")
+
+
+def format_ms(seconds):
+    return f"{seconds * 1000:9.1f}" if seconds is not None else f"{'-':>9}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test http_seamless.py by replaying audios_test.")
+    parser.add_argument("--url", help="Target an already running server instead of starting one")
+    parser.add_argument("--audio-dir", default=os.path.join(HERE, "audios_test"))
+    parser.add_argument("--tgt-lang", default="spa")
+    parser.add_argument("--accept", help="Accept header to send, e.g. audio/ogg")
+    parser.add_argument("--concurrency", default="1,4,8", help="Comma-separated concurrency levels")
+    parser.add_argument("--requests", type=int, default=None,
+                        help="Requests per level (default: 4 per concurrent client)")
+    parser.add_argument("--delay-factor", type=float, default=0.1,
+                        help="Fake backend seconds of sleep per second of audio")
+    parser.add_argument("--server-env", action="append", default=[], metavar="KEY=VALUE",
+                        help="Extra environment for the started server, e.g. BATCH_WINDOW_MS=20")
+    parser.add_argument("--timeout", type=float, default=300)
+    parser.add_argument("--output", help="JSON results path (default: load_test_results/<time>_<commit>.json)")
+    args = parser.parse_args()
+
+    levels = [int(c) for c in args.concurrency.split(",") if c.strip()]
+    payloads = load_payloads(args.audio_dir, args.tgt_lang, args.accept)
+    if not payloads:
+        sys.exit(f"No audio files in {args.audio_dir}")
+    extra_env = dict(item.split("=", 1) for item in args.server_env)
+
+    commit = git_commit()
+    started = datetime.datetime.now()
+    output = args.output or os.path.join(
+        HERE, "load_test_results", f"{started:%Y%m%d_%H%M%S}_{commit or 'nogit'}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+
+    proc = log_file = None
+    url = args.url
+    if url is None:
+        port = free_port()
+        log_path = os.path.splitext(output)[0] + "_server.log"
+        print(f"Starting fake-backend server on port {port} (log: {log_path})")
+        proc, log_file = start_server(port, args.delay_factor, extra_env, log_path)
+        url = f"http://127.0.0.1:{port}/"
+
+    print(f"Replaying {len(payloads)} files from {args.audio_dir} against {url}")
+    results = []
+    try:
+        for concurrency in levels:
+            num_requests = args.requests or 4 * concurrency
+            client = Client(url, args.timeout)
+            level = run_level(client, payloads, concurrency, num_requests)
+            results.append(level)
+            lat = level["latency_seconds"]
+            print(f"c={concurrency:<4} n={num_requests:<5} p50={format_ms(lat['p50'])}ms p95={format_ms(lat['p95'])}ms "
+                  f"p99={format_ms(lat['p99'])}ms  {level['throughput_rps']:.2f} req/s  "
+                  f"errors={level['error_rate']:.1%}")
+    finally:
+        if proc is not None:
+            proc.terminate()
+            proc.wait()
+            log_file.close()
+
+    report = {
+        "timestamp": started.isoformat(timespec="seconds"),
+        "git_commit": commit,
+        "url": url if args.url else None,
+        "config": {
+            "audio_dir": os.path.relpath(args.audio_dir, HERE),
+            "files": [p["name"] for p in payloads],
+            "tgt_lang": args.tgt_lang,
+            "accept": args.accept,
+            "delay_factor": None if args.url else args.delay_factor,
+            "server_env": extra_env,
+        },
+        "levels": results,
+    }
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,196 @@
+## Almacén persistente de embeddings (y transcripciones) por mensaje.
+## Cada columna es un modelo con su versión (HuBERT, audio de CLAP, Whisper,
+## mpnet...) y guarda un valor por mensaje: un vector float32 o un texto.
+## Con esto, volver a etiquetar con otra taxonomía (16tags -> all_tags) solo
+## necesita la búsqueda de etiquetas cercanas (ver retag.py), sin volver a pasar
+## los audios por los modelos, y los mensajes nuevos se añaden al final.
+##
+## Una columna es un directorio con:
+##   index.jsonl: una línea {"id": ...} por fila (con "value" en las de texto)
+##   embeddings.f32: matriz (filas, dim) float32 sin cabecera, que se abre con memmap
+## Los datos se escriben antes que el índice, así que una escritura interrumpida
+## deja como mucho filas sin indexar que la siguiente escritura sobrescribe.
+
+import contextlib
+import fcntl
+import json
+import os
+
+import numpy as np
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_STORE_DIR = os.environ.get("MESSAGE_EMBEDDINGS_DIR", os.path.join(HERE, "message_embeddings"))
+KINDS = ("embedding", "text")
+
+
+class MessageEmbeddingStore:
+    """
+    Args:
+        column: Modelo y versión de la columna (p. ej. "hubert_facebook/hubert-base-ls960")
+        kind: "embedding" (un vector por mensaje) o "text" (p. ej. la transcripción)
+        store_dir: Directorio raíz del almacén
+    """
+
+    def __init__(self, column, kind="embedding", store_dir=DEFAULT_STORE_DIR):
+        if kind not in KINDS:
+            raise ValueError(f"Tipo de columna desconocido: {kind}")
+        self.column = column
+        self.kind = kind
+        self.directory = os.path.join(store_dir, column.replace("/", "_"))
+        self.index_path = os.path.join(self.directory, "index.jsonl")
+        self.data_path = os.path.join(self.directory, "embeddings.f32")
+        self.meta_path = os.path.join(self.directory, "meta.json")
+        self._rows = {} # id -> fila (la última, si un mensaje se ha vuelto a calcular)
+        self._texts = []
+        self._num_rows = 0
+        self._offset = 0 # Bytes del índice ya leídos
+        self.dim = None
+
+    def __len__(self):
+        self._refresh()
+        return len(self._rows)
+
+    def __contains__(self, message_id):
+        self._refresh()
+        return str(message_id) in self._rows
+
+    def _refresh(self):
+        """Leer las filas que otros procesos hayan añadido al índice desde la última vez."""
+        try:
+            with open(self.index_path, "rb") as f:
+                f.seek(self._offset)
+                data = f.read()
+        except FileNotFoundError:
+            return
+        if self.dim is None and self.kind == "embedding" and os.path.exists(self.meta_path):
+            with open(self.meta_path) as f:
+                self.dim = json.load(f)["dim"]
+        # Una línea sin "\n" final es una escritura a medias: se ignora
+        for line in data.split(b"\n")[:-1]:
+            self._offset += len(line) + 1
+            entry = json.loads(line)
+            self._rows[entry["id"]] = self._num_rows
+            if self.kind == "text":
+                self._texts.append(entry["value"])
+            self._num_rows += 1
+
+    @contextlib.contextmanager
+    def _lock(self):
+        """Lock entre procesos (worker, daemon, notebooks) mientras se añaden filas."""
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, ".lock"), "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _matrix(self):
+        if not self._num_rows:
+            return np.zeros((0, self.dim or 0), dtype=np.float32)
+        return np.memmap(self.data_path, dtype=np.float32, mode="r", shape=(self._num_rows, self.dim))
+
+    def get(self, message_ids):
+        """Valores guardados de `message_ids` (los que estén), como diccionario id -> valor."""
+        self._refresh()
+        rows = {mid: self._rows[str(mid)] for mid in message_ids if str(mid) in self._rows}
+        if self.kind == "text":
+            return {mid: self._texts[row] for mid, row in rows.items()}
+        matrix = self._matrix()
+        return {mid: np.array(matrix[row]) for mid, row in rows.items()}
+
+    def put(self, message_ids, values):
+        """Añadir (o recalcular) los valores de `message_ids`."""
+        message_ids = [str(mid) for mid in message_ids]
+        if len(message_ids) != len(values):
+            raise ValueError(f"{len(message_ids)} mensajes y {len(values)} valores")
+        if not message_ids:
+            return
+        with self._lock():
+            self._refresh()
+            first_row = self._num_rows
+            entries = [{"id": mid} for mid in message_ids]
+            if self.kind == "text":
+                for entry, value in zip(entries, values):
+                    entry["value"] = value
+            else:
+                values = np.asarray(values, dtype=np.float32).reshape(len(message_ids), -1)
+                if self.dim is None:
+                    self.dim = int(values.shape[1])
+                    with open(self.meta_path, "w") as f:
+                        json.dump({"column": self.column, "dim": self.dim}, f)
+                elif values.shape[1] != self.dim:
+                    raise ValueError(f"Dimensión {values.shape[1]} distinta de la de {self.directory} ({self.dim})")
+                # Se escribe justo después de la última fila indexada, pisando restos de escrituras a medias
+                with _open_rw(self.data_path) as f:
+                    f.seek(first_row * self.dim * 4)
+                    f.write(values.tobytes())
+                    f.truncate()
+                    f.flush()
+                    os.fsync(f.fileno())
+
+            with _open_rw(self.index_path) as f:
+                f.seek(self._offset)
+                f.write(b"".join(json.dumps(entry, ensure_ascii=False).encode("utf-8") + b"\n" for entry in entries))
+                f.truncate()
+                f.flush()
+                os.fsync(f.fileno())
+            self._refresh()
+
+    def load_or_compute(self, message_ids, inputs, compute):
+        """
+        Valores de `message_ids` en el mismo orden. Los que no estén guardados se
+        calculan con `compute(lista de inputs de esos mensajes)` y se añaden.
+        """
+        stored = self.get(message_ids)
+        missing = [i for i, mid in enumerate(message_ids) if mid not in stored]
+        if missing:
+            computed = compute([inputs[i] for i in missing])
+            self.put([message_ids[i] for i in missing], computed)
+            for i, value in zip(missing, computed):
+                stored[message_ids[i]] = value
+        return [stored[mid] for mid in message_ids]
+
+    def load_or_compute_stream(self, message_ids, inputs, compute, flush_every=64):
+        """
+        Como load_or_compute, para un `compute(inputs)` que devuelve (input, valor)
+        a medida que los calcula, en cualquier orden (p. ej. audio_prefetch.embed_files).
+        Devuelve (input, valor), primero los guardados; los valores None no se guardan.
+        Los valores se guardan de `flush_every` en `flush_every` (cada put toma el
+        lock y hace fsync), y los que queden al terminar o al cerrar el generador.
+        """
+        stored = self.get(message_ids)
+        pending = {}
+        for message_id, item in zip(message_ids, inputs):
+            if message_id in stored:
+                yield item, stored[message_id]
+            else:
+                pending[item] = message_id
+        if not pending:
+            return
+        ids, values = [], []
+        try:
+            for item, value in compute(list(pending)):
+                if value is not None:
+                    ids.append(pending[item])
+                    values.append(value)
+                    if len(ids) >= flush_every:
+                        self.put(ids, values)
+                        ids, values = [], []
+                yield item, value
+        finally:
+            self.put(ids, values)
+
+    def items(self):
+        """Todos los mensajes guardados: (ids, matriz (n, dim)) o (ids, textos)."""
+        self._refresh()
+        ids = list(self._rows)
+        rows = list(self._rows.values())
+        if self.kind == "text":
+            return ids, [self._texts[row] for row in rows]
+        return ids, self._matrix()[rows]
+
+
+def _open_rw(path):
+    """Abrir `path` para leer y escribir en cualquier posición, creándolo si no existe."""
+    return os.fdopen(os.open(path, os.O_RDWR | os.O_CREAT, 0o644), "r+b")
@@ -0,0 +1,234 @@
+## Streaming multipart/form-data parser for http_seamless.py (replaces cgi.FieldStorage).
+## The body is read in fixed-size chunks straight from the socket, its size is
+## checked against a limit before anything is read, and file parts are spooled
+## in memory up to a threshold and to an anonymous temporary file beyond it.
+
+import email.parser
+import hashlib
+import io
+import re
+import tempfile
+
+CHUNK_SIZE = 64 * 1024
+MAX_HEADER_BYTES = 16 * 1024 # Per-part header block
+MAX_FIELD_BYTES = 64 * 1024 # Per non-file field
+
+
+class UploadError(Exception):
+    """Rejected upload. `status` is the HTTP status code to answer with."""
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class SpoolBuffer:
+    """
+    Write-once buffer kept in memory up to `spool_size` bytes, then rolled over to a temp file.
+    The SHA-256 of the contents is computed while writing, so no second pass is needed.
+    """
+
+    def __init__(self, spool_size):
+        self.spool_size = spool_size
+        self.size = 0
+        self._hash = hashlib.sha256()
+        self._file = io.BytesIO()
+        self._in_memory = True
+
+    def write(self, data):
+        if self._in_memory and self.size + len(data) > self.spool_size:
+            rolled = tempfile.TemporaryFile()
+            rolled.write(self._file.getbuffer())
+            self._file = rolled
+            self._in_memory = False
+        self._file.write(data)
+        self.size += len(data)
+        self._hash.update(data)
+
+    @property
+    def sha256(self):
+        return self._hash.hexdigest()
+
+    def getbuffer(self):
+        """Contents as a bytes-like object, without copying when still in memory."""
+        if self._in_memory:
+            return self._file.getbuffer()
+        self._file.seek(0)
+        return self._file.read()
+
+    def close(self):
+        if self._file is not None and not self._in_memory:
+            self._file.close()
+        self._file = None # An in-memory buffer is freed once the last view of it is released
+
+
+class UploadedFile:
+    """A file part of the form."""
+
+    def __init__(self, filename, content_type, buffer):
+        self.filename = filename
+        self.content_type = content_type
+        self.buffer = buffer
+
+    @property
+    def size(self):
+        return self.buffer.size
+
+    @property
+    def sha256(self):
+        return self.buffer.sha256
+
+    def getbuffer(self):
+        return self.buffer.getbuffer()
+
+    def close(self):
+        self.buffer.close()
+
+
+class MultipartForm:
+    """Parsed form: text `fields` and `files`, both keyed by field name."""
+
+    def __init__(self):
+        self.fields = {}
+        self.files = {}
+
+    def __contains__(self, name):
+        return name in self.fields or name in self.files
+
+    def getvalue(self, name, default=None):
+        return self.fields.get(name, default)
+
+    def close(self):
+        for uploaded in self.files.values():
+            uploaded.close()
+
+
+_boundary_re = re.compile(r'boundary=(?:"([^"]+)"|([^;\s]+))', re.IGNORECASE)
+
+
+def _get_boundary(content_type):
+    if not content_type or not content_type.lower().startswith("multipart/form-data"):
+        raise UploadError(415, "Error: Content-Type must be multipart/form-data.")
+    match = _boundary_re.search(content_type)
+    if not match:
+        raise UploadError(400, "Error: multipart boundary missing from Content-Type.")
+    boundary = (match.group(1) or match.group(2)).encode("latin-1")
+    if len(boundary) > 200:
+        raise UploadError(400, "Error: multipart boundary too long.")
+    return boundary
+
+
+def _body_reader(rfile, length):
+    remaining = length
+    while remaining > 0:
+        chunk = rfile.read(min(CHUNK_SIZE, remaining))
+        if not chunk:
+            raise UploadError(400, "Error: request body ended before Content-Length bytes.")
+        remaining -= len(chunk)
+        yield chunk
+
+
+def parse_multipart(rfile, headers, max_body_size, spool_size):
+    """
+    Parse a multipart/form-data request body from `rfile`.
+
+    Content-Length is required and checked against `max_body_size` before any of
+    the body is read. Exactly Content-Length bytes are consumed, so the connection
+    can be reused on success. Raises UploadError on oversized or malformed input.
+    """
+    boundary = _get_boundary(headers.get("Content-Type"))
+    if headers.get("Transfer-Encoding", "").lower() not in ("", "identity"):
+        raise UploadError(411, "Error: chunked uploads are not supported, send Content-Length.")
+    try:
+        length = int(headers.get("Content-Length"))
+    except (TypeError, ValueError):
+        raise UploadError(411, "Error: Content-Length required.")
+    if length < 0:
+        raise UploadError(400, "Error: invalid Content-Length.")
+    if length > max_body_size:
+        raise UploadError(413, f"Error: upload of {length} bytes exceeds the {max_body_size} byte limit.")
+
+    form = MultipartForm()
+    try:
+        _parse_parts(_body_reader(rfile, length), boundary, form, spool_size)
+    except BaseException:
+        form.close()
+        raise
+    return form
+
+
+def _parse_parts(chunks, boundary, form, spool_size):
+    delimiter = b"--" + boundary
+    part_delimiter = b"\r\n" + delimiter
+    buf = bytearray()
+    chunks = iter(chunks)
+
+    def fill():
+        chunk = next(chunks, None)
+        if chunk is None:
+            raise UploadError(400, "Error: malformed multipart body (unexpected end).")
+        buf.extend(chunk)
+
+    # Preamble: skip everything up to the first delimiter
+    while True:
+        pos = buf.find(delimiter)
+        if pos >= 0:
+            del buf[:pos + len(delimiter)]
+            break
+        del buf[:max(0, len(buf) - len(delimiter))]
+        fill()
+
+    while True:
+        while len(buf) < 2:
+            fill()
+        if buf[:2] == b"--":
+            return # Closing delimiter; anything after it is epilogue
+        # Part headers
+        while True:
+            end = buf.find(b"\r\n\r\n")
+            if end >= 0:
+                break
+            if len(buf) > MAX_HEADER_BYTES:
+                raise UploadError(400, "Error: multipart part headers too large.")
+            fill()
+        if not buf.startswith(b"\r\n"):
+            raise UploadError(400, "Error: malformed multipart body (bad delimiter line).")
+        part_headers = email.parser.BytesHeaderParser().parsebytes(bytes(buf[2:end + 2]))
+        del buf[:end + 4]
+
+        name = part_headers.get_param("name", header="content-disposition")
+        if not name:
+            raise UploadError(400, "Error: multipart part without a field name.")
+        filename = part_headers.get_filename()
+        if filename is not None:
+            sink = SpoolBuffer(spool_size)
+            # A repeated field replaces the earlier file (last one wins, as for text fields)
+            earlier = form.files.pop(name, None)
+            if earlier is not None:
+                earlier.close()
+            form.files[name] = UploadedFile(filename, part_headers.get_content_type(), sink)
+        else:
+            sink = bytearray()
+
+        # Part data runs until CRLF + delimiter; keep a tail that could hold a split delimiter
+        while True:
+            pos = buf.find(part_delimiter)
+            if pos >= 0:
+                sink_data = buf[:pos]
+                del buf[:pos + len(part_delimiter)]
+            else:
+                keep = len(part_delimiter) - 1
+                sink_data = buf[:max(0, len(buf) - keep)]
+                del buf[:len(sink_data)]
+            if sink_data and filename is not None:
+                sink.write(sink_data)
+            elif sink_data:
+                if len(sink) + len(sink_data) > MAX_FIELD_BYTES:
+                    raise UploadError(413, f"Error: form field '{name}' too large.")
+                sink.extend(sink_data)
+            if pos >= 0:
+                break
+            fill()
+
+        if filename is None:
+            form.fields[name] = sink.decode("utf-8", errors="replace")
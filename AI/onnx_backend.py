@@ -0,0 +1,293 @@
+## Backend ONNX Runtime para los modelos de embeddings de los taggers.
+## Cada encoder (SentenceTransformer, HuBERT/Wav2Vec2, audio y texto de CLAP) se
+## exporta a ONNX la primera vez y se guarda en ONNX_CACHE_DIR junto con su
+## tokenizer/procesador. Al exportar, la salida de ONNX Runtime se compara con la
+## de PyTorch sobre varias entradas de ejemplo (otros tamaños de lote y otras
+## longitudes, para probar los ejes dinámicos) y el grafo solo se guarda si
+## coinciden (|onnx - torch| <= ONNX_CHECK_ATOL + ONNX_CHECK_RTOL * |torch|).
+## Las cargas siguientes no tocan PyTorch.
+##
+## Los taggers lo usan con backend="onnx" (por defecto "torch").
+
+import json
+import os
+import shutil
+import time
+
+import numpy as np
+
+DEFAULT_CACHE_DIR = os.environ.get(
+    "ONNX_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "blindwiki", "onnx"))
+CHECK_ATOL = float(os.environ.get("ONNX_CHECK_ATOL", 1e-4))
+CHECK_RTOL = float(os.environ.get("ONNX_CHECK_RTOL", 1e-3)) # Las características de CLAP no están normalizadas
+THREADS = int(os.environ.get("ONNX_THREADS", 0)) # 0: lo decide ONNX Runtime
+OPSET = 17
+BACKENDS = ("torch", "onnx")
+
+
+class OnnxCheckError(ValueError):
+    """La salida del grafo ONNX no coincide con la de PyTorch."""
+
+
+def graph_dir(kind, model_name, cache_dir=DEFAULT_CACHE_DIR):
+    return os.path.join(cache_dir, f"{kind}_{model_name.replace('/', '_')}")
+
+
+def create_session(path, num_threads=None):
+    """
+    Sesión de ONNX Runtime en CPU con todas las optimizaciones de grafo.
+    `num_threads` limita los hilos intra-op de esta sesión (por defecto ONNX_THREADS).
+    """
+    import onnxruntime as ort
+
+    options = ort.SessionOptions()
+    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    num_threads = num_threads or THREADS
+    if num_threads:
+        options.intra_op_num_threads = num_threads
+    return ort.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+
+
+def export_and_check(module, inputs, dynamic_axes, directory, extra=None, check_inputs=()):
+    """
+    Exportar `module(*inputs.values())` a `directory`/model.onnx y comprobar que
+    ONNX Runtime da lo mismo que PyTorch con esas entradas y con cada una de
+    `check_inputs` (otros lotes y longitudes). `inputs` es un dict ordenado
+    nombre -> tensor. Devuelve el manifiesto guardado.
+    """
+    import onnxruntime
+    import torch
+
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, "model.onnx")
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    module = module.to("cpu").eval()
+    names = list(inputs)
+
+    start = time.time()
+    with torch.no_grad():
+        torch.onnx.export(module, tuple(inputs.values()), tmp_path,
+                          input_names=names,
+                          output_names=["embedding"],
+                          dynamic_axes=dict(dynamic_axes, embedding={0: "batch"}),
+                          opset_version=OPSET,
+                          do_constant_folding=True)
+    try:
+        session = create_session(tmp_path)
+        max_diff = 0.0
+        for example in [inputs, *check_inputs]:
+            with torch.no_grad():
+                expected = module(*(example[name] for name in names)).numpy()
+            actual = session.run(None, {name: example[name].numpy() for name in names})[0]
+            shapes = {name: tuple(example[name].shape) for name in names}
+            if actual.shape != expected.shape:
+                raise OnnxCheckError(f"La salida ONNX de {directory} no coincide con PyTorch con entradas {shapes}: "
+                                     f"forma {actual.shape} vs {expected.shape}")
+            diff = np.abs(actual - expected)
+            max_diff = max(max_diff, float(np.max(diff)))
+            if np.any(diff > CHECK_ATOL + CHECK_RTOL * np.abs(expected)):
+                raise OnnxCheckError(f"La salida ONNX de {directory} no coincide con PyTorch con entradas {shapes}: "
+                                     f"diferencia máxima {float(np.max(diff)):.2e}")
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    os.replace(tmp_path, path)
+
+    manifest = dict(extra or {},
+                    inputs=names,
+                    max_abs_diff=max_diff,
+                    atol=CHECK_ATOL,
+                    rtol=CHECK_RTOL,
+                    checked_inputs=1 + len(check_inputs),
+                    opset=OPSET,
+                    torch=torch.__version__,
+                    onnxruntime=onnxruntime.__version__,
+                    exported_at=time.strftime("%Y-%m-%dT%H:%M:%S"))
+    with open(os.path.join(directory, "manifest.json"), "w") as f:
+        json.dump(manifest, f, indent=2)
+    print(f"Exportado {path} en {time.time() - start:.2f}s (diferencia máxima con PyTorch: {max_diff:.2e})")
+    return manifest
+
+
+def load_graph(kind, model_name, build, cache_dir=DEFAULT_CACHE_DIR, num_threads=None):
+    """
+    Cargar el grafo de `kind`/`model_name` desde la caché, o exportarlo antes con
+    `build(directory)`, que debe devolver (módulo, entradas de ejemplo, ejes dinámicos,
+    extra, entradas de comprobación) y puede guardar en `directory` lo que haga falta
+    para usarlo (tokenizer...).
+    Devuelve (sesión, directorio, manifiesto); ver create_session para `num_threads`.
+    """
+    directory = graph_dir(kind, model_name, cache_dir)
+    manifest_path = os.path.join(directory, "manifest.json")
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            if "checked_inputs" not in json.load(f):
+                # Exportado antes de comprobar otros lotes y longitudes: se vuelve a exportar
+                print(f"Grafo ONNX de {directory} sin comprobar con otros tamaños, se vuelve a exportar")
+                shutil.rmtree(directory, ignore_errors=True)
+    if not os.path.exists(manifest_path):
+        try:
+            module, inputs, dynamic_axes, extra, check_inputs = build(directory)
+            export_and_check(module, inputs, dynamic_axes, directory, extra, check_inputs)
+        except BaseException:
+            shutil.rmtree(directory, ignore_errors=True)
+            raise
+    else:
+        print(f"Cargando grafo ONNX desde {directory}")
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    return create_session(os.path.join(directory, "model.onnx"), num_threads), directory, manifest
+
+
+def _named_forward(model, forward, names):
+    """
+    Envolver `model` en un módulo cuyo forward posicional llama a
+    `forward(**{nombre: tensor})`: torch.onnx.export pasa las entradas por posición.
+    """
+    import torch
+
+    class NamedForward(torch.nn.Module):
+        def __init__(self):
+            super().__init__()
+            self.model = model
+
+        def forward(self, *tensors):
+            return forward(**dict(zip(names, tensors)))
+
+    return NamedForward()
+
+
+def _run_batches(session, feeds, batch_size):
+    """Ejecutar `session` por lotes sobre la primera dimensión de `feeds`."""
+    total = len(next(iter(feeds.values())))
+    outputs = [session.run(None, {name: value[i:i + batch_size] for name, value in feeds.items()})[0]
+               for i in range(0, total, batch_size)]
+    return np.concatenate(outputs) if outputs else np.zeros((0, 0), dtype=np.float32)
+
+
+class OnnxTextEncoder:
+    """
+    SentenceTransformer ejecutado con ONNX Runtime. `encode` acepta los mismos
+    argumentos principales que SentenceTransformer.encode y devuelve numpy.
+    """
+
+    def __init__(self, model_name, cache_dir=DEFAULT_CACHE_DIR, num_threads=None):
+        from transformers import AutoTokenizer
+
+        def build(directory):
+            from sentence_transformers import SentenceTransformer
+
+            model = SentenceTransformer(model_name, device="cpu")
+            model.tokenizer.save_pretrained(directory)
+            example = model.tokenizer(["Hola, esto es una prueba del tagger", "Ambient sounds"],
+                                      padding=True, return_tensors="pt")
+            names = list(example.keys())
+            check = model.tokenizer(["Sonidos de la calle", "Una frase bastante más larga que las de la exportación, "
+                                     "para probar otra longitud", "bar"], padding=True, return_tensors="pt")
+            module = _named_forward(model, lambda **features: model(features)["sentence_embedding"], names)
+            axes = {name: {0: "batch", 1: "sequence"} for name in names}
+            return module, dict(example), axes, {"max_seq_length": model.max_seq_length}, [dict(check)]
+
+        self.session, directory, manifest = load_graph("text", model_name, build, cache_dir, num_threads)
+        self.tokenizer = AutoTokenizer.from_pretrained(directory)
+        self.input_names = manifest["inputs"]
+        self.max_seq_length = manifest["max_seq_length"]
+
+    def encode(self, sentences, batch_size=32, normalize_embeddings=False, **kwargs):
+        single = isinstance(sentences, str)
+        sentences = [sentences] if single else list(sentences)
+        outputs = []
+        for i in range(0, len(sentences), batch_size):
+            tokens = self.tokenizer(sentences[i:i + batch_size], padding=True, truncation=True,
+                                    max_length=self.max_seq_length, return_tensors="np")
+            feeds = {name: tokens[name].astype(np.int64) for name in self.input_names}
+            outputs.append(self.session.run(None, feeds)[0])
+        embeddings = np.concatenate(outputs) if outputs else np.zeros((0, 0), dtype=np.float32)
+        if normalize_embeddings:
+            embeddings = embeddings / np.maximum(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12)
+        return embeddings[0] if single else embeddings
+
+
+class OnnxAudioEncoder:
+    """
+    HuBERT / Wav2Vec2 ejecutado con ONNX Runtime. `encode(waveform)` recibe audio
+    mono a 16 kHz con forma (lote, muestras) y devuelve la media temporal del
+    último estado oculto, igual que get_audio_embedding en los taggers.
+    """
+
+    def __init__(self, model_name, cache_dir=DEFAULT_CACHE_DIR, num_threads=None):
+        def build(directory):
+            import torch
+            from transformers import HubertModel, Wav2Vec2Model
+
+            model_class = HubertModel if "hubert" in model_name.lower() else Wav2Vec2Model
+            model = model_class.from_pretrained(model_name)
+            forward = lambda waveform: torch.mean(model(waveform).last_hidden_state, dim=1)
+            module = _named_forward(model, forward, ["waveform"])
+            generator = torch.Generator().manual_seed(0)
+            example = {"waveform": torch.randn(1, 16000, generator=generator) * 0.1}
+            # Los ejes dinámicos se prueban con otro lote y otras longitudes, como en get_audio_embeddings
+            check = [{"waveform": torch.randn(2, 24000, generator=generator) * 0.1},
+                     {"waveform": torch.randn(1, 59123, generator=generator) * 0.1}]
+            return module, example, {"waveform": {0: "batch", 1: "samples"}}, {}, check
+
+        self.session, _, _ = load_graph("audio", model_name, build, cache_dir, num_threads)
+
+    def encode(self, waveform):
+        return self.session.run(None, {"waveform": np.asarray(waveform, dtype=np.float32)})[0]
+
+
+class OnnxClapEncoder:
+    """
+    Encoders de audio y de texto de CLAP ejecutados con ONNX Runtime, con el mismo
+    contrato que ClapModel.get_audio_features / get_text_features. Las entradas son
+    la salida del ClapProcessor (`processor`) con return_tensors="np".
+    """
+
+    def __init__(self, model_name, cache_dir=DEFAULT_CACHE_DIR):
+        from transformers import ClapProcessor
+
+        model = None
+
+        def clap_model():
+            nonlocal model
+            if model is None:
+                from transformers import ClapModel
+                model = ClapModel.from_pretrained(model_name).eval()
+            return model
+
+        def build_audio(directory):
+            processor = ClapProcessor.from_pretrained(model_name)
+            processor.save_pretrained(directory)
+            random = np.random.RandomState(0)
+            waveform = random.randn(48000 * 2).astype(np.float32) * 0.1
+            example = dict(processor(audios=waveform, sampling_rate=48000, return_tensors="pt"))
+            # Lote de 2 con un audio de más de 10 s, que pasa por la fusión de CLAP
+            waveforms = [random.randn(48000 * 4).astype(np.float32) * 0.1,
+                         random.randn(48000 * 14).astype(np.float32) * 0.1]
+            check = dict(processor(audios=waveforms, sampling_rate=48000, return_tensors="pt"))
+            names = list(example)
+            module = _named_forward(clap_model(), clap_model().get_audio_features, names)
+            return module, example, {name: {0: "batch"} for name in names}, {}, [check]
+
+        def build_text(directory):
+            processor = ClapProcessor.from_pretrained(model_name)
+            example = dict(processor(text=["ambient sounds", "bar"], padding=True, return_tensors="pt"))
+            check = dict(processor(text=["traffic and street noise in the city centre", "music", "rain"],
+                                   padding=True, return_tensors="pt"))
+            names = list(example)
+            module = _named_forward(clap_model(), clap_model().get_text_features, names)
+            return module, example, {name: {0: "batch", 1: "sequence"} for name in names}, {}, [check]
+
+        self.audio_session, directory, audio_manifest = load_graph("clap_audio", model_name, build_audio, cache_dir)
+        self.text_session, _, text_manifest = load_graph("clap_text", model_name, build_text, cache_dir)
+        self.audio_inputs = audio_manifest["inputs"]
+        self.text_inputs = text_manifest["inputs"]
+        self.processor = ClapProcessor.from_pretrained(directory)
+
+    def get_audio_features(self, inputs, batch_size=16):
+        return _run_batches(self.audio_session, {name: inputs[name] for name in self.audio_inputs}, batch_size)
+
+    def get_text_features(self, inputs, batch_size=64):
+        feeds = {name: inputs[name].astype(np.int64) for name in self.text_inputs}
+        return _run_batches(self.text_session, feeds, batch_size)
@@ -0,0 +1,79 @@
+## Inferencia cuantizada int8 en CPU para los modelos del Tagger.
+## Las capas Linear de Whisper y del modelo de embeddings se cuantizan con
+## cuantización dinámica de PyTorch (pesos int8, activaciones cuantizadas al vuelo).
+## El modelo cuantizado se guarda en disco la primera vez, así las siguientes
+## cargas no pasan por el modelo fp32 ni repiten la cuantización.
+## Antes de activarlo en producción, comprobar la pérdida con quantization_gate.py.
+
+import os
+import time
+
+DEFAULT_CACHE_DIR = os.environ.get(
+    "QUANTIZED_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "blindwiki", "quantized"))
+QUANTIZATION_MODES = ("int8",)
+
+
+def cache_path(kind, model_name, cache_dir=DEFAULT_CACHE_DIR):
+    """
+    Fichero del modelo cuantizado. Incluye las versiones de torch y transformers:
+    un modelo serializado con otra versión puede no cargar bien.
+    """
+    import torch
+    import transformers
+
+    name = model_name.replace("/", "_")
+    versions = f"torch{torch.__version__}_tf{transformers.__version__}".replace("+", "-")
+    return os.path.join(cache_dir, f"{kind}_{name}_int8_{versions}.pt")
+
+
+def quantize_dynamic_int8(model):
+    """Cuantizar a int8 las capas Linear de `model` (solo CPU)."""
+    import torch
+
+    model = model.to("cpu").eval()
+    return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+
+def load_quantized(kind, model_name, build, cache_dir=DEFAULT_CACHE_DIR):
+    """
+    Cargar el modelo cuantizado de `model_name` desde la caché o, si no está,
+    construir el fp32 con `build()`, cuantizarlo y guardarlo.
+    """
+    import torch
+
+    path = cache_path(kind, model_name, cache_dir)
+    if os.path.exists(path):
+        print(f"Cargando modelo cuantizado int8 desde {path}")
+        # Es un módulo completo serializado por nosotros, no solo pesos
+        return torch.load(path, map_location="cpu", weights_only=False)
+
+    start = time.time()
+    model = quantize_dynamic_int8(build())
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    torch.save(model, tmp_path)
+    os.replace(tmp_path, path)
+    print(f"Modelo {model_name} cuantizado a int8 en {time.time() - start:.2f}s y guardado en {path}")
+    return model
+
+
+def quantized_sentence_transformer(model_name, cache_dir=DEFAULT_CACHE_DIR):
+    """SentenceTransformer con las capas Linear del encoder en int8."""
+    from sentence_transformers import SentenceTransformer
+
+    return load_quantized("text", model_name, lambda: SentenceTransformer(model_name, device="cpu"), cache_dir)
+
+
+def quantized_asr_pipeline(model_name, cache_dir=DEFAULT_CACHE_DIR, **pipeline_kwargs):
+    """Pipeline de ASR de transformers con el modelo Whisper en int8."""
+    from transformers import AutoModelForSpeechSeq2Seq, AutoProcessor, pipeline
+
+    model = load_quantized("asr", model_name,
+                           lambda: AutoModelForSpeechSeq2Seq.from_pretrained(model_name), cache_dir)
+    processor = AutoProcessor.from_pretrained(model_name)
+    return pipeline("automatic-speech-recognition",
+                    model=model,
+                    tokenizer=processor.tokenizer,
+                    feature_extractor=processor.feature_extractor,
+                    device=-1,
+                    **pipeline_kwargs)
@@ -0,0 +1,115 @@
+## Control de precisión del modo cuantizado int8 (quantization.py).
+## Etiqueta los mismos audios con los modelos fp32 y con los int8 en CPU y compara:
+## WER de la transcripción int8 respecto a la fp32 (compute_wer.calculate_wer),
+## coincidencia de etiquetas (Jaccard y primera etiqueta) y tiempo de etiquetado.
+## Sale con código 1 si la pérdida supera los umbrales, para decidir con datos
+## si activar TAGGER_QUANTIZE=int8.
+##
+##   python quantization_gate.py --audio-dir audios_test --max-wer 0.05 --min-tag-agreement 0.9
+
+import argparse
+import datetime
+import json
+import os
+import sys
+import time
+
+from compute_wer import calculate_wer
+from git_info import git_commit
+from tagging import DEFAULT_TAGS_FILE, TextTagger
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+AUDIO_EXTENSIONS = (".wav", ".mp3", ".m4a", ".ogg", ".flac", ".amr")
+
+
+def run(audio_files, quantize, args):
+    tagger = TextTagger(tags_file=args.tags_file,
+                        text_model_name=args.text_model,
+                        asr_model_name=args.asr_model,
+                        device="cpu",
+                        quantize=quantize)
+    # Una pasada de calentamiento para no medir la primera inicialización
+    tagger.tag_files(audio_files[:1])
+    start = time.time()
+    results = tagger.tag_files(audio_files, batch_size=args.batch_size)
+    return results, time.time() - start
+
+
+def jaccard(a, b):
+    union = a | b
+    return len(a & b) / len(union) if union else 1.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Comparar el etiquetado fp32 con el int8 cuantizado")
+    parser.add_argument("--audio-dir", default=os.path.join(HERE, "audios_test"))
+    parser.add_argument("--tags-file", default=DEFAULT_TAGS_FILE)
+    parser.add_argument("--text-model", default="paraphrase-multilingual-mpnet-base-v2")
+    parser.add_argument("--asr-model", default="openai/whisper-small")
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--max-wer", type=float, default=0.05, help="WER medio máximo del int8 respecto al fp32")
+    parser.add_argument("--min-tag-agreement", type=float, default=0.9,
+                        help="Coincidencia (Jaccard) media mínima de las etiquetas")
+    parser.add_argument("--output", help="Ruta del JSON (por defecto quantization_results/<fecha>_<commit>.json)")
+    args = parser.parse_args()
+
+    audio_files = [os.path.join(args.audio_dir, f) for f in sorted(os.listdir(args.audio_dir))
+                   if f.lower().endswith(AUDIO_EXTENSIONS)]
+    if not audio_files:
+        sys.exit(f"No hay audios en {args.audio_dir}")
+
+    print(f"Etiquetando {len(audio_files)} audios con fp32...")
+    reference, fp32_seconds = run(audio_files, None, args)
+    print(f"Etiquetando {len(audio_files)} audios con int8...")
+    quantized, int8_seconds = run(audio_files, "int8", args)
+
+    files = []
+    for path, ref, hyp in zip(audio_files, reference, quantized):
+        ref_tags = [t["tag"] for t in ref["tags"]]
+        hyp_tags = [t["tag"] for t in hyp["tags"]]
+        files.append({
+            "file": os.path.basename(path),
+            "wer": calculate_wer(ref["transcription"], hyp["transcription"]) if ref["transcription"] else 0.0,
+            "tag_agreement": round(jaccard(set(ref_tags), set(hyp_tags)), 4),
+            "top1_match": ref_tags[:1] == hyp_tags[:1],
+            "fp32_tags": ref_tags,
+            "int8_tags": hyp_tags,
+        })
+
+    mean_wer = sum(f["wer"] for f in files) / len(files)
+    mean_agreement = sum(f["tag_agreement"] for f in files) / len(files)
+    top1 = sum(f["top1_match"] for f in files) / len(files)
+    passed = mean_wer <= args.max_wer and mean_agreement >= args.min_tag_agreement
+
+    for f in files:
+        print(f"  {f['file'][:50]:<50} WER={f['wer']:.2f} etiquetas={f['tag_agreement']:.2f} "
+              f"{f['fp32_tags']} -> {f['int8_tags']}")
+    print(f"WER medio: {mean_wer:.3f} (máximo {args.max_wer})")
+    print(f"Coincidencia de etiquetas: {mean_agreement:.3f} (mínimo {args.min_tag_agreement}), primera etiqueta: {top1:.1%}")
+    print(f"Tiempo fp32: {fp32_seconds:.2f}s, int8: {int8_seconds:.2f}s ({fp32_seconds / int8_seconds:.2f}x)")
+    print("APROBADO" if passed else "NO APROBADO")
+
+    commit = git_commit()
+    started = datetime.datetime.now()
+    output = args.output or os.path.join(
+        HERE, "quantization_results", f"{started:%Y%m%d_%H%M%S}_{commit or 'nogit'}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump({
+            "timestamp": started.isoformat(timespec="seconds"),
+            "git_commit": commit,
+            "config": {k: v for k, v in vars(args).items() if k != "output"},
+            "mean_wer": round(mean_wer, 4),
+            "mean_tag_agreement": round(mean_agreement, 4),
+            "top1_agreement": round(top1, 4),
+            "fp32_seconds": round(fp32_seconds, 3),
+            "int8_seconds": round(int8_seconds, 3),
+            "passed": passed,
+            "files": files,
+        }, f, indent=2, ensure_ascii=False)
+    print(f"Resultados guardados en {output}")
+    sys.exit(0 if passed else 1)
+
+
+if __name__ == "__main__":
+    main()
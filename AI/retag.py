@@ -0,0 +1,91 @@
+## Volver a etiquetar todos los mensajes ya procesados con otra taxonomía.
+## Usa las transcripciones y sus embeddings guardados por mensaje
+## (message_embedding_store.py), así que no pasa ningún audio por Whisper ni por
+## el modelo de embeddings: solo se calculan los embeddings de las etiquetas que
+## aún no estén en el almacén de etiquetas y se buscan las más cercanas.
+##
+##   python retag.py --tags-file taxonomies/all_tags.txt
+
+import argparse
+import datetime
+import os
+import sys
+import time
+
+from git_info import git_commit
+from json_files import write_json_atomic
+from message_embedding_store import MessageEmbeddingStore
+from tag_embedding_store import DEFAULT_STORE_DIR, TagEmbeddingStore
+from tag_index import TagIndex
+from tagging import (DEFAULT_TAGS_FILE, SELECTION_METHODS, load_tags, load_text_model, select_tags,
+                     message_embeddings_key, text_embeddings_key, transcription_key)
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Volver a etiquetar los mensajes guardados con otra taxonomía")
+    parser.add_argument("--tags-file", default=DEFAULT_TAGS_FILE)
+    parser.add_argument("--text-model", default=os.environ.get("TAGGER_TEXT_MODEL", "paraphrase-multilingual-mpnet-base-v2"))
+    parser.add_argument("--asr-model", default=os.environ.get("TAGGER_ASR_MODEL", "openai/whisper-small"))
+    parser.add_argument("--quantize", choices=["int8"], default=os.environ.get("TAGGER_QUANTIZE") or None)
+    parser.add_argument("--text-backend", choices=["torch", "onnx"], default=os.environ.get("TAGGER_TEXT_BACKEND", "torch"))
+    parser.add_argument("--embeddings-dir", default=os.environ.get("TAGGER_EMBEDDINGS_DIR", DEFAULT_STORE_DIR),
+                        help="Almacén de embeddings de etiquetas")
+    parser.add_argument("--selection", choices=SELECTION_METHODS, default="adaptive")
+    parser.add_argument("--top-k", type=int, default=3)
+    parser.add_argument("--batch-size", type=int, default=4096, help="Mensajes por búsqueda")
+    parser.add_argument("--output", help="Ruta del JSON (por defecto retag_results/<fecha>_<commit>.json)")
+    args = parser.parse_args()
+
+    embeddings_key = text_embeddings_key(args.text_model, args.text_backend, args.quantize)
+    message_embeddings = MessageEmbeddingStore(
+        message_embeddings_key(args.text_model, args.asr_model, args.text_backend, args.quantize))
+    transcriptions = MessageEmbeddingStore(transcription_key(args.asr_model, args.quantize), kind="text")
+    message_ids, embeddings = message_embeddings.items()
+    if not message_ids:
+        sys.exit(f"No hay embeddings guardados en {message_embeddings.directory}")
+    texts = transcriptions.get(message_ids)
+
+    tags = load_tags(args.tags_file)
+    text_model = None
+
+    def embed(new_tags):
+        # El modelo solo se carga si hay etiquetas nuevas
+        nonlocal text_model
+        if text_model is None:
+            text_model = load_text_model(args.text_model, args.text_backend, args.quantize)
+        return text_model.encode(new_tags, normalize_embeddings=True)
+
+    # "Ambient_sounds" se compara como "ambient sounds", igual que en TextTagger
+    tag_store = TagEmbeddingStore(embeddings_key, args.embeddings_dir)
+    tag_embeddings = tag_store.get([tag.replace("_", " ") for tag in tags], embed)
+    tag_index = TagIndex(tags, tag_embeddings)
+
+    start = time.time()
+    messages = {}
+    for i in range(0, len(message_ids), args.batch_size):
+        indices, similarities = tag_index.search(embeddings[i:i + args.batch_size], k=args.top_k)
+        for message_id, top, sims in zip(message_ids[i:i + args.batch_size], indices, similarities):
+            transcription = texts.get(message_id, "")
+            # Sin habla no hay nada que etiquetar
+            selected = select_tags(tags, top, sims, args.selection) if transcription else []
+            messages[message_id] = {"transcription": transcription, "tags": selected}
+    print(f"{len(messages)} mensajes etiquetados con {len(tags)} etiquetas en {time.time() - start:.2f}s")
+
+    commit = git_commit()
+    started = datetime.datetime.now()
+    output = args.output or os.path.join(
+        HERE, "retag_results", f"{started:%Y%m%d_%H%M%S}_{commit or 'nogit'}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    write_json_atomic(output, {
+        "timestamp": started.isoformat(timespec="seconds"),
+        "git_commit": commit,
+        "config": {k: v for k, v in vars(args).items() if k != "output"},
+        "messages": messages,
+    })
+    print(f"Resultados guardados en {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,385 @@
+## Translation backends for http_seamless.py.
+## Models are loaded once per worker and kept resident, instead of running
+## m4t_predict / expressivity_predict as a new subprocess for every request.
+
+import os
+import threading
+import time
+
+SAMPLE_RATE = 16000 # Backends take and return 16 kHz mono s16 PCM
+EXPRESSIVE_LANGS = ["spa", "fra", "deu", "eng", "cmn", "ita"]
+
+
+class TranslationResult:
+    """Translated speech as mono s16 PCM bytes plus its sample rate."""
+
+    def __init__(self, pcm, sample_rate, text=None):
+        self.pcm = pcm
+        self.sample_rate = sample_rate
+        self.text = text
+
+    @property
+    def duration(self):
+        return len(self.pcm) / (2 * self.sample_rate)
+
+
+class TranslationBackend:
+    """
+    Base class for a speech-to-speech translation backend.
+
+    Subclasses implement `_load()` and at least one of `_translate()` and
+    `_translate_batch()`; each defaults to the other. `load()` is idempotent and
+    thread-safe, so the model is loaded only once per worker no matter how many
+    requests arrive while it is still loading. Inference calls on one backend are
+    serialised, so concurrent requests overlap parsing and ffmpeg but never run
+    two forward passes on the same model at once.
+    """
+    name = "base"
+    preload_modules = () # Heavy imports done by _load(), timed separately during warm-up
+
+    def __init__(self):
+        self._load_lock = threading.Lock()
+        self._loaded = False
+        self._inference_lock = threading.Lock()
+
+    @property
+    def loaded(self):
+        return self._loaded
+
+    @property
+    def cache_id(self):
+        """Identifies the model behind this backend in result cache keys."""
+        return self.name
+
+    def load(self):
+        if self._loaded:
+            return
+        with self._load_lock:
+            if self._loaded:
+                return
+            start = time.time()
+            self._load()
+            self._loaded = True
+            print(f"Backend '{self.name}' loaded in {time.time() - start:.2f}s")
+
+    def translate(self, pcm, tgt_lang):
+        """Translate 16 kHz mono s16 PCM bytes into `tgt_lang` speech."""
+        self.load()
+        with self._inference_lock:
+            return self._translate(pcm, tgt_lang)
+
+    def translate_batch(self, pcms, tgt_lang):
+        """Translate several PCM buffers into `tgt_lang` with one batched inference."""
+        self.load()
+        with self._inference_lock:
+            return self._translate_batch(pcms, tgt_lang)
+
+    def translate_text(self, pcm, tgt_lang):
+        """Speech-to-text translation (S2TT) of 16 kHz mono s16 PCM bytes into `tgt_lang` text."""
+        self.load()
+        with self._inference_lock:
+            return self._translate_text(pcm, tgt_lang)
+
+    def _load(self):
+        raise NotImplementedError
+
+    def _translate(self, pcm, tgt_lang):
+        return self._translate_batch([pcm], tgt_lang)[0]
+
+    def _translate_batch(self, pcms, tgt_lang):
+        return [self._translate(pcm, tgt_lang) for pcm in pcms]
+
+    def _translate_text(self, pcm, tgt_lang):
+        raise NotImplementedError(f"Backend '{self.name}' does not support speech-to-text translation")
+
+
+class _SeamlessBackend(TranslationBackend):
+    """Shared torch/device handling for the seamless_communication backends."""
+    preload_modules = ("torch", "seamless_communication.inference")
+
+    def __init__(self):
+        super().__init__()
+        self.device = None
+        self.dtype = None
+
+    def _setup_device(self):
+        import torch
+        if torch.cuda.is_available():
+            self.device = torch.device("cuda:0")
+            self.dtype = torch.float16
+        else:
+            self.device = torch.device("cpu")
+            self.dtype = torch.float32
+        print(f"Backend '{self.name}' using device {self.device}, dtype {self.dtype}")
+
+    def _waveform(self, pcm):
+        # s16 PCM -> float waveform in [-1, 1], shaped (seq_len, 1) as fairseq2 expects
+        import torch
+        waveform = torch.frombuffer(bytearray(pcm), dtype=torch.int16).to(torch.float32) / 32768.0
+        return waveform.unsqueeze(1)
+
+    @staticmethod
+    def _to_pcm(wav):
+        import torch
+        wav = wav.to(torch.float32).clamp(-1.0, 1.0).reshape(-1)
+        return (wav * 32767.0).to(torch.int16).cpu().numpy().tobytes()
+
+    @staticmethod
+    def _batch(seqs):
+        # Pad (seq_len, feat) tensors into one SequenceData batch
+        import torch
+        from torch.nn.utils.rnn import pad_sequence
+        seq_lens = torch.LongTensor([seq.shape[0] for seq in seqs]).to(seqs[0].device)
+        return {
+            "seqs": pad_sequence(seqs, batch_first=True),
+            "seq_lens": seq_lens,
+            "is_ragged": len(set(seq_lens.tolist())) > 1,
+        }
+
+    def _results(self, text_output, speech_output):
+        return [
+            TranslationResult(self._to_pcm(wav[0]), speech_output.sample_rate, text=str(text))
+            for text, wav in zip(text_output, speech_output.audio_wavs)
+        ]
+
+
+class M4TBackend(_SeamlessBackend):
+    """SeamlessM4T v2 S2ST, equivalent to `m4t_predict --task S2ST`."""
+    name = "m4t"
+
+    def __init__(self, model_name="seamlessM4T_v2_large", vocoder_name="vocoder_v2"):
+        super().__init__()
+        self.model_name = model_name
+        self.vocoder_name = vocoder_name
+        self.translator = None
+
+    @property
+    def cache_id(self):
+        return f"{self.name}:{self.model_name}:{self.vocoder_name}"
+
+    def _load(self):
+        from seamless_communication.inference import Translator
+        self._setup_device()
+        self.translator = Translator(
+            self.model_name,
+            vocoder_name_or_card=self.vocoder_name,
+            device=self.device,
+            dtype=self.dtype,
+        )
+
+    def _translate(self, pcm, tgt_lang):
+        import torch
+        with torch.inference_mode():
+            text_output, speech_output = self.translator.predict(
+                input=self._waveform(pcm),
+                task_str="S2ST",
+                tgt_lang=tgt_lang,
+                sample_rate=SAMPLE_RATE,
+            )
+        return self._results(text_output, speech_output)[0]
+
+    def _translate_text(self, pcm, tgt_lang):
+        # S2TT stops after the text decoder: no unit decoder, no vocoder
+        import torch
+        with torch.inference_mode():
+            text_output, _ = self.translator.predict(
+                input=self._waveform(pcm),
+                task_str="S2TT",
+                tgt_lang=tgt_lang,
+                sample_rate=SAMPLE_RATE,
+            )
+        return str(text_output[0])
+
+    def _translate_batch(self, pcms, tgt_lang):
+        import torch
+        with torch.inference_mode():
+            fbanks = [
+                self.translator.convert_to_fbank({
+                    "waveform": self._waveform(pcm).to(self.device),
+                    "sample_rate": SAMPLE_RATE,
+                    "format": -1,
+                })["fbank"]
+                for pcm in pcms
+            ]
+            text_output, speech_output = self.translator.predict(
+                input=self._batch(fbanks),
+                task_str="S2ST",
+                tgt_lang=tgt_lang,
+            )
+        return self._results(text_output, speech_output)
+
+
+class ExpressiveBackend(_SeamlessBackend):
+    """SeamlessExpressive S2ST with the PRETSSEL vocoder, equivalent to `expressivity_predict`."""
+    name = "expressive"
+    preload_modules = _SeamlessBackend.preload_modules + (
+        "fairseq2.data.audio", "seamless_communication.inference.pretssel_generator")
+
+    def __init__(self,
+                 model_name="seamless_expressivity",
+                 vocoder_name="vocoder_pretssel",
+                 gated_model_dir="/app/seamless_expressive_pts"):
+        super().__init__()
+        self.model_name = model_name
+        self.vocoder_name = vocoder_name
+        self.gated_model_dir = gated_model_dir
+        self.translator = None
+        self.pretssel_generator = None
+        self.fbank_extractor = None
+        self.gcmvn_mean = None
+        self.gcmvn_std = None
+
+    @property
+    def cache_id(self):
+        return f"{self.name}:{self.model_name}:{self.vocoder_name}"
+
+    def _load(self):
+        from pathlib import Path
+        import torch
+        from fairseq2.data.audio import WaveformToFbankConverter
+        from seamless_communication.inference import Translator
+        from seamless_communication.inference.pretssel_generator import PretsselGenerator
+        from seamless_communication.models.unity import load_gcmvn_stats, load_unity_unit_tokenizer
+        from seamless_communication.store import add_gated_assets
+
+        self._setup_device()
+        add_gated_assets(Path(self.gated_model_dir))
+        unit_tokenizer = load_unity_unit_tokenizer(self.model_name)
+        self.translator = Translator(
+            self.model_name,
+            vocoder_name_or_card=None,
+            device=self.device,
+            dtype=self.dtype,
+        )
+        self.pretssel_generator = PretsselGenerator(
+            self.vocoder_name,
+            vocab_info=unit_tokenizer.vocab_info,
+            device=self.device,
+            dtype=self.dtype,
+        )
+        self.fbank_extractor = WaveformToFbankConverter(
+            num_mel_bins=80,
+            waveform_scale=2**15,
+            channel_last=True,
+            standardize=False,
+            device=self.device,
+            dtype=self.dtype,
+        )
+        gcmvn_mean, gcmvn_std = load_gcmvn_stats(self.vocoder_name)
+        self.gcmvn_mean = torch.tensor(gcmvn_mean, device=self.device, dtype=self.dtype)
+        self.gcmvn_std = torch.tensor(gcmvn_std, device=self.device, dtype=self.dtype)
+
+    def _features(self, pcm):
+        # Same feature pipeline as expressivity_predict: gcmvn-normalised fbank for
+        # the prosody encoder, utterance-normalised fbank for the translator.
+        import torch
+        waveform = self._waveform(pcm).to(self.device)
+        fbank = self.fbank_extractor({"waveform": waveform, "sample_rate": SAMPLE_RATE})["fbank"]
+        gcmvn_fbank = fbank.subtract(self.gcmvn_mean).divide(self.gcmvn_std)
+        std, mean = torch.std_mean(fbank, dim=0)
+        fbank = fbank.subtract(mean).divide(std)
+        return fbank, gcmvn_fbank
+
+    def _translate_batch(self, pcms, tgt_lang):
+        import torch
+        with torch.inference_mode():
+            features = [self._features(pcm) for pcm in pcms]
+            src = self._batch([fbank for fbank, _ in features])
+            src_gcmvn = self._batch([gcmvn_fbank for _, gcmvn_fbank in features])
+            text_output, unit_output = self.translator.predict(
+                src,
+                "s2st",
+                tgt_lang,
+                prosody_encoder_input=src_gcmvn,
+            )
+            speech_output = self.pretssel_generator.predict(
+                unit_output.units,
+                tgt_lang=tgt_lang,
+                prosody_encoder_input=src_gcmvn,
+            )
+        return self._results(text_output, speech_output)
+
+
+class FakeBackend(TranslationBackend):
+    """
+    Model-free backend for tests and benchmarks on CPU-only machines.
+
+    Returns the input audio unchanged after sleeping `delay_factor` seconds per
+    second of input, so latency scales with audio length like the real models.
+    A batch costs as much as its longest item, like a padded forward pass.
+    """
+
+    def __init__(self, name="fake", delay_factor=0.0):
+        super().__init__()
+        self.name = name
+        self.delay_factor = delay_factor
+
+    def _load(self):
+        pass
+
+    def _translate_batch(self, pcms, tgt_lang):
+        if self.delay_factor > 0:
+            time.sleep(self.delay_factor * max(len(pcm) for pcm in pcms) / (2 * SAMPLE_RATE))
+        return [TranslationResult(pcm, SAMPLE_RATE, text=f"[{tgt_lang}]") for pcm in pcms]
+
+    def _translate_text(self, pcm, tgt_lang):
+        if self.delay_factor > 0:
+            # Text-only output skips speech synthesis, so it costs a fraction of S2ST
+            time.sleep(0.5 * self.delay_factor * len(pcm) / (2 * SAMPLE_RATE))
+        return f"[{tgt_lang}]"
+
+
+class BackendRouter:
+    """Routes each target language to the expressive or the M4T backend."""
+
+    def __init__(self, m4t, expressive, expressive_langs=None):
+        self.m4t = m4t
+        self.expressive = expressive
+        self.expressive_langs = expressive_langs if expressive_langs is not None else EXPRESSIVE_LANGS
+
+    @property
+    def backends(self):
+        return [self.expressive, self.m4t]
+
+    def select(self, tgt_lang):
+        return self.expressive if tgt_lang in self.expressive_langs else self.m4t
+
+    def select_text(self, tgt_lang):
+        """Backend for speech-to-text translation: M4T covers every target language."""
+        return self.m4t
+
+    def sample_lang(self, backend):
+        """A target language served by `backend`, for warm-up inferences."""
+        if backend is self.expressive and self.expressive_langs:
+            return self.expressive_langs[0]
+        return "cat"
+
+    def load(self):
+        for backend in self.backends:
+            backend.load()
+
+    def translate(self, pcm, tgt_lang):
+        return self.select(tgt_lang).translate(pcm, tgt_lang)
+
+
+def create_router():
+    """
+    Build the backend router from environment variables:
+      SEAMLESS_BACKEND: "seamless" (default) or "fake"
+      FAKE_DELAY_FACTOR: seconds of sleep per second of audio for the fake backend
+      SEAMLESS_GATED_MODEL_DIR: directory with the SeamlessExpressive checkpoints
+    """
+    kind = os.environ.get("SEAMLESS_BACKEND", "seamless")
+    if kind == "fake":
+        delay_factor = float(os.environ.get("FAKE_DELAY_FACTOR", 0.0))
+        return BackendRouter(
+            FakeBackend("fake-m4t", delay_factor),
+            FakeBackend("fake-expressive", delay_factor),
+        )
+    if kind == "seamless":
+        gated_model_dir = os.environ.get("SEAMLESS_GATED_MODEL_DIR", "/app/seamless_expressive_pts")
+        return BackendRouter(
+            M4TBackend(),
+            ExpressiveBackend(gated_model_dir=gated_model_dir),
+        )
+    raise ValueError(f"Unknown SEAMLESS_BACKEND: {kind}")
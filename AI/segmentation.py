@@ -0,0 +1,93 @@
+## Segmented translation of long recordings for http_seamless.py.
+## The 16 kHz PCM is cut at the quietest point (a pause between phrases) of
+## each window into chunks of bounded length. The chunks are translated in
+## parallel and the translated audio is stitched back together in order, so the
+## model only ever sees short inputs and finished chunks can be sent early.
+
+from collections import deque
+
+from seamless_backends import SAMPLE_RATE, TranslationResult
+
+
+def split_at_silences(pcm, sample_rate=SAMPLE_RATE, max_seconds=20.0, min_seconds=5.0,
+                      frame_ms=20, smooth_ms=200):
+    """
+    Split mono s16 PCM into chunks of at most `max_seconds`.
+
+    Each cut is placed at the lowest-energy point between `min_seconds` and
+    `max_seconds` after the previous one, with frame energies averaged over
+    `smooth_ms` so that a pause wins over a single quiet frame. Only the search
+    window is analysed at a time, so the extra memory does not grow with the
+    recording. Returns a list of (start, end) byte offsets into `pcm`.
+    """
+    import numpy as np
+
+    samples = np.frombuffer(pcm, dtype=np.int16)
+    total = len(samples)
+    max_len = int(max_seconds * sample_rate)
+    min_len = min(int(min_seconds * sample_rate), max_len)
+    frame = max(1, int(sample_rate * frame_ms / 1000))
+    smooth = max(1, smooth_ms // frame_ms)
+
+    bounds = []
+    start = 0
+    while total - start > max_len:
+        window = samples[start + min_len:start + max_len]
+        num_frames = len(window) // frame
+        if num_frames == 0:
+            cut = start + max_len
+        else:
+            frames = window[:num_frames * frame].astype(np.float32).reshape(num_frames, frame)
+            energy = (frames * frames).mean(axis=1)
+            if smooth > 1 and num_frames > smooth:
+                energy = np.convolve(energy, np.ones(smooth, dtype=np.float32) / smooth, mode="same")
+            # Cut in the middle of the quietest stretch rather than at its first frame
+            quiet = energy <= energy.min() * 1.05 + 1.0
+            lo = hi = int(np.argmin(energy))
+            while lo > 0 and quiet[lo - 1]:
+                lo -= 1
+            while hi < num_frames - 1 and quiet[hi + 1]:
+                hi += 1
+            cut = start + min_len + (lo + hi) // 2 * frame + frame // 2
+        bounds.append((2 * start, 2 * cut))
+        start = cut
+    if total > start:
+        bounds.append((2 * start, 2 * total))
+    return bounds
+
+
+def translate_segments(pcm, tgt_lang, submit, bounds, max_in_flight=4):
+    """
+    Translate the chunks of `pcm` given by `bounds` and yield their
+    TranslationResults in order.
+
+    `submit(chunk, tgt_lang)` must return a Future. At most `max_in_flight` chunks
+    are pending at once, so results that are ready but not yet consumed stay
+    bounded however long the recording is. Chunks are memoryview slices of
+    `pcm`, not copies.
+    """
+    view = memoryview(pcm)
+    pending = deque()
+    next_chunk = 0
+    try:
+        while next_chunk < len(bounds) or pending:
+            while next_chunk < len(bounds) and len(pending) < max_in_flight:
+                start, end = bounds[next_chunk]
+                pending.append(submit(view[start:end], tgt_lang))
+                next_chunk += 1
+            yield pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+def stitch(results):
+    """Join translated chunks into one TranslationResult."""
+    results = list(results)
+    if not results:
+        return TranslationResult(b"", SAMPLE_RATE, text="")
+    sample_rate = results[0].sample_rate
+    if any(result.sample_rate != sample_rate for result in results):
+        raise ValueError("Translated chunks have different sample rates")
+    text = " ".join(result.text for result in results if result.text)
+    return TranslationResult(b"".join(result.pcm for result in results), sample_rate, text=text)
@@ -0,0 +1,129 @@
+## Carga diferida de librerías pesadas y perfil de arranque de los scripts de etiquetado.
+##
+## `lazy_import("torch")` devuelve un módulo que solo se importa de verdad al
+## usar su primer atributo, así cada script paga torch, transformers,
+## sentence_transformers, sklearn, librosa o torchaudio solo si la etapa que los
+## necesita llega a ejecutarse. Cada importación y cada carga de modelo
+## (`profile_stage`) queda registrada con su duración y el momento en que terminó.
+##
+## Con STARTUP_PROFILE=1 se imprime el perfil al salir; con
+## STARTUP_PROFILE=<ruta>.json además se guarda en JSON para comparar entre versiones:
+##
+##   STARTUP_PROFILE=perfil.json python hybrid_tagger.py
+
+import atexit
+import contextlib
+import importlib
+import json
+import os
+import sys
+import threading
+import time
+import types
+
+_START = time.perf_counter()
+events = []
+_marks = set()
+_marks_lock = threading.Lock()
+_import_locks = {} # nombre -> lock, compartido por todos los LazyModule del mismo módulo
+
+
+def elapsed():
+    """Segundos desde que se importó este módulo (en la práctica, desde el arranque del script)."""
+    return time.perf_counter() - _START
+
+
+@contextlib.contextmanager
+def profile_stage(name, kind="modelo"):
+    """Registrar la duración de una etapa de arranque (importación, carga de modelo...)."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        end = time.perf_counter()
+        events.append({"kind": kind, "name": name, "seconds": round(end - start, 4),
+                       "at": round(end - _START, 4)})
+
+
+def mark(name):
+    """Registrar un hito (p. ej. "primer resultado") la primera vez que se alcanza."""
+    with _marks_lock:
+        if name in _marks:
+            return
+        _marks.add(name)
+    events.append({"kind": "hito", "name": name, "seconds": None, "at": round(elapsed(), 4)})
+
+
+class LazyModule(types.ModuleType):
+    """
+    Módulo que se importa en el primer acceso a uno de sus atributos.
+    Seguro entre hilos: si dos hilos lo usan a la vez (p. ej. las dos ramas de
+    HybridTagger), uno lo importa y el otro espera, y se registra una sola vez.
+    """
+
+    def __init__(self, name):
+        super().__init__(name)
+        self.__dict__["_lazy_module"] = None
+        self.__dict__["_lazy_lock"] = _import_locks.setdefault(name, threading.RLock())
+
+    def _load(self):
+        module = self.__dict__["_lazy_module"]
+        if module is not None:
+            return module
+        with self.__dict__["_lazy_lock"]:
+            module = self.__dict__["_lazy_module"]
+            if module is None:
+                if self.__name__ in sys.modules:
+                    # Otra librería ya lo había importado: no cuenta como coste propio
+                    module = importlib.import_module(self.__name__)
+                else:
+                    with profile_stage(self.__name__, kind="import"):
+                        module = importlib.import_module(self.__name__)
+                self.__dict__["_lazy_module"] = module
+        return module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __dir__(self):
+        return dir(self._load())
+
+
+def lazy_import(name):
+    """Devolver `name` ya importado si lo está, o un LazyModule que lo importará al usarse."""
+    return sys.modules.get(name) or LazyModule(name)
+
+
+def report(file=sys.stdout):
+    """Imprimir las etapas registradas en orden."""
+    print("\nPerfil de arranque (segundos desde el inicio del script)", file=file)
+    print(f"  {'tipo':<7} {'etapa':<50} {'duración':>9} {'acumulado':>10}", file=file)
+    for event in events:
+        seconds = f"{event['seconds']:.2f}" if event["seconds"] is not None else ""
+        print(f"  {event['kind']:<7} {event['name'][:50]:<50} {seconds:>9} {event['at']:>10.2f}", file=file)
+    imports = sum(e["seconds"] for e in events if e["kind"] == "import")
+    models = sum(e["seconds"] for e in events if e["kind"] == "modelo")
+    print(f"  Total importaciones: {imports:.2f}s, carga de modelos: {models:.2f}s", file=file)
+
+
+def save(path):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({
+            "script": os.path.basename(sys.argv[0]),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "total_seconds": round(elapsed(), 4),
+            "events": events,
+        }, f, indent=2, ensure_ascii=False)
+
+
+def _report_at_exit():
+    setting = os.environ.get("STARTUP_PROFILE", "")
+    if not setting or setting == "0":
+        return
+    report()
+    if setting.endswith(".json"):
+        save(setting)
+        print(f"  Perfil guardado en {setting}")
+
+
+atexit.register(_report_at_exit)
@@ -0,0 +1,133 @@
+## Almacén persistente de embeddings de etiquetas, compartido por los taggers
+## (CLAP, híbrido y de texto).
+## Cada modelo tiene su directorio con una matriz `embeddings.npy` (una fila por
+## etiqueta) y un `manifest.json` que asocia el hash del texto normalizado de la
+## etiqueta con su fila. El embedding se calcula con el texto original (los
+## modelos distinguen mayúsculas); la normalización solo sirve para que
+## "Ambient  sounds" y "ambient sounds" compartan fila. Si la taxonomía crece,
+## solo se calculan las etiquetas nuevas y se añaden al final. La matriz se abre
+## con memmap, así cargar miles de etiquetas no pasa por leer y copiar el fichero entero.
+
+import contextlib
+import fcntl
+import hashlib
+import json
+import os
+import re
+import time
+import unicodedata
+
+import numpy as np
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_STORE_DIR = os.environ.get("TAG_EMBEDDINGS_DIR", os.path.join(HERE, "embeddings"))
+# Versión 1: los embeddings se calculaban con el texto normalizado (en minúsculas)
+FORMAT_VERSION = 2
+
+
+def normalize_tag(tag):
+    """Texto con el que se identifica una etiqueta: NFC, minúsculas, espacios simples."""
+    tag = unicodedata.normalize("NFC", tag)
+    return re.sub(r"\s+", " ", tag).strip().lower()
+
+
+def tag_key(tag):
+    return hashlib.sha1(normalize_tag(tag).encode("utf-8")).hexdigest()[:16]
+
+
+class TagEmbeddingStore:
+    """
+    Args:
+        model_key: Identificador del modelo y su variante (p. ej. "text_paraphrase-multilingual-mpnet-base-v2_int8")
+        store_dir: Directorio raíz del almacén
+    """
+
+    def __init__(self, model_key, store_dir=DEFAULT_STORE_DIR):
+        self.model_key = model_key
+        self.directory = os.path.join(store_dir, model_key.replace("/", "_"))
+        self.matrix_path = os.path.join(self.directory, "embeddings.npy")
+        self.manifest_path = os.path.join(self.directory, "manifest.json")
+
+    def _read_manifest(self):
+        try:
+            with open(self.manifest_path, encoding="utf-8") as f:
+                manifest = json.load(f)
+        except FileNotFoundError:
+            manifest = None
+        if manifest is None or manifest.get("version") != FORMAT_VERSION:
+            # Almacén vacío o de un formato anterior: se empieza de nuevo
+            return {"model": self.model_key, "version": FORMAT_VERSION, "rows": {}, "texts": []}
+        return manifest
+
+    @contextlib.contextmanager
+    def _lock(self):
+        """Lock entre procesos (daemon, workers, notebooks) mientras se añaden etiquetas."""
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, ".lock"), "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _append(self, texts, embed):
+        """Calcular los embeddings de `texts` (aún no guardados) y añadirlos al almacén."""
+        with self._lock():
+            # Otro proceso puede haberlas añadido mientras esperábamos el lock
+            manifest = self._read_manifest()
+            texts = [text for text in texts if tag_key(text) not in manifest["rows"]]
+            if not texts:
+                return manifest
+
+            start = time.time()
+            new = np.asarray(embed(texts), dtype=np.float32)
+            if new.ndim != 2 or len(new) != len(texts):
+                raise ValueError(f"Se esperaban {len(texts)} embeddings, forma recibida {new.shape}")
+            if manifest["texts"] and os.path.exists(self.matrix_path):
+                old = np.load(self.matrix_path, mmap_mode="r")
+                if old.shape[1] != new.shape[1]:
+                    raise ValueError(f"Dimensión {new.shape[1]} distinta de la del almacén {self.directory} ({old.shape[1]})")
+                matrix = np.concatenate([old, new])
+            else:
+                matrix = new
+
+            # Primero la matriz y después el manifiesto: quien lea un manifiesto
+            # nuevo encuentra siempre una matriz con todas sus filas
+            tmp_path = f"{self.matrix_path}.{os.getpid()}.tmp.npy"
+            np.save(tmp_path, matrix)
+            os.replace(tmp_path, self.matrix_path)
+            first_row = len(manifest["texts"])
+            for offset, text in enumerate(texts):
+                manifest["rows"][tag_key(text)] = first_row + offset
+                manifest["texts"].append(text)
+            manifest["dim"] = int(matrix.shape[1])
+            manifest["updated_at"] = time.strftime("%Y-%m-%dT%H:%M:%S")
+            tmp_path = f"{self.manifest_path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(manifest, f, ensure_ascii=False)
+            os.replace(tmp_path, self.manifest_path)
+            print(f"{len(texts)} etiquetas nuevas añadidas a {self.directory} en {time.time() - start:.2f}s "
+                  f"({len(manifest['texts'])} en total)")
+            return manifest
+
+    def get(self, tags, embed):
+        """
+        Embeddings de `tags`, en el mismo orden, como matriz (n_etiquetas, dim).
+        `embed(textos)` se llama solo con las etiquetas que no estaban guardadas, con
+        su texto original y una sola vez por etiqueta normalizada.
+        """
+        manifest = self._read_manifest()
+        missing = {}
+        for tag in tags:
+            key = tag_key(tag)
+            if key not in manifest["rows"]:
+                missing.setdefault(key, tag)
+        missing = list(missing.values())
+        if missing:
+            manifest = self._append(missing, embed)
+        else:
+            print(f"Embeddings de {len(tags)} etiquetas cargados desde {self.directory}")
+        if not tags:
+            return np.zeros((0, manifest.get("dim", 0)), dtype=np.float32)
+        matrix = np.load(self.matrix_path, mmap_mode="r")
+        return matrix[[manifest["rows"][tag_key(tag)] for tag in tags]]
@@ -0,0 +1,71 @@
+## Índice de etiquetas para búsquedas top-k por similitud coseno.
+## Guarda los embeddings de las etiquetas normalizados (L2) en una sola matriz
+## contigua, una vez, y responde a un lote entero de consultas con una
+## multiplicación de matrices más argpartition, en lugar de ajustar un
+## NearestNeighbors de sklearn por cada audio.
+
+import numpy as np
+
+
+class TagIndex:
+    """
+    Args:
+        tags: Lista de etiquetas, en el mismo orden que `embeddings`
+        embeddings: Matriz (n_etiquetas, dim) de embeddings de las etiquetas
+        dtype: np.float32 o np.float16 (la mitad de memoria; se calcula en float32)
+    """
+
+    def __init__(self, tags, embeddings, dtype=np.float32):
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        if embeddings.ndim != 2 or len(embeddings) != len(tags):
+            raise ValueError(f"Se esperaban {len(tags)} embeddings, forma recibida {embeddings.shape}")
+        self.tags = list(tags)
+        self.matrix = np.ascontiguousarray(normalize(embeddings), dtype=dtype)
+
+    def __len__(self):
+        return len(self.tags)
+
+    @property
+    def dim(self):
+        return self.matrix.shape[1]
+
+    def similarities(self, queries):
+        """Similitud coseno de cada consulta (n, dim) con todas las etiquetas: (n, n_etiquetas)."""
+        queries = normalize(np.atleast_2d(np.asarray(queries, dtype=np.float32)))
+        matrix = self.matrix if self.matrix.dtype == np.float32 else self.matrix.astype(np.float32)
+        return queries @ matrix.T
+
+    def search(self, queries, k=5):
+        """
+        Las `k` etiquetas más similares para cada consulta, de mayor a menor similitud.
+        Devuelve (índices, similitudes), ambos de forma (n_consultas, k).
+        """
+        sims = self.similarities(queries)
+        k = min(k, sims.shape[1])
+        if k < sims.shape[1]:
+            # argpartition deja las k mejores al principio, sin ordenar el resto
+            top = np.argpartition(-sims, k - 1, axis=1)[:, :k]
+        else:
+            top = np.broadcast_to(np.arange(sims.shape[1]), sims.shape)
+        top_sims = np.take_along_axis(sims, top, axis=1)
+        order = np.argsort(-top_sims, axis=1)
+        return np.take_along_axis(top, order, axis=1), np.take_along_axis(top_sims, order, axis=1)
+
+    def nearest(self, query, k=5):
+        """
+        Consulta de un solo embedding con el mismo resultado que el KNN coseno de
+        sklearn: (etiquetas más cercanas, distancias coseno = 1 - similitud).
+        """
+        indices, sims = self.search(query, k)
+        return [self.tags[i] for i in indices[0]], 1 - sims[0]
+
+
+def normalize(vectors):
+    """Normalizar las filas a norma 1 (las filas nulas se quedan a cero)."""
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def as_index(tags, embeddings):
+    """Devolver `embeddings` si ya es un TagIndex, o construir uno."""
+    return embeddings if isinstance(embeddings, TagIndex) else TagIndex(tags, embeddings)
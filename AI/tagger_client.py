@@ -0,0 +1,91 @@
+## Cliente mínimo del daemon del Tagger, con la misma interfaz que Tagger/run_tagger.sh:
+##
+##   python tagger_client.py <audio_file> <output_json>
+##
+## Envía el audio al daemon (tagger_daemon.py) y escribe su resultado en
+## <output_json> de forma atómica, con el mismo contrato JSON (`transcription`,
+## `tags[].tag`). Sale con código 0 si todo fue bien y distinto de 0 si no, y en
+## ese caso deja {"error": ...} en <output_json> para el log de PHP.
+## El daemon se elige con TAGGER_URL (http://127.0.0.1:<port>) o TAGGER_SOCKET.
+
+import http.client
+import json
+import os
+import socket
+import sys
+import time
+import urllib.parse
+
+from json_files import write_json_atomic
+
+DEFAULT_SOCKET = "/tmp/blindwiki-tagger.sock"
+TIMEOUT = float(os.environ.get("TAGGER_TIMEOUT", 300)) # Igual que el set_time_limit de PHP
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path, timeout):
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+def connect():
+    url = os.environ.get("TAGGER_URL")
+    if url:
+        parts = urllib.parse.urlsplit(url)
+        return http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=TIMEOUT), url
+    path = os.environ.get("TAGGER_SOCKET", DEFAULT_SOCKET)
+    return UnixHTTPConnection(path, TIMEOUT), f"unix:{path}"
+
+
+def tag(audio_file):
+    """Pedir al daemon las etiquetas de `audio_file`. Devuelve (status HTTP, respuesta JSON)."""
+    conn, where = connect()
+    try:
+        body = json.dumps({"audio_file": audio_file}).encode("utf-8")
+        conn.request("POST", "/tag", body=body, headers={"Content-Type": "application/json"})
+        response = conn.getresponse()
+        return response.status, json.loads(response.read())
+    except (OSError, http.client.HTTPException, ValueError) as e:
+        raise ConnectionError(f"No se pudo contactar con el daemon del Tagger en {where}: {e}")
+    finally:
+        conn.close()
+
+
+def main():
+    if len(sys.argv) != 3:
+        print(f"Uso: {sys.argv[0]} <audio_file> <output_json>", file=sys.stderr)
+        return 2
+    audio_file, output_json = os.path.abspath(sys.argv[1]), sys.argv[2]
+
+    if not os.path.isfile(audio_file):
+        error = f"El archivo de audio {audio_file} no existe"
+        print(error)
+        write_json_atomic(output_json, {"error": error})
+        return 1
+
+    start = time.time()
+    try:
+        status, result = tag(audio_file)
+    except ConnectionError as e:
+        print(e)
+        write_json_atomic(output_json, {"error": str(e)})
+        return 3
+    if status != 200:
+        print(f"El daemon del Tagger respondió {status}: {result.get('error')}")
+        write_json_atomic(output_json, result)
+        return 1
+
+    write_json_atomic(output_json, result)
+    print(f"Transcripción: {result['transcription'][:80]}")
+    print(f"Etiquetas: {', '.join(t['tag'] for t in result['tags'])}")
+    print(f"Etiquetado en {time.time() - start:.2f} segundos (daemon: {result.get('processing_time')}s)")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
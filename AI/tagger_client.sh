@@ -0,0 +1,4 @@
+#!/bin/sh
+# Sustituto de run_tagger.sh: mismos argumentos (<audio_file> <output_json>),
+# pero el trabajo lo hace el daemon residente (tagger_daemon.py).
+exec python3 "$(dirname "$0")/tagger_client.py" "$@"
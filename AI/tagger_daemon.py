@@ -0,0 +1,146 @@
+## Daemon residente del Tagger.
+## Carga los modelos (Whisper y el modelo de embeddings) una sola vez y atiende
+## peticiones de etiquetado por un socket Unix (por defecto) o por HTTP en
+## localhost, en lugar de lanzar Tagger/run_tagger.sh y recargarlo todo por mensaje.
+##
+##   python tagger_daemon.py                      # socket Unix en TAGGER_SOCKET
+##   python tagger_daemon.py --port 8090          # HTTP en 127.0.0.1:8090
+##
+## Protocolo (HTTP/1.1 en ambos casos):
+##   POST /tag  {"audio_file": "/ruta/audio.amr"} -> {"transcription": ..., "tags": [{"tag": ...}, ...]}
+##              ("message_id" opcional: guarda la transcripción y su embedding, ver retag.py)
+##   GET /healthz                                 -> estado y modelos cargados
+
+import argparse
+import http.server
+import json
+import os
+import socket
+import socketserver
+import threading
+import time
+
+from tagging import create_tagger
+
+DEFAULT_SOCKET = os.environ.get("TAGGER_SOCKET", "/tmp/blindwiki-tagger.sock")
+SOCKET_MODE = int(os.environ.get("TAGGER_SOCKET_MODE", "660"), 8) # Quién puede conectarse (p. ej. www-data)
+MAX_REQUEST_BYTES = 64 * 1024
+
+tagger = None
+tagger_lock = threading.Lock() # Una inferencia a la vez: los modelos no son thread-safe
+
+
+class TaggerHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def address_string(self):
+        # Los clientes de un socket Unix no tienen dirección
+        return self.client_address[0] if self.client_address else "unix"
+
+    def send_json(self, status, data):
+        body = json.dumps(data, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == "/healthz":
+            self.send_json(200, {"status": "ok", **tagger.info()})
+        else:
+            self.send_json(404, {"error": "No encontrado"})
+
+    def do_POST(self):
+        if self.path != "/tag":
+            self.send_json(404, {"error": "No encontrado"})
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+        except ValueError:
+            length = -1
+        if not 0 < length <= MAX_REQUEST_BYTES:
+            self.close_connection = True
+            self.send_json(400, {"error": "Petición vacía o demasiado grande"})
+            return
+        try:
+            request = json.loads(self.rfile.read(length))
+            audio_file = request["audio_file"]
+            # Con message_id, la transcripción y su embedding se guardan por mensaje
+            message_id = request.get("message_id")
+        except (ValueError, KeyError, TypeError, AttributeError):
+            self.send_json(400, {"error": "Se esperaba un JSON con 'audio_file'"})
+            return
+
+        # Fallar antes de tocar los modelos si el audio no existe
+        if not os.path.isfile(audio_file):
+            self.send_json(404, {"error": f"El archivo de audio {audio_file} no existe"})
+            return
+
+        start = time.time()
+        try:
+            with tagger_lock:
+                result = tagger.tag_file(audio_file, message_id)
+        except Exception as e:
+            print(f"Error etiquetando {audio_file}: {e}")
+            self.send_json(500, {"error": f"Error etiquetando el audio: {e}"})
+            return
+        elapsed = time.time() - start
+        print(f"Etiquetado {audio_file} en {elapsed:.2f}s: {[t['tag'] for t in result['tags']]}")
+        self.send_json(200, dict(result, processing_time=round(elapsed, 3)))
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    """HTTPServer sobre un socket Unix."""
+    address_family = socket.AF_UNIX
+    daemon_threads = True
+
+    def server_bind(self):
+        # Un socket de una ejecución anterior impediría el bind
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+        socketserver.TCPServer.server_bind(self)
+        os.chmod(self.server_address, SOCKET_MODE)
+        self.server_name = "localhost"
+        self.server_port = 0
+
+    def server_close(self):
+        super().server_close()
+        try:
+            os.remove(self.server_address)
+        except OSError:
+            pass
+
+
+class LocalHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+def main():
+    global tagger
+    parser = argparse.ArgumentParser(description="Daemon residente del Tagger")
+    parser.add_argument("--socket", default=DEFAULT_SOCKET, help="Ruta del socket Unix")
+    parser.add_argument("--port", type=int, default=int(os.environ.get("TAGGER_PORT", 0)),
+                        help="Escuchar por HTTP en 127.0.0.1:<port> en lugar de un socket Unix")
+    args = parser.parse_args()
+
+    # Los modelos se cargan antes de aceptar conexiones: el primer mensaje ya no paga la carga
+    tagger = create_tagger()
+
+    if args.port:
+        server = LocalHTTPServer(("127.0.0.1", args.port), TaggerHandler)
+        where = f"http://127.0.0.1:{args.port}"
+    else:
+        server = UnixHTTPServer(args.socket, TaggerHandler)
+        where = f"unix:{args.socket}"
+    print(f"Tagger daemon escuchando en {where}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
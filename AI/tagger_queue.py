@@ -0,0 +1,240 @@
+## Cola persistente (SQLite) de trabajos de etiquetado.
+## PHP encola un trabajo al publicar un mensaje y tagger_worker.py los procesa por
+## lotes con los modelos ya cargados, así el etiquetado queda fuera de la petición.
+## Cada trabajo guarda sus intentos y el último error; los que fallan se
+## reintentan con espera creciente hasta `max_attempts` y después quedan en "failed".
+##
+##   python tagger_queue.py enqueue <message_id> <audio_file>   # -> JSON del trabajo
+##   python tagger_queue.py status <message_id>                 # último trabajo del mensaje
+##   python tagger_queue.py claim-apply <job_id>                # PHP va a aplicar el resultado
+##   python tagger_queue.py applied <job_id>                    # PHP ya lo guardó en el mensaje
+##   python tagger_queue.py release <job_id>                    # PHP no pudo guardarlo
+##   python tagger_queue.py stats
+
+import json
+import os
+import sqlite3
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_DB = os.environ.get("TAGGER_QUEUE_DB", os.path.join(HERE, "tagger_queue.sqlite"))
+MAX_ATTEMPTS = int(os.environ.get("TAGGER_MAX_ATTEMPTS", 3))
+RETRY_BACKOFF = float(os.environ.get("TAGGER_RETRY_BACKOFF", 30)) # Segundos antes del 1er reintento, luego se duplica
+LEASE_SECONDS = float(os.environ.get("TAGGER_LEASE_SECONDS", 600)) # Un trabajo "running" más antiguo se da por abandonado
+APPLY_LEASE_SECONDS = float(os.environ.get("TAGGER_APPLY_LEASE_SECONDS", 300)) # Una aplicación en curso más antigua se da por abandonada
+
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    message_id TEXT NOT NULL,
+    audio_file TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    last_error TEXT,
+    output_json TEXT,
+    worker TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    available_at REAL NOT NULL,
+    claimed_at REAL,
+    applying_at REAL,
+    applied_at REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, available_at);
+CREATE INDEX IF NOT EXISTS jobs_message ON jobs (message_id);
+"""
+
+
+class TaggerQueue:
+    """Cola de trabajos de etiquetado sobre SQLite, segura entre procesos."""
+
+    def __init__(self, db_path=DEFAULT_DB, max_attempts=MAX_ATTEMPTS,
+                 retry_backoff=RETRY_BACKOFF, lease_seconds=LEASE_SECONDS):
+        self.db_path = db_path
+        self.max_attempts = max_attempts
+        self.retry_backoff = retry_backoff
+        self.lease_seconds = lease_seconds
+        # isolation_level=None: las transacciones se abren a mano con BEGIN IMMEDIATE
+        self.conn = sqlite3.connect(db_path, timeout=30, isolation_level=None)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript(SCHEMA)
+        columns = {row["name"] for row in self.conn.execute("PRAGMA table_info(jobs)")}
+        if "applying_at" not in columns:
+            # Colas creadas antes de que PHP reservara la aplicación del resultado
+            self.conn.execute("ALTER TABLE jobs ADD COLUMN applying_at REAL")
+
+    def close(self):
+        self.conn.close()
+
+    def _transaction(self):
+        return _Transaction(self.conn)
+
+    def enqueue(self, message_id, audio_file):
+        """
+        Encolar el audio de un mensaje. Si el mensaje ya tiene un trabajo pendiente
+        o en curso, se devuelve ese en lugar de crear otro.
+        """
+        now = time.time()
+        with self._transaction():
+            row = self.conn.execute(
+                "SELECT * FROM jobs WHERE message_id = ? AND status IN (?, ?) ORDER BY id DESC LIMIT 1",
+                (str(message_id), PENDING, RUNNING)).fetchone()
+            if row is not None:
+                return dict(row)
+            cursor = self.conn.execute(
+                "INSERT INTO jobs (message_id, audio_file, created_at, updated_at, available_at) VALUES (?, ?, ?, ?, ?)",
+                (str(message_id), audio_file, now, now, now))
+            return dict(self.conn.execute("SELECT * FROM jobs WHERE id = ?", (cursor.lastrowid,)).fetchone())
+
+    def claim(self, limit, worker="worker"):
+        """
+        Reservar hasta `limit` trabajos listos para `worker`, los más antiguos primero.
+        También se recuperan los trabajos "running" cuyo worker murió (lease vencido).
+        """
+        now = time.time()
+        with self._transaction():
+            rows = self.conn.execute(
+                "SELECT * FROM jobs WHERE (status = ? AND available_at <= ?) OR (status = ? AND claimed_at < ?) "
+                "ORDER BY id LIMIT ?",
+                (PENDING, now, RUNNING, now - self.lease_seconds, limit)).fetchall()
+            claimed = []
+            for row in rows:
+                if row["status"] == RUNNING and row["attempts"] >= self.max_attempts:
+                    # Un audio que tumba al worker una y otra vez no se vuelve a intentar
+                    self.conn.execute(
+                        "UPDATE jobs SET status = ?, last_error = ?, updated_at = ? WHERE id = ?",
+                        (FAILED, f"Abandonado por {row['worker']} tras {row['attempts']} intentos", now, row["id"]))
+                    continue
+                self.conn.execute(
+                    "UPDATE jobs SET status = ?, attempts = attempts + 1, worker = ?, claimed_at = ?, updated_at = ? "
+                    "WHERE id = ?",
+                    (RUNNING, worker, now, now, row["id"]))
+                claimed.append(dict(row, status=RUNNING, attempts=row["attempts"] + 1, worker=worker))
+        return claimed
+
+    def complete(self, job_id, output_json):
+        now = time.time()
+        with self._transaction():
+            self.conn.execute(
+                "UPDATE jobs SET status = ?, output_json = ?, last_error = NULL, updated_at = ? WHERE id = ?",
+                (DONE, output_json, now, job_id))
+
+    def fail(self, job_id, error, retry=True):
+        """
+        Registrar un fallo. Se reintenta más tarde si `retry` y quedan intentos;
+        si no, el trabajo queda en "failed". Devuelve el nuevo estado.
+        """
+        now = time.time()
+        with self._transaction():
+            row = self.conn.execute("SELECT attempts FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            if row is None:
+                return None
+            attempts = row["attempts"]
+            if retry and attempts < self.max_attempts:
+                status = PENDING
+                available_at = now + self.retry_backoff * 2 ** (attempts - 1)
+            else:
+                status, available_at = FAILED, now
+            self.conn.execute(
+                "UPDATE jobs SET status = ?, last_error = ?, available_at = ?, updated_at = ? WHERE id = ?",
+                (status, str(error)[:2000], available_at, now, job_id))
+        return status
+
+    def claim_apply(self, job_id, lease_seconds=APPLY_LEASE_SECONDS):
+        """
+        Reservar la aplicación del resultado de `job_id` al mensaje. Solo una petición
+        de PHP la consigue; si esa muere sin llamar a mark_applied ni a release_apply,
+        la reserva vence a los `lease_seconds`.
+        """
+        now = time.time()
+        with self._transaction():
+            cursor = self.conn.execute(
+                "UPDATE jobs SET applying_at = ? WHERE id = ? AND status = ? AND applied_at IS NULL "
+                "AND (applying_at IS NULL OR applying_at < ?)",
+                (now, job_id, DONE, now - lease_seconds))
+        return cursor.rowcount == 1
+
+    def mark_applied(self, job_id):
+        """Marcar que PHP ya guardó el resultado en el mensaje, para no aplicarlo dos veces."""
+        with self._transaction():
+            cursor = self.conn.execute(
+                "UPDATE jobs SET applied_at = ?, applying_at = NULL WHERE id = ? AND status = ? AND applied_at IS NULL",
+                (time.time(), job_id, DONE))
+        return cursor.rowcount == 1
+
+    def release_apply(self, job_id):
+        """Soltar la reserva de claim_apply sin marcar el trabajo, para que se vuelva a intentar."""
+        with self._transaction():
+            self.conn.execute("UPDATE jobs SET applying_at = NULL WHERE id = ? AND applied_at IS NULL", (job_id,))
+
+    def latest(self, message_id):
+        row = self.conn.execute("SELECT * FROM jobs WHERE message_id = ? ORDER BY id DESC LIMIT 1",
+                                (str(message_id),)).fetchone()
+        return dict(row) if row is not None else None
+
+    def stats(self):
+        counts = {status: 0 for status in (PENDING, RUNNING, DONE, FAILED)}
+        for row in self.conn.execute("SELECT status, COUNT(*) AS n FROM jobs GROUP BY status"):
+            counts[row["status"]] = row["n"]
+        oldest = self.conn.execute("SELECT MIN(created_at) FROM jobs WHERE status = ?", (PENDING,)).fetchone()[0]
+        counts["oldest_pending_seconds"] = round(time.time() - oldest, 1) if oldest else None
+        return counts
+
+
+class _Transaction:
+    """BEGIN IMMEDIATE ... COMMIT/ROLLBACK: toma el lock de escritura al empezar."""
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        self.conn.execute("BEGIN IMMEDIATE")
+
+    def __exit__(self, exc_type, exc, tb):
+        self.conn.execute("COMMIT" if exc_type is None else "ROLLBACK")
+
+
+def main(argv):
+    usage = (f"Uso: {argv[0]} enqueue <message_id> <audio_file> | status <message_id> | "
+             f"claim-apply <job_id> | applied <job_id> | release <job_id> | stats")
+    if len(argv) < 2:
+        print(usage, file=sys.stderr)
+        return 2
+    command, args = argv[1], argv[2:]
+    queue = TaggerQueue()
+    try:
+        if command == "enqueue" and len(args) == 2:
+            message_id, audio_file = args
+            if not os.path.isfile(audio_file):
+                print(f"El archivo de audio {audio_file} no existe", file=sys.stderr)
+                return 1
+            result = queue.enqueue(message_id, os.path.abspath(audio_file))
+        elif command == "status" and len(args) == 1:
+            result = queue.latest(args[0])
+        elif command == "claim-apply" and len(args) == 1:
+            result = {"claimed": queue.claim_apply(int(args[0]))}
+        elif command == "applied" and len(args) == 1:
+            result = {"applied": queue.mark_applied(int(args[0]))}
+        elif command == "release" and len(args) == 1:
+            queue.release_apply(int(args[0]))
+            result = {"released": True}
+        elif command == "stats" and not args:
+            result = queue.stats()
+        else:
+            print(usage, file=sys.stderr)
+            return 2
+    finally:
+        queue.close()
+    print(json.dumps(result, ensure_ascii=False))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
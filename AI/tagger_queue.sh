@@ -0,0 +1,3 @@
+#!/bin/sh
+# Acceso a la cola de etiquetado desde PHP: tagger_queue.sh enqueue|status|claim-apply|applied|release|stats ...
+exec python3 "$(dirname "$0")/tagger_queue.py" "$@"
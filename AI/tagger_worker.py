@@ -0,0 +1,119 @@
+## Worker de la cola de etiquetado (tagger_queue.py).
+## Carga los modelos una vez, reserva trabajos por lotes, los etiqueta juntos
+## (Whisper y el modelo de embeddings procesan el lote entero) y escribe cada
+## resultado en <output_dir>/<message_id>_<timestamp>.json de forma atómica,
+## con el mismo contrato JSON que run_tagger.sh (`transcription`, `tags[].tag`).
+##
+##   python tagger_worker.py                  # atender la cola indefinidamente
+##   python tagger_worker.py --once           # vaciar la cola y salir
+##
+## Con TAGGER_CALLBACK_URL (p. ej. https://api.blind.wiki/message/applyTagger/{message_id})
+## se avisa a PHP de cada resultado para que lo aplique al mensaje. El secreto
+## (TAGGER_CALLBACK_SECRET) va en la cabecera X-Tagger-Secret, no en la URL, para
+## que no acabe en los logs de acceso.
+
+import argparse
+import os
+import socket
+import time
+import urllib.request
+
+from json_files import write_json_atomic
+from tagger_queue import TaggerQueue
+from tagging import create_tagger
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_OUTPUT_DIR = os.environ.get("TAGGER_OUTPUT_DIR", os.path.join(HERE, "output"))
+CALLBACK_URL = os.environ.get("TAGGER_CALLBACK_URL", "")
+CALLBACK_SECRET = os.environ.get("TAGGER_CALLBACK_SECRET", "")
+
+
+def notify(job):
+    """Avisar a PHP de que el resultado de `job` está listo. Un fallo aquí no es fatal."""
+    if not CALLBACK_URL:
+        return
+    url = CALLBACK_URL.format(message_id=job["message_id"], job_id=job["id"])
+    request = urllib.request.Request(url, data=b"", method="POST", headers={"X-Tagger-Secret": CALLBACK_SECRET})
+    try:
+        with urllib.request.urlopen(request, timeout=30) as response:
+            response.read()
+    except OSError as e:
+        print(f"No se pudo avisar del trabajo {job['id']} (mensaje {job['message_id']}): {e}")
+
+
+def finish(queue, job, result, output_dir):
+    output_json = os.path.join(output_dir, f"{job['message_id']}_{int(time.time())}.json")
+    write_json_atomic(output_json, result)
+    queue.complete(job["id"], output_json)
+    print(f"Trabajo {job['id']} (mensaje {job['message_id']}): {[t['tag'] for t in result['tags']]} -> {output_json}")
+    notify(job)
+
+
+def process_batch(tagger, queue, jobs, output_dir, batch_size):
+    """Etiquetar un lote de trabajos reservados y registrar el resultado de cada uno."""
+    ready = []
+    for job in jobs:
+        if os.path.isfile(job["audio_file"]):
+            ready.append(job)
+        else:
+            # Reintentar no va a hacer aparecer el archivo
+            queue.fail(job["id"], f"El archivo de audio {job['audio_file']} no existe", retry=False)
+            print(f"Trabajo {job['id']} (mensaje {job['message_id']}): falta {job['audio_file']}")
+    if not ready:
+        return
+
+    start = time.time()
+    try:
+        results = tagger.tag_files([job["audio_file"] for job in ready], batch_size=batch_size,
+                                   message_ids=[job["message_id"] for job in ready])
+    except Exception as e:
+        if len(ready) == 1:
+            status = queue.fail(ready[0]["id"], f"{type(e).__name__}: {e}")
+            print(f"Trabajo {ready[0]['id']} (mensaje {ready[0]['message_id']}) falló ({status}): {e}")
+            return
+        # Un audio defectuoso no debe tumbar el lote entero: se repite uno a uno
+        print(f"El lote de {len(ready)} falló ({e}), procesando uno a uno")
+        for job in ready:
+            process_batch(tagger, queue, [job], output_dir, batch_size)
+        return
+
+    for job, result in zip(ready, results):
+        try:
+            finish(queue, job, result, output_dir)
+        except OSError as e:
+            queue.fail(job["id"], f"No se pudo escribir el resultado: {e}")
+    print(f"Lote de {len(ready)} etiquetado en {time.time() - start:.2f} segundos")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Worker de la cola de etiquetado")
+    parser.add_argument("--batch-size", type=int, default=int(os.environ.get("TAGGER_BATCH_SIZE", 8)))
+    parser.add_argument("--poll-seconds", type=float, default=float(os.environ.get("TAGGER_POLL_SECONDS", 2)),
+                        help="Espera entre consultas cuando la cola está vacía")
+    parser.add_argument("--output-dir", default=DEFAULT_OUTPUT_DIR)
+    parser.add_argument("--once", action="store_true", help="Vaciar la cola y salir")
+    args = parser.parse_args()
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    worker = f"{socket.gethostname()}:{os.getpid()}"
+    queue = TaggerQueue()
+    tagger = create_tagger()
+    print(f"Worker {worker} atendiendo {queue.db_path} (lotes de {args.batch_size})")
+
+    try:
+        while True:
+            jobs = queue.claim(args.batch_size, worker)
+            if jobs:
+                process_batch(tagger, queue, jobs, args.output_dir, args.batch_size)
+            elif args.once:
+                break
+            else:
+                time.sleep(args.poll_seconds)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        queue.close()
+
+
+if __name__ == "__main__":
+    main()
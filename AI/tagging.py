@@ -0,0 +1,241 @@
+## Pipeline de etiquetado por texto compartido por el daemon y los workers del Tagger.
+## Reproduce el pipeline de Tagger/main.py (transcripción con Whisper, embedding
+## multilingüe de la transcripción y selección de las etiquetas más cercanas),
+## pero con los modelos cargados una sola vez por proceso y no una vez por mensaje.
+
+import os
+import time
+
+from message_embedding_store import MessageEmbeddingStore
+from tag_embedding_store import DEFAULT_STORE_DIR, TagEmbeddingStore
+from tag_index import TagIndex
+from waveform_cache import create_waveform_cache, to_float32
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_TAGS_FILE = os.path.join(HERE, "taxonomies", "16tags.txt")
+SELECTION_METHODS = ("adaptive", "top_k")
+
+
+def load_tags(file_path):
+    """Cargar una etiqueta por línea, ignorando líneas vacías."""
+    with open(file_path, "r", encoding="utf-8") as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def text_embeddings_key(text_model_name, text_backend="torch", quantize=None):
+    """Nombre del modelo de embeddings y su variante, para los almacenes de embeddings."""
+    key = f"text_{text_model_name}"
+    if text_backend == "onnx":
+        key += "_onnx"
+    elif quantize:
+        # Las etiquetas se comparan con embeddings del mismo modelo cuantizado
+        key += f"_{quantize}"
+    return key
+
+
+def transcription_key(asr_model_name, quantize=None):
+    return f"transcription_{asr_model_name}" + (f"_{quantize}" if quantize else "")
+
+
+def message_embeddings_key(text_model_name, asr_model_name, text_backend="torch", quantize=None):
+    """
+    Almacén de embeddings de las transcripciones: depende del modelo de embeddings y
+    también de la transcripción (modelo ASR y cuantización) de la que se calcularon.
+    """
+    return text_embeddings_key(text_model_name, text_backend, quantize) + "__" + transcription_key(asr_model_name, quantize)
+
+
+def load_text_model(text_model_name, text_backend="torch", quantize=None, device="cpu"):
+    """Modelo de embeddings de texto (SentenceTransformer, cuantizado u ONNX)."""
+    if text_backend == "onnx":
+        from onnx_backend import OnnxTextEncoder
+        return OnnxTextEncoder(text_model_name)
+    if quantize:
+        from quantization import quantized_sentence_transformer
+        return quantized_sentence_transformer(text_model_name)
+    from sentence_transformers import SentenceTransformer
+    return SentenceTransformer(text_model_name, device=device)
+
+
+def select_tags(tags, indices, similarities, selection="adaptive", min_similarity=0.2, margin=0.1):
+    """Elegir etiquetas entre las top-k (`indices`, `similarities`, de mayor a menor similitud)."""
+    selected = zip(indices, similarities)
+    if selection == "adaptive":
+        best = similarities[0]
+        selected = [(i, sim) for i, sim in selected
+                    if sim >= min_similarity and sim >= best - margin]
+    return [{"tag": tags[i], "similarity": round(float(sim), 4)} for i, sim in selected]
+
+
+class TextTagger:
+    """
+    Etiquetador de audio por transcripción.
+
+    Args:
+        tags_file: Fichero de etiquetas, una por línea
+        text_model_name: Modelo de SentenceTransformer para los embeddings
+        asr_model_name: Modelo Whisper para la transcripción
+        embeddings_dir: Directorio donde se guardan los embeddings de las etiquetas
+        selection: "adaptive" (etiquetas cercanas a la mejor) o "top_k"
+        top_k: Número máximo de etiquetas por mensaje
+        min_similarity: Similitud mínima para proponer una etiqueta ("adaptive")
+        margin: Distancia máxima a la mejor similitud ("adaptive")
+        device: 'cuda' o 'cpu'. Si es None, se autodetecta.
+        quantize: "int8" para usar los modelos cuantizados (solo CPU, ver quantization.py)
+        text_backend: "torch" u "onnx" para el modelo de embeddings (ver onnx_backend.py)
+    """
+
+    def __init__(self,
+                 tags_file=DEFAULT_TAGS_FILE,
+                 text_model_name="paraphrase-multilingual-mpnet-base-v2",
+                 asr_model_name="openai/whisper-small",
+                 embeddings_dir=DEFAULT_STORE_DIR,
+                 selection="adaptive",
+                 top_k=3,
+                 min_similarity=0.2,
+                 margin=0.1,
+                 device=None,
+                 quantize=None,
+                 text_backend="torch"):
+        import torch
+        from transformers import pipeline
+
+        if selection not in SELECTION_METHODS:
+            raise ValueError(f"Método de selección desconocido: {selection}")
+        if quantize not in (None, "int8"):
+            raise ValueError(f"Modo de cuantización desconocido: {quantize}")
+        if text_backend not in ("torch", "onnx"):
+            raise ValueError(f"Backend desconocido: {text_backend}")
+        self.device = device or ("cuda" if torch.cuda.is_available() else "cpu")
+        if quantize and self.device != "cpu":
+            print(f"La cuantización int8 solo está disponible en CPU, se ignora en {self.device}")
+            quantize = None
+        self.quantize = quantize
+        self.text_backend = text_backend
+        self.text_model_name = text_model_name
+        self.asr_model_name = asr_model_name
+        self.selection = selection
+        self.top_k = top_k
+        self.min_similarity = min_similarity
+        self.margin = margin
+
+        start = time.time()
+        print(f"Cargando modelo de embeddings: {text_model_name}...")
+        self.text_model = load_text_model(text_model_name, text_backend, quantize, self.device)
+        print(f"Cargando modelo ASR: {asr_model_name}...")
+        if quantize:
+            from quantization import quantized_asr_pipeline
+            self.asr_model = quantized_asr_pipeline(asr_model_name, chunk_length_s=30)
+        else:
+            self.asr_model = pipeline("automatic-speech-recognition",
+                                      model=asr_model_name,
+                                      chunk_length_s=30,
+                                      device=0 if self.device == "cuda" else -1)
+        print(f"Usando dispositivo: {self.device}")
+
+        self.tags_file = tags_file
+        self.tags = load_tags(tags_file)
+        print(f"Se cargaron {len(self.tags)} etiquetas desde {os.path.basename(tags_file)}")
+        self.embeddings_dir = embeddings_dir
+        # Audio decodificado compartido con los demás taggers si WAVEFORM_CACHE_DIR está definido (ver waveform_cache.py)
+        self.waveform_cache = create_waveform_cache()
+        self.tag_embeddings = self.load_or_calculate_tag_embeddings()
+        self.tag_index = TagIndex(self.tags, self.tag_embeddings)
+        # Transcripciones y embeddings por mensaje, para volver a etiquetar sin los modelos (retag.py)
+        self.transcription_store = MessageEmbeddingStore(transcription_key(asr_model_name, quantize), kind="text")
+        self.message_embeddings = MessageEmbeddingStore(
+            message_embeddings_key(text_model_name, asr_model_name, text_backend, quantize))
+        print(f"Método de selección de etiquetas: {selection}")
+        print(f"Modelos cargados en {time.time() - start:.2f} segundos")
+
+    def embeddings_key(self):
+        return text_embeddings_key(self.text_model_name, self.text_backend, self.quantize)
+
+    def load_or_calculate_tag_embeddings(self):
+        """Embeddings (normalizados) de las etiquetas, calculando solo los que no estén en el almacén."""
+        store = TagEmbeddingStore(self.embeddings_key(), self.embeddings_dir)
+        # "Ambient_sounds" se compara como "ambient sounds"
+        texts = [tag.replace("_", " ") for tag in self.tags]
+        return store.get(texts, lambda new: self.text_model.encode(new, normalize_embeddings=True))
+
+    def transcribe(self, audio_paths, batch_size=8):
+        """Transcribir una lista de audios con Whisper, por lotes."""
+        if self.waveform_cache is None:
+            inputs = list(audio_paths) # El pipeline decodifica cada fichero
+        else:
+            # Whisper trabaja a 16 kHz: el audio sale de la caché sin volver a pasar por ffmpeg
+            inputs = [{"raw": to_float32(self.waveform_cache.load_file(path, 16000)), "sampling_rate": 16000}
+                      for path in audio_paths]
+        outputs = self.asr_model(inputs, batch_size=batch_size)
+        return [output["text"].strip() for output in outputs]
+
+    def select_tags(self, indices, similarities):
+        """Elegir etiquetas entre las top-k (`indices`, `similarities`, de mayor a menor similitud)."""
+        return select_tags(self.tags, indices, similarities, self.selection, self.min_similarity, self.margin)
+
+    def tag_files(self, audio_paths, batch_size=8, message_ids=None):
+        """
+        Etiquetar una lista de audios. Devuelve, por audio, un diccionario con
+        `transcription` y `tags` (lista de {"tag", "similarity"}).
+        Con `message_ids`, la transcripción y su embedding se guardan por mensaje
+        (ver message_embedding_store.py) y no se recalculan si ya estaban.
+        """
+        if message_ids is None:
+            transcriptions = self.transcribe(audio_paths, batch_size=batch_size)
+            embeddings = self.encode(transcriptions, batch_size=batch_size)
+        else:
+            transcriptions = self.transcription_store.load_or_compute(
+                message_ids, audio_paths, lambda paths: self.transcribe(paths, batch_size=batch_size))
+            embeddings = self.message_embeddings.load_or_compute(
+                message_ids, transcriptions, lambda texts: self.encode(texts, batch_size=batch_size))
+        indices, similarities = self.tag_index.search(embeddings, k=self.top_k)
+
+        results = []
+        for transcription, top, sims in zip(transcriptions, indices, similarities):
+            # Sin habla no hay nada que etiquetar
+            tags = self.select_tags(top, sims) if transcription else []
+            results.append({"transcription": transcription, "tags": tags})
+        return results
+
+    def encode(self, texts, batch_size=8):
+        return self.text_model.encode(texts, batch_size=batch_size, normalize_embeddings=True)
+
+    def tag_file(self, audio_path, message_id=None):
+        return self.tag_files([audio_path], message_ids=None if message_id is None else [message_id])[0]
+
+    def info(self):
+        return {
+            "text_model": self.text_model_name,
+            "asr_model": self.asr_model_name,
+            "tags_file": os.path.basename(self.tags_file),
+            "num_tags": len(self.tags),
+            "selection": self.selection,
+            "device": self.device,
+            "quantize": self.quantize,
+            "text_backend": self.text_backend,
+        }
+
+
+def create_tagger():
+    """
+    Crear el TextTagger a partir de variables de entorno:
+      TAGGER_TAGS_FILE: fichero de etiquetas (por defecto taxonomies/16tags.txt)
+      TAGGER_TEXT_MODEL: modelo de embeddings (paraphrase-multilingual-mpnet-base-v2)
+      TAGGER_ASR_MODEL: modelo Whisper (openai/whisper-small)
+      TAGGER_EMBEDDINGS_DIR: caché de embeddings de etiquetas (AI/embeddings)
+      TAGGER_SELECTION: "adaptive" (por defecto) o "top_k"
+      TAGGER_TOP_K: número máximo de etiquetas (3)
+      TAGGER_QUANTIZE: "int8" para usar los modelos cuantizados en CPU (por defecto no)
+      TAGGER_TEXT_BACKEND: "torch" (por defecto) u "onnx" para el modelo de embeddings
+    El audio decodificado solo se guarda si WAVEFORM_CACHE_DIR está definido (ver waveform_cache.py).
+    """
+    return TextTagger(
+        tags_file=os.environ.get("TAGGER_TAGS_FILE", DEFAULT_TAGS_FILE),
+        text_model_name=os.environ.get("TAGGER_TEXT_MODEL", "paraphrase-multilingual-mpnet-base-v2"),
+        asr_model_name=os.environ.get("TAGGER_ASR_MODEL", "openai/whisper-small"),
+        embeddings_dir=os.environ.get("TAGGER_EMBEDDINGS_DIR", DEFAULT_STORE_DIR),
+        selection=os.environ.get("TAGGER_SELECTION", "adaptive"),
+        top_k=int(os.environ.get("TAGGER_TOP_K", 3)),
+        quantize=os.environ.get("TAGGER_QUANTIZE") or None,
+        text_backend=os.environ.get("TAGGER_TEXT_BACKEND", "torch"),
+    )
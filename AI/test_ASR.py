@@ -1,10 +1,13 @@
-import pandas as pd
 import os
 import time
-from AI.Tagger.S2TT import WhisperS2TT, SUPPORTED_MODELS
 from tqdm import tqdm
 import warnings
-import librosa
+from AI.startup_profile import lazy_import, mark, profile_stage
+
+# Las librerías pesadas se importan al usarse por primera vez (ver startup_profile.py)
+pd = lazy_import("pandas")
+librosa = lazy_import("librosa")
+S2TT = lazy_import("AI.Tagger.S2TT")
 
 # Suprimir todos los warnings
 warnings.filterwarnings("ignore")
@@ -25,7 +28,7 @@ def test_multiple_files(path_to_folder, models=None, language=None, device=None)
     """
     # Usar todos los modelos si no se especifican
     if models is None:
-        models = SUPPORTED_MODELS
+        models = S2TT.SUPPORTED_MODELS
     
     # Obtener lista de archivos de audio en la carpeta
     audio_files = [f for f in os.listdir(path_to_folder) if f.endswith('.wav')]
@@ -48,7 +51,8 @@ def test_multiple_files(path_to_folder, models=None, language=None, device=None)
     # Procesar cada modelo
     for model_name in tqdm(models, desc="Procesando modelos"):
         print(f"\nProcesando con modelo: {model_name}")
-        asr = WhisperS2TT(model_name=model_name, device=device)
+        with profile_stage(f"ASR {model_name}"):
+            asr = S2TT.WhisperS2TT(model_name=model_name, device=device)
         
         # Procesar cada archivo de audio
         for audio_file in tqdm(audio_files, desc=f"Archivos con {model_name}", leave=False):
@@ -68,6 +72,7 @@ def test_multiple_files(path_to_folder, models=None, language=None, device=None)
                 results_dict[model_name][f"RTFx_{audio_file}"] = rtf
                 
                 print(f"  - RTFx para {audio_file} con {model_name}: {rtf:.2f}")
+                mark("primer resultado")
             except Exception as e:
                 print(f"Error procesando {audio_file} con {model_name}: {str(e)}")
                 results_dict[model_name][audio_file] = f"ERROR: {str(e)}"
@@ -0,0 +1,195 @@
+## Content-addressed cache of translation results for http_seamless.py.
+## Keys hash the uploaded bytes together with tgt_lang and the model that served
+## them, so replaying a message translation skips ffmpeg and the model entirely.
+## Two tiers: an in-memory tier bounded in bytes and an optional size-capped
+## on-disk tier of WAV files that survives worker restarts.
+
+import hashlib
+import os
+import threading
+import wave
+from collections import OrderedDict
+
+from audio_pipeline import wav_header
+from seamless_backends import TranslationResult
+
+EVICTION_POLICIES = ("lru", "fifo")
+
+
+class CacheStats:
+    def __init__(self):
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.memory_evictions = 0
+        self.disk_evictions = 0
+
+    def as_dict(self):
+        return dict(vars(self))
+
+
+class TranslationCache:
+    """
+    Two-tier result cache.
+
+    Args:
+        memory_max_bytes: PCM bytes kept in memory (0 disables the memory tier)
+        disk_dir: Directory for the on-disk tier (None disables it)
+        disk_max_bytes: Size cap of the on-disk tier
+        policy: "lru" (hits refresh an entry) or "fifo" (entries expire in insertion order)
+    """
+
+    def __init__(self, memory_max_bytes, disk_dir=None, disk_max_bytes=0, policy="lru"):
+        if policy not in EVICTION_POLICIES:
+            raise ValueError(f"Unknown cache eviction policy: {policy}")
+        self.memory_max_bytes = memory_max_bytes
+        self.disk_dir = disk_dir
+        self.disk_max_bytes = disk_max_bytes
+        self.policy = policy
+        self.stats = CacheStats()
+        self._lock = threading.Lock()
+        self._memory = OrderedDict() # key -> TranslationResult
+        self._memory_bytes = 0
+        self._disk = OrderedDict() # key -> file size
+        self._disk_bytes = 0
+        if self.disk_dir:
+            os.makedirs(self.disk_dir, exist_ok=True)
+            self._index_disk()
+
+    @staticmethod
+    def make_key(audio_sha256, tgt_lang, model_id):
+        return hashlib.sha256(f"{audio_sha256}:{tgt_lang}:{model_id}".encode()).hexdigest()
+
+    def _index_disk(self):
+        # Rebuild the on-disk index oldest first, so eviction order survives restarts
+        entries = []
+        for name in os.listdir(self.disk_dir):
+            path = os.path.join(self.disk_dir, name)
+            if name.endswith(".tmp"):
+                os.remove(path) # Left over from an interrupted write
+            elif name.endswith(".wav"):
+                st = os.stat(path)
+                entries.append((st.st_mtime, name[:-4], st.st_size))
+        for _, key, size in sorted(entries):
+            self._disk[key] = size
+            self._disk_bytes += size
+        self._evict_disk()
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, f"{key}.wav")
+
+    def get(self, key):
+        """Return the cached TranslationResult for `key`, or None."""
+        with self._lock:
+            result = self._memory.get(key)
+            if result is not None:
+                if self.policy == "lru":
+                    self._memory.move_to_end(key)
+                self.stats.memory_hits += 1
+                return result
+            on_disk = key in self._disk
+            if on_disk and self.policy == "lru":
+                self._disk.move_to_end(key)
+
+        if on_disk:
+            result = self._read_disk(key)
+            if result is not None:
+                with self._lock:
+                    self.stats.disk_hits += 1
+                    self._put_memory(key, result)
+                return result
+
+        with self._lock:
+            self.stats.misses += 1
+        return None
+
+    def put(self, key, result):
+        with self._lock:
+            self._put_memory(key, result)
+            write_disk = self.disk_dir is not None and key not in self._disk
+        if write_disk:
+            self._write_disk(key, result)
+
+    def _put_memory(self, key, result):
+        size = len(result.pcm)
+        if size > self.memory_max_bytes or key in self._memory:
+            return
+        self._memory[key] = result
+        self._memory_bytes += size
+        while self._memory_bytes > self.memory_max_bytes:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_bytes -= len(evicted.pcm)
+            self.stats.memory_evictions += 1
+
+    def _read_disk(self, key):
+        try:
+            with wave.open(self._disk_path(key), "rb") as wav_in:
+                pcm = wav_in.readframes(wav_in.getnframes())
+                sample_rate = wav_in.getframerate()
+        except (OSError, wave.Error, EOFError) as e:
+            print(f"Cache entry {key} unreadable, dropping it: {e}")
+            with self._lock:
+                self._drop_disk(key)
+            return None
+        if self.policy == "lru":
+            try:
+                os.utime(self._disk_path(key)) # Keeps the eviction order across restarts
+            except OSError:
+                pass
+        return TranslationResult(pcm, sample_rate)
+
+    def _write_disk(self, key, result):
+        size = 44 + len(result.pcm)
+        if size > self.disk_max_bytes:
+            return
+        path = self._disk_path(key)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                f.write(wav_header(len(result.pcm), result.sample_rate))
+                f.write(result.pcm)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"Could not write cache entry {key}: {e}")
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            return
+        with self._lock:
+            if key not in self._disk:
+                self._disk[key] = size
+                self._disk_bytes += size
+            self._evict_disk()
+
+    def _drop_disk(self, key):
+        size = self._disk.pop(key, None)
+        if size is None:
+            return
+        self._disk_bytes -= size
+        try:
+            os.remove(self._disk_path(key))
+        except OSError:
+            pass
+
+    def _evict_disk(self):
+        while self._disk_bytes > self.disk_max_bytes and self._disk:
+            key = next(iter(self._disk))
+            self._drop_disk(key)
+            self.stats.disk_evictions += 1
+
+
+def create_cache():
+    """
+    Build the result cache from environment variables:
+      CACHE_MEMORY_BYTES: in-memory tier size (default 256 MiB, 0 disables it)
+      CACHE_DIR: directory of the on-disk tier (unset disables it)
+      CACHE_DISK_BYTES: on-disk tier size cap (default 2 GiB)
+      CACHE_POLICY: "lru" (default) or "fifo"
+    """
+    return TranslationCache(
+        memory_max_bytes=int(os.environ.get("CACHE_MEMORY_BYTES", 256 * 1024 * 1024)),
+        disk_dir=os.environ.get("CACHE_DIR") or None,
+        disk_max_bytes=int(os.environ.get("CACHE_DISK_BYTES", 2 * 1024 * 1024 * 1024)),
+        policy=os.environ.get("CACHE_POLICY", "lru"),
+    )
@@ -0,0 +1,114 @@
+## Cold-start handling for http_seamless.py.
+## The server starts listening at once so /healthz answers, while the backends
+## are loaded and each runs one synthetic inference in the background; /readyz
+## only turns green after that, so no real request pays for lazy initialization.
+## The time spent in each startup phase is logged as a breakdown.
+
+import importlib
+import math
+import threading
+import time
+from array import array
+from contextlib import contextmanager
+
+from seamless_backends import SAMPLE_RATE
+
+STARTING = "starting"
+READY = "ready"
+FAILED = "failed"
+
+
+class StartupState:
+    """Readiness of the server plus the duration of each startup phase."""
+
+    def __init__(self):
+        self.status = STARTING
+        self.error = None
+        self.started = time.perf_counter()
+        self.ready_after = None
+        self.phases = [] # (name, seconds), in order
+        self._ready = threading.Event()
+
+    @property
+    def ready(self):
+        return self._ready.is_set()
+
+    def wait(self, timeout=None):
+        return self._ready.wait(timeout)
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases.append((name, time.perf_counter() - start))
+
+    def mark_ready(self):
+        self.ready_after = time.perf_counter() - self.started
+        self.status = READY
+        self._ready.set()
+
+    def mark_failed(self, error):
+        self.error = str(error)
+        self.status = FAILED
+
+    def as_dict(self):
+        info = {"status": self.status, "phases": {name: round(seconds, 3) for name, seconds in self.phases}}
+        if self.ready_after is not None:
+            info["ready_after"] = round(self.ready_after, 3)
+        if self.error is not None:
+            info["error"] = self.error
+        return info
+
+    def summary(self):
+        total = self.ready_after if self.ready_after is not None else time.perf_counter() - self.started
+        lines = [f"Cold start {self.status} after {total:.2f}s:"]
+        for name, seconds in self.phases:
+            share = 100 * seconds / total if total > 0 else 0
+            lines.append(f"  {name:<40} {seconds:8.2f}s {share:5.1f}%")
+        if self.error is not None:
+            lines.append(f"  error: {self.error}")
+        return "\n".join(lines)
+
+
+def synthetic_pcm(seconds, sample_rate=SAMPLE_RATE):
+    """A quiet 220 Hz tone as s16 PCM, enough to run every stage of a model once."""
+    samples = int(seconds * sample_rate)
+    tone = array("h", (int(3000 * math.sin(2 * math.pi * 220 * i / sample_rate)) for i in range(samples)))
+    return tone.tobytes()
+
+
+def warm_up(router, state, inference_seconds=2.0, language_detector=None):
+    """
+    Load every backend of `router` (and `language_detector`, if any) and run one
+    synthetic inference on each (skipped when `inference_seconds` is 0), then
+    mark `state` ready. Failures are recorded in `state`, which then stays not ready.
+    """
+    try:
+        modules = []
+        for backend in router.backends:
+            modules.extend(m for m in backend.preload_modules if m not in modules)
+        if modules:
+            with state.phase("imports (" + ", ".join(modules) + ")"):
+                for module in modules:
+                    importlib.import_module(module)
+        for backend in router.backends:
+            with state.phase(f"load {backend.name}"):
+                backend.load()
+        if language_detector is not None:
+            with state.phase(f"load language detector {language_detector.name}"):
+                language_detector.load()
+        if inference_seconds > 0:
+            pcm = synthetic_pcm(inference_seconds)
+            if language_detector is not None:
+                with state.phase(f"warm-up language detection {language_detector.name}"):
+                    language_detector.detect(pcm)
+            for backend in router.backends:
+                tgt_lang = router.sample_lang(backend)
+                with state.phase(f"warm-up inference {backend.name} ({tgt_lang})"):
+                    backend.translate(pcm, tgt_lang)
+        state.mark_ready()
+    except Exception as e:
+        state.mark_failed(e)
+    print(state.summary())
@@ -0,0 +1,201 @@
+## Shared cache of decoded audio, keyed by the SHA-256 of the file and the sample rate.
+## An upload is decoded by ffmpeg once per rate (48 kHz for CLAP, 16 kHz for
+## HuBERT, Whisper and the translation server) and the mono PCM is kept as a
+## .npy file that later readers memory-map instead of decoding it again.
+## Samples are stored as int16 (exactly what ffmpeg's s16 output holds) or
+## float16; the directory is size-capped and evicts least recently used entries.
+## The cache is opt-in: without WAVEFORM_CACHE_DIR callers decode directly.
+
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from audio_pipeline import decode_to_pcm
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "blindwiki", "waveforms")
+DTYPES = ("int16", "float16")
+DISABLED = ("", "0", "off", "none")
+# Temp files older than this are left over from a crashed writer; younger ones may
+# belong to a write in progress in another process sharing the directory
+STALE_TMP_SECONDS = 3600
+
+
+def file_sha256(path, chunk_size=1024 * 1024):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def to_float32(samples):
+    """Samples from the cache as float32 in [-1, 1), the scale librosa and torchaudio use."""
+    import numpy as np
+
+    if samples.dtype == np.int16:
+        return samples.astype(np.float32) / 32768.0
+    return samples.astype(np.float32)
+
+
+def to_pcm(samples):
+    """Samples from the cache as mono s16 PCM bytes, the format of audio_pipeline.decode_to_pcm."""
+    import numpy as np
+
+    if samples.dtype != np.int16:
+        samples = np.clip(np.round(samples.astype(np.float32) * 32768.0), -32768, 32767).astype(np.int16)
+    return samples.astype("<i2", copy=False).tobytes()
+
+
+class WaveformCache:
+    """
+    Args:
+        cache_dir: Directory of the cached .npy files (shared between processes)
+        max_bytes: Size cap of the directory
+        dtype: "int16" (lossless for ffmpeg output) or "float16"
+    """
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_bytes=4 * 1024 * 1024 * 1024, dtype="int16"):
+        if dtype not in DTYPES:
+            raise ValueError(f"Unknown waveform cache dtype: {dtype}")
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.dtype = dtype
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._entries = OrderedDict() # file name -> size, least recently used first
+        self._bytes = 0
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self._index()
+
+    def _index(self):
+        # Rebuild the index oldest first, so eviction order survives restarts
+        entries = []
+        now = time.time()
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            try:
+                st = os.stat(path)
+                if name.endswith(".tmp.npy"):
+                    if now - st.st_mtime > STALE_TMP_SECONDS:
+                        os.remove(path) # Left over from an interrupted write
+                elif name.endswith(".npy"):
+                    entries.append((st.st_mtime, name, st.st_size))
+            except OSError:
+                pass # Renamed or evicted by another process meanwhile
+        for _, name, size in sorted(entries):
+            self._entries[name] = size
+            self._bytes += size
+        self._evict()
+
+    def _name(self, key, sample_rate):
+        return f"{key}_{sample_rate}_{self.dtype}.npy"
+
+    def get(self, key, sample_rate):
+        """Memory-mapped samples of `key` at `sample_rate`, or None."""
+        import numpy as np
+
+        name = self._name(key, sample_rate)
+        path = os.path.join(self.cache_dir, name)
+        try:
+            samples = np.load(path, mmap_mode="r")
+            os.utime(path) # Keeps the eviction order across processes and restarts
+        except (OSError, ValueError):
+            # Not cached, evicted by another process, or unreadable
+            with self._lock:
+                self._drop(name)
+                self.misses += 1
+            return None
+        with self._lock:
+            if name in self._entries:
+                self._entries.move_to_end(name)
+            else:
+                self._add(name, os.path.getsize(path))
+            self.hits += 1
+        return samples
+
+    def put(self, key, sample_rate, pcm):
+        """Store mono s16 PCM bytes; returns the stored samples, memory-mapped."""
+        import numpy as np
+
+        samples = np.frombuffer(pcm, dtype="<i2")
+        if self.dtype == "float16":
+            samples = (samples.astype(np.float32) / 32768.0).astype(np.float16)
+        if samples.nbytes > self.max_bytes:
+            return samples
+        name = self._name(key, sample_rate)
+        path = os.path.join(self.cache_dir, name)
+        tmp_path = f"{path[:-4]}.{os.getpid()}.{threading.get_ident()}.tmp.npy"
+        try:
+            np.save(tmp_path, samples)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"Could not write waveform cache entry {name}: {e}")
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            return samples
+        with self._lock:
+            self._add(name, os.path.getsize(path))
+        return np.load(path, mmap_mode="r")
+
+    def load(self, key, sample_rate, decode):
+        """Cached samples of `key`, or decode them with `decode()` (s16 PCM bytes) and cache them."""
+        samples = self.get(key, sample_rate)
+        if samples is None:
+            samples = self.put(key, sample_rate, decode())
+        return samples
+
+    def load_file(self, path, sample_rate):
+        """Mono samples of the audio file at `path`, resampled to `sample_rate` by ffmpeg."""
+        def decode():
+            with open(path, "rb") as f:
+                return decode_to_pcm(f.read(), sample_rate)
+
+        return self.load(file_sha256(path), sample_rate, decode)
+
+    def _add(self, name, size):
+        if name in self._entries:
+            self._bytes -= self._entries.pop(name)
+        self._entries[name] = size
+        self._bytes += size
+        self._evict()
+
+    def _drop(self, name):
+        size = self._entries.pop(name, None)
+        if size is None:
+            return
+        self._bytes -= size
+        try:
+            os.remove(os.path.join(self.cache_dir, name))
+        except OSError:
+            pass
+
+    def _evict(self):
+        # Readers that already mapped an evicted file keep their view of it
+        while self._bytes > self.max_bytes and self._entries:
+            self._drop(next(iter(self._entries)))
+            self.evictions += 1
+
+
+def create_waveform_cache(default_dir=None):
+    """
+    Build the decoded-waveform cache from environment variables:
+      WAVEFORM_CACHE_DIR: cache directory (unset: `default_dir`, None by default;
+        empty, "0", "off" or "none" disables the cache)
+      WAVEFORM_CACHE_BYTES: size cap of the directory (default 4 GiB)
+      WAVEFORM_CACHE_DTYPE: "int16" (default) or "float16"
+    Returns None when the cache is off.
+    """
+    cache_dir = os.environ.get("WAVEFORM_CACHE_DIR", default_dir)
+    if cache_dir is None or cache_dir.strip().lower() in DISABLED:
+        return None
+    return WaveformCache(
+        cache_dir=cache_dir,
+        max_bytes=int(os.environ.get("WAVEFORM_CACHE_BYTES", 4 * 1024 * 1024 * 1024)),
+        dtype=os.environ.get("WAVEFORM_CACHE_DTYPE", "int16"),
+    )
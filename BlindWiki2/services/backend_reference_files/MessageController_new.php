@@ -28,7 +28,7 @@ class MessageController extends Controller
 		//       This is not relevant in practice but only because we always assign publishing permissions globally.
 		return array(
 			array('allow',  
-				'actions'=>array('index','view','processAttachments','viewSingle', 'search', 'results', 'enableSearch', 'myComments'),
+				'actions'=>array('index','view','processAttachments','applyTagger','viewSingle', 'search', 'results', 'enableSearch', 'myComments'),
 				'users'=>array('*'),
 			),
 			array('allow', 
@@ -213,6 +213,14 @@ class MessageController extends Controller
 					if ($form->audioDataUri!=null) $dataUris[]=$form->audioDataUri;
 					$attsuccess=$message->createAttachments($uploadedfiles, isset($_REQUEST['uploadedImage'])?$_REQUEST['uploadedImage']:null, $dataUris);
 					$message->setTags($form->tags,$form->newtags);
+					if (!empty($_POST['use_tagger'])) {
+						// El etiquetado no debe impedir publicar: si la cola falla, processTagger lo reintenta
+						try {
+							$this->_enqueueTagger($message);
+						} catch (Exception $e) {
+							Yii::log("Could not queue message {$message->id} for the Tagger: " . $e->getMessage(), 'error');
+						}
+					}
 					if (Yii::app()->request->isAjaxRequest) {
 						echo json_encode(array('status'=>'OK', 'message'=>array('id'=>$message->id)));
 						Yii::app()->end();
@@ -1039,10 +1047,157 @@ class MessageController extends Controller
 		}
 	}
 
+	/**
+	 * Ejecuta el script de la cola del tagger (AI/tagger_queue.py) y devuelve su salida JSON decodificada.
+	 * @param array $args argumentos del script (p. ej. array('enqueue', $id, $audioFilePath))
+	 * @return mixed array con el trabajo, o null si no hay ninguno
+	 */
+	protected function _taggerQueue($args)
+	{
+		$script = "/srv/www/blind.wiki/public_html/Tagger/tagger_queue.sh";
+		if (!file_exists($script)) {
+			throw new CException("Tagger queue script not found: $script");
+		}
+		$cmd = $script . " " . implode(" ", array_map('escapeshellarg', $args));
+		$outputLog = array();
+		$ret = 0;
+		exec($cmd . " 2>&1", $outputLog, $ret);
+		if ($ret !== 0) {
+			throw new CException("Tagger queue command failed (code: $ret): $cmd. Output: " . implode("\n", $outputLog));
+		}
+		$result = json_decode(end($outputLog), true);
+		if (json_last_error() !== JSON_ERROR_NONE) {
+			throw new CException("Error decoding Tagger queue output: " . json_last_error_msg());
+		}
+		return $result;
+	}
+
+	/**
+	 * Encola el primer audio del mensaje en la cola del tagger.
+	 * Los workers (AI/tagger_worker.py) lo etiquetan fuera de la petición.
+	 * @return mixed el trabajo encolado, o null si el mensaje no tiene audio
+	 */
+	protected function _enqueueTagger($message)
+	{
+		foreach ($message->attachments as $attachment) {
+			if ($attachment->type == Attachment::TYPE_AUDIO) {
+				$audioFilePath = Yii::getPathOfAlias('webroot.uploads') . "/" . $attachment->local_filename;
+				if (!file_exists($audioFilePath)) {
+					Yii::log("Audio file not found: $audioFilePath", 'error');
+					continue;
+				}
+				$job = $this->_taggerQueue(array('enqueue', $message->id, $audioFilePath));
+				Yii::log("Tagger job {$job['id']} queued for message {$message->id}: $audioFilePath", 'info');
+				return $job;
+			}
+		}
+		return null;
+	}
+
+	/**
+	 * Aplica al mensaje el JSON de salida del tagger (transcripción y tags).
+	 * Cada resultado se aplica una sola vez: se reserva en la cola antes de tocar el
+	 * mensaje, se marca como aplicado después de guardarlo y, si algo falla, se suelta
+	 * la reserva para que la siguiente llamada lo vuelva a intentar.
+	 */
+	protected function _applyTaggerResult($message, $job)
+	{
+		$id = $message->id;
+		$outputJsonPath = $job['output_json'];
+
+		// Procesar el archivo JSON de salida
+		Yii::log("Processing Tagger output JSON file: $outputJsonPath", 'info');
+		if (!file_exists($outputJsonPath)) {
+			Yii::log("Tagger output JSON file not found for finished job {$job['id']}: $outputJsonPath", 'error');
+			throw new CException("Tagger output JSON file not found: $outputJsonPath.");
+		}
+
+		$jsonContent = file_get_contents($outputJsonPath);
+		if ($jsonContent === false) {
+			Yii::log("Could not read Tagger output JSON file: $outputJsonPath", 'error');
+			throw new CException("Could not read Tagger output JSON file: $outputJsonPath");
+		}
+
+		$taggerResult = json_decode($jsonContent, true); // true for associative array
+		if (json_last_error() !== JSON_ERROR_NONE) {
+			Yii::log("Error decoding Tagger output JSON: " . json_last_error_msg() . ". File: $outputJsonPath. Content: " . substr($jsonContent, 0, 500), 'error');
+			throw new CException("Error decoding Tagger output JSON: " . json_last_error_msg());
+		}
+
+		// Extraer información del resultado decodificado
+		$transcription = isset($taggerResult['transcription']) ? $taggerResult['transcription'] : '';
+		$newTags = array();
+		if (isset($taggerResult['tags']) && is_array($taggerResult['tags'])) {
+			foreach ($taggerResult['tags'] as $tagInfo) {
+				if (isset($tagInfo['tag']) && !empty($tagInfo['tag'])) {
+					$newTags[] = $tagInfo['tag'];
+				}
+			}
+		}
+
+		Yii::log("Extraction from JSON completed. Transcription (first 50 chars): " . substr($transcription, 0, 50) . "... Number of Tags: " . count($newTags), 'info');
+
+		// Reservar antes de guardar: si dos peticiones llegan a la vez, solo una aplica el resultado
+		$claim = $this->_taggerQueue(array('claim-apply', $job['id']));
+		if (empty($claim['claimed'])) {
+			Yii::log("Tagger job {$job['id']} is already being applied, or was applied, to message $id.", 'info');
+			return;
+		}
+
+		try {
+			$this->_saveTaggerResult($message, $transcription, $newTags);
+		} catch (Exception $e) {
+			// Sin guardar no se marca: se suelta la reserva para no perder el resultado
+			try {
+				$this->_taggerQueue(array('release', $job['id']));
+			} catch (Exception $releaseError) {
+				Yii::log("Could not release Tagger job {$job['id']}: " . $releaseError->getMessage(), 'error');
+			}
+			throw $e;
+		}
+		$this->_taggerQueue(array('applied', $job['id']));
+	}
+
+	/**
+	 * Guarda en el mensaje la transcripción (si no tenía texto) y los tags nuevos del tagger.
+	 * Lanza CException si el mensaje no se puede guardar.
+	 */
+	protected function _saveTaggerResult($message, $transcription, $newTags)
+	{
+		$id = $message->id;
+
+		// Actualizar mensaje
+		$updateText = empty($message->text) && !empty($transcription);
+		if ($updateText) {
+			$message->text = $transcription;
+			Yii::log("Message text will be updated with transcription.", 'info');
+		}
+
+		// Añadir nuevos tags sin eliminar los existentes
+		if (!empty($newTags)) {
+			Yii::log("Adding tags to message: " . implode(", ", $newTags), 'info');
+			$message->setNewTags($newTags, true); // true para mantener tags existentes
+			$message->updateTagSummaries('add');
+		}
+
+		if ($updateText || !empty($newTags)) {
+			if ($message->save(false)) {
+				Yii::log("Message (ID: $id) saved successfully with new transcription/tags.", 'info');
+			} else {
+				Yii::log("Failed to save message (ID: $id) with new transcription/tags.", 'error');
+				throw new CException("Failed to save message after processing with Tagger.");
+			}
+		} else {
+			Yii::log("No changes to message text or tags from Tagger output for message ID: $id.", 'info');
+		}
+	}
+
 	/**
 	 * Endpoint para procesar un mensaje con el tagger.
-	 * Este endpoint es asíncrono y permite al frontend decidir cuándo ejecutar el tagger.
-	 * 
+	 * El etiquetado se hace en la cola (AI/tagger_worker.py), no en esta petición:
+	 * si el resultado ya está listo se aplica al mensaje; si no, se encola (si hacía falta)
+	 * y se responde enseguida. El worker avisa a actionApplyTagger cuando termina.
+	 *
 	 * @param integer $id ID del mensaje a procesar
 	 */
 	public function actionProcessTagger($id)
@@ -1058,190 +1213,76 @@ class MessageController extends Controller
 			throw new CHttpException(403, 'No tienes permiso para procesar este mensaje');
 		}
 
-		// Buscar adjuntos de audio
-		$audioFound = false;
-		foreach ($message->attachments as $attachment) {
-			if ($attachment->type == Attachment::TYPE_AUDIO) {
-				try {
-					$audioFilePath = Yii::getPathOfAlias('webroot.uploads') . "/" . $attachment->local_filename;
-					Yii::log("Procesando audio: " . $audioFilePath, 'info');
-					
-					// Verificar que el archivo existe
-					if (!file_exists($audioFilePath)) {
-						Yii::log("Audio file not found: $audioFilePath", 'error');
-						continue;
-					}
-					
-					// Preparar el script tagger
-					$script = "/srv/www/blind.wiki/public_html/Tagger/run_tagger.sh";
-					if (!file_exists($script)) {
-						throw new CException("Tagger script not found: $script");
-					}
-					
-					// Verificar permisos del script
-					$permissions = fileperms($script);
-					$isExecutable = ($permissions & 0x0040) || ($permissions & 0x0008) || ($permissions & 0x0001); // Checks execute permission for owner, group, or others
-					Yii::log("Tagger script permissions: " . decoct($permissions) . ", executable: " . ($isExecutable ? 'yes' : 'no'), 'info');
-					if (!$isExecutable) {
-						throw new CException("Tagger script is not executable: $script. Permissions: " . decoct($permissions));
-					}
-					
-					// Definir la ruta para el archivo JSON de salida del tagger
-					// Path: webroot/Tagger/output/message_id_timestamp.json
-					$outputJsonDir = Yii::getPathOfAlias('webroot') . "/Tagger/output";
-					if (!is_dir($outputJsonDir)) {
-						if (!mkdir($outputJsonDir, 0777, true)) {
-							throw new CException("Failed to create Tagger output directory: $outputJsonDir");
-						}
-						Yii::log("Created Tagger output directory: $outputJsonDir", 'info');
-					}
-					if (!is_writable($outputJsonDir)) {
-						throw new CException("Tagger output directory is not writable: $outputJsonDir");
-					}
-
-					$timestamp = time();
-					$outputJsonFileName = "{$id}_{$timestamp}.json";
-					$outputJsonPath = $outputJsonDir . "/" . $outputJsonFileName;
-
-					// Preparar y ejecutar el comando
-					$scriptAudioFileArgument = escapeshellarg($audioFilePath);
-					$scriptJsonOutputArgument = escapeshellarg($outputJsonPath); // Second argument for the shell script
-					$cmd = "$script $scriptAudioFileArgument $scriptJsonOutputArgument";
-					Yii::log("Executing Tagger command: $cmd", 'info');
-					
-					// Configurar timeout
-					$defaultTimeout = ini_get('max_execution_time');
-					set_time_limit(300); // 5 minutos
-					
-					// Ejecutar el comando
-					$startTime = microtime(true);
-					$outputLog = array(); // Will store stdout/stderr from the script (for logging)
-					$ret = 0; // Exit code
-					exec($cmd." 2>&1", $outputLog, $ret); // Capture stdout and stderr
-					$endTime = microtime(true);
-					$executionTime = round($endTime - $startTime, 2);
-					
-					// Restaurar timeout
-					set_time_limit($defaultTimeout);
-					
-					// Log stdout/stderr from the Tagger script
-					Yii::log("Tagger execution completed in {$executionTime} seconds with exit code: $ret", $ret === 0 ? 'info' : 'error');
-					Yii::log("Tagger script output (logs) START", 'info');
-					foreach ($outputLog as $index => $line) {
-						Yii::log("Tagger log line " . ($index + 1) . ": " . $line, 'info');
-					}
-					Yii::log("Tagger script output (logs) END", 'info');
-					
-					if ($ret !== 0) {
-						// Even if the script failed, the JSON might contain error details from Python
-						$errorContext = "Error executing Tagger (code: $ret).";
-						if (file_exists($outputJsonPath)) {
-							$jsonContent = file_get_contents($outputJsonPath);
-							$errorContext .= " Partial/Error JSON content: " . $jsonContent;
-						} else {
-							$errorContext .= " Output JSON file not found at $outputJsonPath.";
-						}
-						Yii::log($errorContext, 'error');
-						throw new CException("Error executing Tagger (code: $ret). Check application logs for details and Tagger script output.");
-					}
-					
-					// Procesar el archivo JSON de salida
-					Yii::log("Processing Tagger output JSON file: $outputJsonPath", 'info');
-					if (!file_exists($outputJsonPath)) {
-						Yii::log("Tagger output JSON file not found after successful script execution: $outputJsonPath", 'error');
-						throw new CException("Tagger output JSON file not found: $outputJsonPath. Script executed successfully but file is missing.");
-					}
-					
-					$jsonContent = file_get_contents($outputJsonPath);
-					if ($jsonContent === false) {
-						Yii::log("Could not read Tagger output JSON file: $outputJsonPath", 'error');
-						throw new CException("Could not read Tagger output JSON file: $outputJsonPath");
-					}
-					
-					$taggerResult = json_decode($jsonContent, true); // true for associative array
-					if (json_last_error() !== JSON_ERROR_NONE) {
-						Yii::log("Error decoding Tagger output JSON: " . json_last_error_msg() . ". File: $outputJsonPath. Content: " . substr($jsonContent, 0, 500), 'error');
-						throw new CException("Error decoding Tagger output JSON: " . json_last_error_msg());
-					}
-					
-					// Extraer información del resultado decodificado
-					$transcription = isset($taggerResult['transcription']) ? $taggerResult['transcription'] : '';
-					$newTags = array();
-					if (isset($taggerResult['tags']) && is_array($taggerResult['tags'])) {
-						foreach ($taggerResult['tags'] as $tagInfo) {
-							if (isset($tagInfo['tag']) && !empty($tagInfo['tag'])) {
-								$newTags[] = $tagInfo['tag'];
-							}
-						}
-					}
-					
-					Yii::log("Extraction from JSON completed. Transcription (first 50 chars): " . substr($transcription, 0, 50) . "... Number of Tags: " . count($newTags), 'info');
-					
-					// Actualizar mensaje
-					if (empty($message->text) && !empty($transcription)) {
-						$message->text = $transcription;
-						// $message->save(false); // Consider if save should be conditional or grouped
-						Yii::log("Message text will be updated with transcription.", 'info');
-					}
-					
-					// Añadir nuevos tags sin eliminar los existentes
-					if (!empty($newTags)) {
-						Yii::log("Adding tags to message: " . implode(", ", $newTags), 'info');
-						$message->setNewTags($newTags, true); // true para mantener tags existentes
-						$message->updateTagSummaries('add');
-					}
-
-					if ((empty($message->text) && !empty($transcription)) || !empty($newTags)) {
-						if ($message->save(false)) {
-							Yii::log("Message (ID: $id) saved successfully with new transcription/tags.", 'info');
-						} else {
-							Yii::log("Failed to save message (ID: $id) with new transcription/tags.", 'error');
-							throw new CException("Failed to save message after processing with Tagger.");
-						}
-					} else {
-						Yii::log("No changes to message text or tags from Tagger output for message ID: $id.", 'info');
-					}
-					
-					$audioFound = true;
-
-					// Opcional: Eliminar el archivo JSON después de procesarlo si no se necesita para depuración prolongada
-					// if (file_exists($outputJsonPath)) {
-					//     unlink($outputJsonPath);
-					//     Yii::log("Cleaned up Tagger output JSON file: $outputJsonPath", 'info');
-					// }
-					break; // Solo procesar el primer audio encontrado
-					
-				} catch (Exception $e) {
-					Yii::log("Error procesando audio: " . $e->getMessage() . "\n" . $e->getTraceAsString(), 'error');
+		try {
+			$job = $this->_taggerQueue(array('status', $id));
+			if ($job && $job['status'] == 'done') {
+				if (empty($job['applied_at'])) {
+					$this->_applyTaggerResult($message, $job);
+				}
+			}
+			else if (!$job || $job['status'] == 'failed') {
+				if ($job) {
+					Yii::log("Previous Tagger job {$job['id']} for message $id failed: {$job['last_error']}. Queuing again.", 'warning');
+				}
+				$job = $this->_enqueueTagger($message);
+				if (!$job) {
 					if (Yii::app()->request->isApiRequest) {
 						echo Yii::app()->api->errorResponse(array(
-							'error' => 'Error procesando audio',
-							'details' => $e->getMessage()
+							'error' => 'No se encontraron archivos de audio en el mensaje'
 						));
 						Yii::app()->end();
 					}
-					throw $e;
+					throw new CHttpException(400, 'No se encontraron archivos de audio en el mensaje');
 				}
 			}
-		}
-		
-		if (!$audioFound) {
+			else {
+				Yii::log("Tagger job {$job['id']} for message $id is {$job['status']} (attempts: {$job['attempts']}).", 'info');
+			}
+		} catch (CException $e) {
+			if ($e instanceof CHttpException) throw $e;
+			Yii::log("Error procesando audio: " . $e->getMessage() . "\n" . $e->getTraceAsString(), 'error');
 			if (Yii::app()->request->isApiRequest) {
 				echo Yii::app()->api->errorResponse(array(
-					'error' => 'No se encontraron archivos de audio en el mensaje'
+					'error' => 'Error procesando audio',
+					'details' => $e->getMessage()
 				));
 				Yii::app()->end();
 			}
-			throw new CHttpException(400, 'No se encontraron archivos de audio en el mensaje');
+			throw $e;
 		}
 
 		// Refrescar el mensaje para obtener los cambios
 		$message->refresh();
-		
+
 		if (Yii::app()->request->isApiRequest) {
 			echo Yii::app()->api->okResponse($message);
 		} else {
 			$this->redirect(array('message/viewSingle', 'id' => $message->id));
 		}
 	}
+
+	/**
+	 * Llamado por el worker del tagger (TAGGER_CALLBACK_URL) cuando el resultado de un mensaje está listo.
+	 * El secreto llega en la cabecera X-Tagger-Secret (o en el cuerpo del POST), nunca en la URL.
+	 */
+	public function actionApplyTagger($id) {
+		if (isset($_SERVER['HTTP_X_TAGGER_SECRET'])) {
+			$secret = $_SERVER['HTTP_X_TAGGER_SECRET'];
+		} else {
+			$secret = Yii::app()->request->getPost('secret', '');
+		}
+		$expected = (string)Yii::app()->params['adminPassword'];
+		if ($expected === '' || !is_string($secret) || !hash_equals($expected, $secret)) {
+			throw new CHttpException(403,'Unauthorized');
+		}
+		$message = Message::model()->findByPk($id);
+		if (!$message) {
+			throw new CHttpException(404, 'Mensaje no encontrado');
+		}
+		$job = $this->_taggerQueue(array('status', $id));
+		if ($job && $job['status'] == 'done' && empty($job['applied_at'])) {
+			$this->_applyTaggerResult($message, $job);
+		}
+		echo "done";
+	}
 }
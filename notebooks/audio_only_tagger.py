@@ -1,19 +1,30 @@
-import pandas as pd
 import numpy as np
 import os
-import torch
-from transformers import Wav2Vec2Model, HubertModel
-from sklearn.neighbors import NearestNeighbors
-import torchaudio
-from sentence_transformers import SentenceTransformer
-from sklearn.decomposition import PCA
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "AI"))
+from audio_prefetch import DEFAULT_WORKERS, embed_files
+from message_embedding_store import MessageEmbeddingStore
+from startup_profile import lazy_import, mark, profile_stage
+from tag_index import TagIndex, as_index
+from waveform_cache import create_waveform_cache, to_float32
+
+# Las librerías pesadas se importan al usarse por primera vez (ver AI/startup_profile.py)
+pd = lazy_import("pandas")
+torch = lazy_import("torch")
+torchaudio = lazy_import("torchaudio")
+transformers = lazy_import("transformers")
+sentence_transformers = lazy_import("sentence_transformers")
+decomposition = lazy_import("sklearn.decomposition")
+onnx_backend = lazy_import("onnx_backend")
 
 class AudioOnlyTagger:
     def __init__(self, 
                  audio_model_name="facebook/hubert-large-ll60k", 
                  use_pca=True,
                  embedding_dim=768,
-                 device=None):
+                 device=None,
+                 backend="torch"):
         """
         Inicializador del tagger basado solo en audio
         
@@ -22,7 +33,12 @@ class AudioOnlyTagger:
             use_pca: Si se debe usar PCA para reducir dimensiones de embeddings
             embedding_dim: Dimensión objetivo para reducción PCA
             device: Dispositivo (cuda o cpu)
+            backend: "torch" o "onnx" (ONNX Runtime en CPU, ver AI/onnx_backend.py)
         """
+        if backend not in ("torch", "onnx"):
+            raise ValueError(f"Backend desconocido: {backend}")
+        self.backend = backend
+        
         # Configurar dispositivo
         if device is None:
             self.device = "cuda" if torch.cuda.is_available() else "cpu"
@@ -33,20 +49,32 @@ class AudioOnlyTagger:
         
         # Cargar modelo de audio
         print(f"Cargando modelo de audio {audio_model_name}...")
-        if "hubert" in audio_model_name.lower():
-            self.audio_model = HubertModel.from_pretrained(audio_model_name).to(self.device)
-        else:
-            self.audio_model = Wav2Vec2Model.from_pretrained(audio_model_name).to(self.device)
+        with profile_stage(f"audio {audio_model_name}"):
+            if backend == "onnx":
+                self.audio_model = onnx_backend.OnnxAudioEncoder(audio_model_name)
+            elif "hubert" in audio_model_name.lower():
+                self.audio_model = transformers.HubertModel.from_pretrained(audio_model_name).to(self.device)
+            else:
+                self.audio_model = transformers.Wav2Vec2Model.from_pretrained(audio_model_name).to(self.device)
         
         # Configuración de reducción de dimensionalidad
         self.use_pca = use_pca
         self.embedding_dim = embedding_dim
         self.pca = None
+        # Audio decodificado compartido con los demás taggers si WAVEFORM_CACHE_DIR está definido (ver AI/waveform_cache.py)
+        self.waveform_cache = create_waveform_cache()
+        # Embeddings de audio (media temporal) por mensaje, para volver a etiquetar sin el modelo
+        self.audio_store = MessageEmbeddingStore(f"audio_{audio_model_name}" + ("_onnx" if backend == "onnx" else ""))
         
         print("Inicialización completada")
     
-    def load_audio(self, audio_path, target_sr=16000):
-        """Cargar archivo de audio y prepararlo para el modelo"""
+    def decode_audio(self, audio_path, target_sr=16000):
+        """Cargar audio mono remuestreado, en CPU (se llama desde los hilos de AI/audio_prefetch.py)"""
+        if self.waveform_cache is not None:
+            # Se decodifica una sola vez por audio y frecuencia, ver AI/waveform_cache.py
+            samples = to_float32(self.waveform_cache.load_file(audio_path, target_sr))
+            return torch.from_numpy(samples).unsqueeze(0)
+        
         # Cargar audio
         waveform, sample_rate = torchaudio.load(audio_path)
         
@@ -59,20 +87,44 @@ class AudioOnlyTagger:
             resampler = torchaudio.transforms.Resample(sample_rate, target_sr)
             waveform = resampler(waveform)
         
-        return waveform.to(self.device)
+        return waveform
+    
+    def load_audio(self, audio_path, target_sr=16000):
+        """Cargar archivo de audio y prepararlo para el modelo"""
+        return self.decode_audio(audio_path, target_sr).to(self.device)
+    
+    def get_audio_embeddings(self, waveforms):
+        """Embeddings de un lote de audios de la misma longitud, con forma (1, muestras) cada uno"""
+        if self.backend == "onnx":
+            return self.audio_model.encode(np.concatenate([w.cpu().numpy() for w in waveforms]))
+        
+        with torch.no_grad():
+            outputs = self.audio_model(torch.cat(list(waveforms)).to(self.device))
+            # Promedio en la dimensión temporal para obtener un vector único
+            return torch.mean(outputs.last_hidden_state, dim=1).cpu().numpy()
+    
+    def embed_audio_files(self, audio_paths, batch_size=1, workers=DEFAULT_WORKERS, message_ids=None):
+        """
+        Embeddings de `audio_paths`, decodificando los siguientes audios en paralelo
+        mientras el modelo procesa los actuales. Devuelve (ruta, embedding o None)
+        según se calculan.
+        Por defecto cada audio va solo al modelo: rellenar cambiaría la media temporal
+        del embedding, y dos grabaciones casi nunca tienen el mismo número de muestras,
+        así que agrupar por longitud solo retendría audios ya decodificados. Con
+        `batch_size` > 1 se agrupan los que sí tengan la misma longitud.
+        Con `message_ids`, los embeddings se guardan por mensaje y los ya guardados
+        no se recalculan (ver AI/message_embedding_store.py).
+        """
+        compute = lambda paths: embed_files(paths, self.decode_audio, self.get_audio_embeddings, batch_size=batch_size,
+                                            length=lambda waveform: waveform.shape[-1], workers=workers)
+        if message_ids is None:
+            return compute(audio_paths)
+        return self.audio_store.load_or_compute_stream(message_ids, audio_paths, compute)
     
     def get_audio_embedding(self, audio_path):
         """Obtener embedding directamente desde el audio"""
         try:
-            waveform = self.load_audio(audio_path)
-            
-            # Obtener embedding
-            with torch.no_grad():
-                outputs = self.audio_model(waveform)
-                # Promedio en la dimensión temporal para obtener un vector único
-                embedding = torch.mean(outputs.last_hidden_state, dim=1).squeeze().cpu().numpy()
-            
-            return embedding
+            return self.get_audio_embeddings([self.decode_audio(audio_path)])[0]
         except Exception as e:
             print(f"Error al procesar {audio_path}: {e}")
             return None
@@ -106,7 +158,11 @@ class AudioOnlyTagger:
         
         # Primero obtenemos embeddings textuales para las etiquetas
         # (Usamos un modelo de texto solo para esta proyección inicial)
-        text_model = SentenceTransformer('paraphrase-multilingual-mpnet-base-v2')
+        with profile_stage("texto paraphrase-multilingual-mpnet-base-v2"):
+            if self.backend == "onnx":
+                text_model = onnx_backend.OnnxTextEncoder('paraphrase-multilingual-mpnet-base-v2')
+            else:
+                text_model = sentence_transformers.SentenceTransformer('paraphrase-multilingual-mpnet-base-v2')
         tag_text_embeddings = text_model.encode(tags)
         
         # Si tenemos suficientes muestras de audio, entrenamos un PCA 
@@ -117,7 +173,7 @@ class AudioOnlyTagger:
             target_dim = min(self.embedding_dim, sample_audio_embeddings[0].shape[0], tag_text_embeddings.shape[1])
             
             # Entrenar PCA en los embeddings de audio
-            self.pca = PCA(n_components=target_dim)
+            self.pca = decomposition.PCA(n_components=target_dim)
             audio_embeddings_pca = self.pca.fit_transform(np.vstack(sample_audio_embeddings))
             
             # Aplicar la misma transformación a los embeddings de texto
@@ -132,22 +188,15 @@ class AudioOnlyTagger:
             return truncated_tag_embeddings
     
     def find_knn_tags(self, tag_embeddings, audio_embedding, tags, k=5):
-        """Encontrar etiquetas más cercanas usando KNN"""
-        # Crear modelo KNN
-        knn = NearestNeighbors(n_neighbors=min(k, len(tags)), metric='cosine')
-        knn.fit(tag_embeddings)
-        
+        """
+        Encontrar las etiquetas más cercanas (distancia coseno).
+        `tag_embeddings` puede ser un TagIndex ya construido, para no rehacerlo en cada audio.
+        """
         # Si usamos PCA, transformar el embedding de audio
         if self.pca is not None:
             audio_embedding = self.pca.transform(audio_embedding.reshape(1, -1))
         
-        # Encontrar los k vecinos más cercanos
-        distances, indices = knn.kneighbors(audio_embedding.reshape(1, -1))
-        
-        # Obtener las etiquetas correspondientes
-        nearest_tags = [tags[idx] for idx in indices[0]]
-        
-        return nearest_tags, distances[0]
+        return as_index(tags, tag_embeddings).nearest(audio_embedding, k)
 
 def process_audio_files(audio_dir, tags_file, output_file, num_samples=50):
     """
@@ -177,32 +226,34 @@ def process_audio_files(audio_dir, tags_file, output_file, num_samples=50):
     sample_audio_embeddings = []
     sample_files = np.random.choice(audio_files, min(num_samples, len(audio_files)), replace=False)
     
-    for file_name in sample_files:
-        audio_path = os.path.join(audio_dir, file_name)
-        embedding = tagger.get_audio_embedding(audio_path)
+    sample_paths = [os.path.join(audio_dir, file_name) for file_name in sample_files]
+    sample_ids = [os.path.splitext(file_name)[0] for file_name in sample_files]
+    for audio_path, embedding in tagger.embed_audio_files(sample_paths, message_ids=sample_ids):
         if embedding is not None:
             sample_audio_embeddings.append(embedding)
     
     # Proyectar etiquetas al espacio de embeddings de audio
     tag_embeddings = tagger.project_tags_to_audio_space(tags, sample_audio_embeddings)
+    # Índice normalizado, construido una vez para todos los audios
+    tag_index = TagIndex(tags, tag_embeddings)
     
     # Procesar cada archivo
     results = []
-    for idx, file_name in enumerate(audio_files):
+    # Los audios se decodifican en paralelo mientras el modelo calcula los embeddings
+    audio_paths = [os.path.join(audio_dir, file_name) for file_name in audio_files]
+    # El nombre del fichero (sin extensión) identifica al mensaje en el almacén de embeddings
+    message_ids = [os.path.splitext(file_name)[0] for file_name in audio_files]
+    for idx, (audio_path, audio_embedding) in enumerate(tagger.embed_audio_files(audio_paths, message_ids=message_ids)):
+        file_name = os.path.basename(audio_path)
         print(f"Procesando {idx+1}/{len(audio_files)}: {file_name}")
         
-        audio_path = os.path.join(audio_dir, file_name)
-        
-        # Obtener embedding de audio
-        audio_embedding = tagger.get_audio_embedding(audio_path)
-        
         if audio_embedding is None:
             print(f"No se pudo obtener embedding para {file_name}, omitiendo...")
             continue
         
         # Encontrar etiquetas cercanas
         nearest_tags, distances = tagger.find_knn_tags(
-            tag_embeddings, audio_embedding, tags, k=5)
+            tag_index, audio_embedding, tags, k=5)
         
         # Calcular similitudes
         similarities = [1 - distance for distance in distances]
@@ -219,6 +270,7 @@ def process_audio_files(audio_dir, tags_file, output_file, num_samples=50):
         
         # Agregar a resultados
         results.append(result)
+        mark("primer resultado")
     
     # Convertir a DataFrame
     results_df = pd.DataFrame(results)
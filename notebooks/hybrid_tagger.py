@@ -1,12 +1,30 @@
-import pandas as pd
 import numpy as np
 import os
-import torch
-from transformers import pipeline, Wav2Vec2Model, HubertModel, WhisperProcessor, WhisperForConditionalGeneration
-from sentence_transformers import SentenceTransformer
-from sklearn.neighbors import NearestNeighbors
-import librosa
-import torchaudio
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "AI"))
+from audio_prefetch import prefetch
+from message_embedding_store import MessageEmbeddingStore
+from startup_profile import lazy_import, mark, profile_stage
+from tag_embedding_store import DEFAULT_STORE_DIR, TagEmbeddingStore
+from tag_index import TagIndex, as_index
+from tagging import message_embeddings_key, text_embeddings_key, transcription_key
+from waveform_cache import create_waveform_cache, to_float32
+
+# Las librerías pesadas se importan al usarse por primera vez (ver AI/startup_profile.py)
+pd = lazy_import("pandas")
+torch = lazy_import("torch")
+torchaudio = lazy_import("torchaudio")
+transformers = lazy_import("transformers")
+sentence_transformers = lazy_import("sentence_transformers")
+quantization = lazy_import("quantization")
+onnx_backend = lazy_import("onnx_backend")
+
+def branch_executor(name):
+    """Hilo dedicado y de larga vida para una rama"""
+    return ThreadPoolExecutor(max_workers=1, thread_name_prefix=name)
 
 class HybridTagger:
     def __init__(self, 
@@ -15,7 +33,11 @@ class HybridTagger:
                  asr_model_name="openai/whisper-large-v3",
                  audio_weight=0.3,
                  text_weight=0.7,
-                 device=None):
+                 device=None,
+                 quantize=None,
+                 backend="torch",
+                 parallel_branches=True,
+                 audio_threads=None):
         # Configurar dispositivo
         if device is None:
             self.device = "cuda" if torch.cuda.is_available() else "cpu"
@@ -24,21 +46,53 @@ class HybridTagger:
             
         print(f"Usando dispositivo: {self.device}")
         
-        # Cargar modelos
-        print("Cargando modelos...")
-        # Modelo para embeddings de audio
-        if "hubert" in audio_model_name:
-            self.audio_model = HubertModel.from_pretrained(audio_model_name).to(self.device)
-        else:
-            self.audio_model = Wav2Vec2Model.from_pretrained(audio_model_name).to(self.device)
-            
-        # Modelo para embeddings de texto
-        self.text_model = SentenceTransformer(text_model_name)
+        # quantize="int8": modelos de texto y ASR cuantizados (solo CPU, ver AI/quantization.py)
+        if quantize and self.device != "cpu":
+            print(f"La cuantización int8 solo está disponible en CPU, se ignora en {self.device}")
+            quantize = None
+        self.quantize = quantize
         
-        # Modelo ASR para transcripción
-        self.asr_model = pipeline("automatic-speech-recognition", 
-                                 model=asr_model_name,
-                                 device=0 if self.device == "cuda" else -1)
+        # backend="onnx": embeddings de audio y texto con ONNX Runtime (ver AI/onnx_backend.py)
+        if backend not in ("torch", "onnx"):
+            raise ValueError(f"Backend desconocido: {backend}")
+        if backend == "onnx" and quantize:
+            raise ValueError("El backend ONNX no se combina con la cuantización int8 de PyTorch")
+        self.backend = backend
+        
+        # Los modelos se cargan la primera vez que se usan: si ya hay transcripciones,
+        # por ejemplo, el modelo ASR no llega a cargarse
+        self.audio_model_name = audio_model_name
+        self.text_model_name = text_model_name
+        self.asr_model_name = asr_model_name
+        self._audio_model = None
+        self._text_model = None
+        self._asr_model = None
+        # Audio decodificado compartido con los demás taggers si WAVEFORM_CACHE_DIR está definido (ver AI/waveform_cache.py)
+        self.waveform_cache = create_waveform_cache()
+        # Embeddings y transcripciones por mensaje (ver AI/message_embedding_store.py). Los
+        # embeddings de texto del híbrido no se normalizan, a diferencia de los de TextTagger
+        self.audio_store = MessageEmbeddingStore(f"audio_{audio_model_name}" + ("_onnx" if backend == "onnx" else ""))
+        self.transcription_store = MessageEmbeddingStore(transcription_key(asr_model_name, quantize), kind="text")
+        self.text_store = MessageEmbeddingStore(
+            message_embeddings_key(text_model_name, asr_model_name, backend, quantize) + "_raw")
+        
+        # La rama de audio (HuBERT) y la de texto (Whisper + embeddings) son independientes
+        # y se ejecutan a la vez, cada una en su hilo. Presupuesto de hilos: por defecto una
+        # cuarta parte para el audio, que es el modelo más ligero, y el resto para el texto.
+        # torch.set_num_threads es de todo el proceso, así que PyTorch se fija una sola vez a
+        # la suma de los dos y las ramas lo comparten; el reparto solo es estricto con
+        # backend="onnx", donde cada sesión de ONNX Runtime tiene su propio límite.
+        # Cerrar con close() o usar con `with`.
+        self.parallel_branches = parallel_branches
+        total_threads = torch.get_num_threads()
+        self.audio_threads = audio_threads or max(1, total_threads // 4)
+        self.text_threads = max(1, total_threads - self.audio_threads)
+        self._audio_branch = None
+        self._text_branch = None
+        if parallel_branches:
+            torch.set_num_threads(self.audio_threads + self.text_threads)
+            self._audio_branch = branch_executor("rama-audio")
+            self._text_branch = branch_executor("rama-texto")
         
         # Configuración de pesos para la combinación de embeddings
         self.audio_weight = audio_weight
@@ -51,8 +105,59 @@ class HybridTagger:
         
         print(f"Inicialización completada. Pesos: Audio={self.audio_weight:.2f}, Texto={self.text_weight:.2f}")
     
-    def load_audio(self, audio_path, target_sr=16000):
-        """Cargar archivo de audio y prepararlo para el modelo"""
+    @property
+    def audio_model(self):
+        """Modelo para embeddings de audio"""
+        if self._audio_model is None:
+            print(f"Cargando modelo de audio: {self.audio_model_name}...")
+            with profile_stage(f"audio {self.audio_model_name}"):
+                if self.backend == "onnx":
+                    self._audio_model = onnx_backend.OnnxAudioEncoder(self.audio_model_name,
+                                                                       num_threads=self.audio_threads)
+                    return self._audio_model
+                if "hubert" in self.audio_model_name:
+                    model_class = transformers.HubertModel
+                else:
+                    model_class = transformers.Wav2Vec2Model
+                self._audio_model = model_class.from_pretrained(self.audio_model_name).to(self.device)
+        return self._audio_model
+    
+    @property
+    def text_model(self):
+        """Modelo para embeddings de texto"""
+        if self._text_model is None:
+            print(f"Cargando modelo de embeddings: {self.text_model_name}...")
+            with profile_stage(f"texto {self.text_model_name}"):
+                if self.backend == "onnx":
+                    self._text_model = onnx_backend.OnnxTextEncoder(self.text_model_name,
+                                                                     num_threads=self.text_threads)
+                elif self.quantize:
+                    self._text_model = quantization.quantized_sentence_transformer(self.text_model_name)
+                else:
+                    self._text_model = sentence_transformers.SentenceTransformer(self.text_model_name)
+        return self._text_model
+    
+    @property
+    def asr_model(self):
+        """Modelo ASR para transcripción"""
+        if self._asr_model is None:
+            print(f"Cargando modelo ASR: {self.asr_model_name}...")
+            with profile_stage(f"ASR {self.asr_model_name}"):
+                if self.quantize:
+                    self._asr_model = quantization.quantized_asr_pipeline(self.asr_model_name)
+                else:
+                    self._asr_model = transformers.pipeline("automatic-speech-recognition", 
+                                                            model=self.asr_model_name,
+                                                            device=0 if self.device == "cuda" else -1)
+        return self._asr_model
+    
+    def decode_audio(self, audio_path, target_sr=16000):
+        """Cargar audio mono remuestreado, en CPU (se llama desde los hilos de AI/audio_prefetch.py)"""
+        if self.waveform_cache is not None:
+            # Se decodifica una sola vez por audio y frecuencia, ver AI/waveform_cache.py
+            samples = to_float32(self.waveform_cache.load_file(audio_path, target_sr))
+            return torch.from_numpy(samples).unsqueeze(0)
+        
         # Cargar audio
         waveform, sample_rate = torchaudio.load(audio_path)
         
@@ -65,40 +170,93 @@ class HybridTagger:
             resampler = torchaudio.transforms.Resample(sample_rate, target_sr)
             waveform = resampler(waveform)
         
-        return waveform.to(self.device)
+        return waveform
     
-    def get_audio_embedding(self, audio_path):
-        """Obtener embedding directamente desde el audio"""
-        waveform = self.load_audio(audio_path)
+    def load_audio(self, audio_path, target_sr=16000):
+        """Cargar archivo de audio y prepararlo para el modelo"""
+        return self.decode_audio(audio_path, target_sr).to(self.device)
+    
+    def get_audio_embeddings(self, waveforms):
+        """Embeddings de un lote de audios de la misma longitud, con forma (1, muestras) cada uno"""
+        if self.backend == "onnx":
+            return self.audio_model.encode(np.concatenate([w.cpu().numpy() for w in waveforms]))
         
-        # Obtener embedding
         with torch.no_grad():
-            outputs = self.audio_model(waveform)
+            outputs = self.audio_model(torch.cat(list(waveforms)).to(self.device))
             # Promedio en la dimensión temporal para obtener un vector único
-            embedding = torch.mean(outputs.last_hidden_state, dim=1).squeeze().cpu().numpy()
-        
-        return embedding
+            return torch.mean(outputs.last_hidden_state, dim=1).cpu().numpy()
+    
+    def get_audio_embedding(self, audio_path, waveform=None):
+        """Obtener embedding directamente desde el audio (o desde `waveform` ya decodificado)"""
+        if waveform is None:
+            waveform = self.decode_audio(audio_path)
+        return self.get_audio_embeddings([waveform])[0]
     
     def get_text_embedding(self, text):
         """Obtener embedding desde texto"""
         return self.text_model.encode(text)
     
-    def transcribe_audio(self, audio_path):
+    def transcribe_audio(self, audio_path, waveform=None):
         """Transcribir audio usando el modelo ASR"""
-        result = self.asr_model(audio_path)
+        if waveform is not None:
+            # Audio ya decodificado a 16 kHz: el pipeline no vuelve a pasar por ffmpeg
+            result = self.asr_model({"raw": waveform.squeeze(0).cpu().numpy(), "sampling_rate": 16000})
+        else:
+            result = self.asr_model(audio_path)
         return result["text"]
     
-    def get_hybrid_embedding(self, audio_path, transcription=None):
-        """Obtener embedding híbrido combinando audio y texto"""
-        # Obtener embedding de audio
-        audio_embedding = self.get_audio_embedding(audio_path)
+    def _stored(self, store, message_id, compute):
+        """Valor de `message_id` en `store`, o calcularlo con `compute()` y guardarlo"""
+        if message_id is None:
+            return compute()
+        return store.load_or_compute([message_id], [None], lambda _: [compute()])[0]
+    
+    def is_stored(self, message_id):
+        """Si el mensaje tiene guardados sus embeddings de audio y de texto"""
+        return message_id in self.audio_store and message_id in self.text_store
+    
+    def get_hybrid_embedding(self, audio_path, transcription=None, waveform=None, message_id=None):
+        """
+        Obtener embedding híbrido combinando audio y texto.
+        `waveform` es el audio ya decodificado con decode_audio, si se tiene.
+        Con `message_id`, los embeddings y la transcripción se guardan por mensaje y
+        los ya guardados no se recalculan (ver AI/message_embedding_store.py).
+        """
+        # Las dos ramas comparten la misma forma de onda, decodificada una sola vez
+        waveform_lock = threading.Lock()
         
-        # Si no se proporciona transcripción, generarla
-        if transcription is None:
-            transcription = self.transcribe_audio(audio_path)
-            
-        # Obtener embedding de texto
-        text_embedding = self.get_text_embedding(transcription)
+        def load_waveform():
+            nonlocal waveform
+            with waveform_lock:
+                if waveform is None:
+                    waveform = self.decode_audio(audio_path)
+            return waveform
+        
+        def audio_branch():
+            # Obtener embedding de audio
+            return self._stored(self.audio_store, message_id,
+                                lambda: self.get_audio_embedding(audio_path, load_waveform()))
+        
+        def text_branch():
+            nonlocal transcription
+            if transcription is not None:
+                # Transcripción del llamador (p. ej. un CSV): su embedding no se guarda, el
+                # del mensaje es siempre el de la transcripción de transcription_store
+                return self.get_text_embedding(transcription)
+            # Si no se proporciona transcripción, generarla
+            transcription = self._stored(self.transcription_store, message_id,
+                                         lambda: self.transcribe_audio(audio_path, load_waveform()))
+            # Obtener embedding de texto
+            return self._stored(self.text_store, message_id, lambda: self.get_text_embedding(transcription))
+        
+        if self.parallel_branches:
+            audio_future = self._audio_branch.submit(audio_branch)
+            text_future = self._text_branch.submit(text_branch)
+            audio_embedding = audio_future.result()
+            text_embedding = text_future.result()
+        else:
+            audio_embedding = audio_branch()
+            text_embedding = text_branch()
         
         # Asegurarse de que ambos embeddings tengan la misma dimensión
         # Si no, proyectar el de menor dimensión al espacio del otro
@@ -115,6 +273,20 @@ class HybridTagger:
         
         return hybrid_embedding, transcription
 
+    def close(self):
+        """Terminar los hilos de las ramas"""
+        for executor in (self._audio_branch, self._text_branch):
+            if executor is not None:
+                executor.shutdown(wait=True)
+        self._audio_branch = self._text_branch = None
+        self.parallel_branches = False
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc_info):
+        self.close()
+
     def load_and_preprocess_tags(self, file_path):
         """Cargar y preprocesar etiquetas desde un archivo"""
         with open(file_path, 'r', encoding='utf-8') as f:
@@ -133,23 +305,17 @@ class HybridTagger:
         
         return processed_tags
     
-    def compute_tag_embeddings(self, tags):
-        """Calcular embeddings para las etiquetas"""
-        return self.text_model.encode(tags)
+    def compute_tag_embeddings(self, tags, store_dir=DEFAULT_STORE_DIR):
+        """Embeddings de las etiquetas, desde el almacén compartido (solo se calculan las nuevas)"""
+        key = text_embeddings_key(self.text_model_name, self.backend, self.quantize)
+        return TagEmbeddingStore(key, store_dir).get(tags, self.text_model.encode)
     
     def find_knn_tags(self, tag_embeddings, input_embedding, tags, k=5):
-        """Encontrar etiquetas más cercanas usando KNN"""
-        # Crear modelo KNN
-        knn = NearestNeighbors(n_neighbors=k, metric='cosine')
-        knn.fit(tag_embeddings)
-        
-        # Encontrar los k vecinos más cercanos
-        distances, indices = knn.kneighbors(input_embedding.reshape(1, -1))
-        
-        # Obtener las etiquetas correspondientes
-        nearest_tags = [tags[idx] for idx in indices[0]]
-        
-        return nearest_tags, distances[0]
+        """
+        Encontrar las etiquetas más cercanas (distancia coseno).
+        `tag_embeddings` puede ser un TagIndex ya construido, para no rehacerlo en cada audio.
+        """
+        return as_index(tags, tag_embeddings).nearest(input_embedding, k)
 
 def process_audio_files(audio_dir, tags_file, output_file, transcriptions_file=None):
     """
@@ -162,69 +328,80 @@ def process_audio_files(audio_dir, tags_file, output_file, transcriptions_file=N
         transcriptions_file: Archivo CSV opcional con transcripciones existentes
     """
     # Inicializar el tagger híbrido
-    tagger = HybridTagger()
-    
-    # Cargar etiquetas
-    print("Cargando etiquetas...")
-    tags = tagger.load_and_preprocess_tags(tags_file)
-    print(f"Se cargaron {len(tags)} etiquetas únicas")
+    with HybridTagger() as tagger:
+        # Cargar etiquetas
+        print("Cargando etiquetas...")
+        tags = tagger.load_and_preprocess_tags(tags_file)
+        print(f"Se cargaron {len(tags)} etiquetas únicas")
     
-    # Calcular embeddings para las etiquetas
-    print("Calculando embeddings para las etiquetas...")
-    tag_embeddings = tagger.compute_tag_embeddings(tags)
+        # Calcular embeddings para las etiquetas
+        print("Calculando embeddings para las etiquetas...")
+        tag_embeddings = tagger.compute_tag_embeddings(tags)
+        # Índice normalizado, construido una vez para todos los audios
+        tag_index = TagIndex(tags, tag_embeddings)
     
-    # Cargar transcripciones existentes si se proporcionan
-    transcriptions = {}
-    if transcriptions_file:
-        print("Cargando transcripciones existentes...")
-        df = pd.read_csv(transcriptions_file)
-        for _, row in df.iterrows():
-            if not pd.isna(row['transcription']) and row['transcription'] != "":
-                transcriptions[row['file']] = row['transcription']
-        print(f"Se cargaron {len(transcriptions)} transcripciones")
+        # Cargar transcripciones existentes si se proporcionan
+        transcriptions = {}
+        if transcriptions_file:
+            print("Cargando transcripciones existentes...")
+            df = pd.read_csv(transcriptions_file)
+            for _, row in df.iterrows():
+                if not pd.isna(row['transcription']) and row['transcription'] != "":
+                    transcriptions[row['file']] = row['transcription']
+            print(f"Se cargaron {len(transcriptions)} transcripciones")
     
-    # Listar archivos de audio
-    audio_files = [f for f in os.listdir(audio_dir) if f.endswith(('.mp3', '.wav', '.ogg'))]
-    print(f"Se encontraron {len(audio_files)} archivos de audio")
+        # Listar archivos de audio
+        audio_files = [f for f in os.listdir(audio_dir) if f.endswith(('.mp3', '.wav', '.ogg'))]
+        print(f"Se encontraron {len(audio_files)} archivos de audio")
     
-    # Procesar cada archivo
-    results = []
-    for idx, file_name in enumerate(audio_files):
-        print(f"Procesando {idx+1}/{len(audio_files)}: {file_name}")
+        # Procesar cada archivo
+        results = []
+        # Los audios siguientes se decodifican en paralelo mientras se procesa el actual
+        audio_paths = [os.path.join(audio_dir, file_name) for file_name in audio_files]
+        # El nombre del fichero (sin extensión) identifica al mensaje en el almacén de embeddings
+        message_id = lambda path: os.path.splitext(os.path.basename(path))[0]
+        # Los mensajes que ya tienen sus embeddings guardados no se decodifican
+        decode = lambda path: None if tagger.is_stored(message_id(path)) else tagger.decode_audio(path)
+        for idx, (audio_path, waveform, error) in enumerate(prefetch(audio_paths, decode)):
+            file_name = os.path.basename(audio_path)
+            print(f"Procesando {idx+1}/{len(audio_files)}: {file_name}")
         
-        audio_path = os.path.join(audio_dir, file_name)
+            if error is not None:
+                print(f"No se pudo cargar {file_name} ({error}), omitiendo...")
+                continue
         
-        # Usar transcripción existente si está disponible
-        transcription = transcriptions.get(file_name)
+            # Usar transcripción existente si está disponible
+            transcription = transcriptions.get(file_name)
         
-        # Obtener embedding híbrido
-        hybrid_embedding, actual_transcription = tagger.get_hybrid_embedding(
-            audio_path, transcription)
+            # Obtener embedding híbrido
+            hybrid_embedding, actual_transcription = tagger.get_hybrid_embedding(
+                audio_path, transcription, waveform, message_id(audio_path))
         
-        # Si no teníamos transcripción, usar la generada
-        if transcription is None:
-            transcription = actual_transcription
+            # Si no teníamos transcripción, usar la generada
+            if transcription is None:
+                transcription = actual_transcription
         
-        # Encontrar etiquetas cercanas
-        nearest_tags, distances = tagger.find_knn_tags(
-            tag_embeddings, hybrid_embedding, tags, k=5)
+            # Encontrar etiquetas cercanas
+            nearest_tags, distances = tagger.find_knn_tags(
+                tag_index, hybrid_embedding, tags, k=5)
         
-        # Calcular similitudes
-        similarities = [1 - distance for distance in distances]
+            # Calcular similitudes
+            similarities = [1 - distance for distance in distances]
         
-        # Crear registro para este archivo
-        result = {
-            'file': file_name,
-            'transcription': transcription,
-        }
+            # Crear registro para este archivo
+            result = {
+                'file': file_name,
+                'transcription': transcription,
+            }
         
-        # Agregar tags y similitudes
-        for i in range(5):
-            result[f'tag_{i+1}'] = nearest_tags[i] if i < len(nearest_tags) else ""
-            result[f'similarity_{i+1}'] = similarities[i] if i < len(similarities) else 0.0
+            # Agregar tags y similitudes
+            for i in range(5):
+                result[f'tag_{i+1}'] = nearest_tags[i] if i < len(nearest_tags) else ""
+                result[f'similarity_{i+1}'] = similarities[i] if i < len(similarities) else 0.0
         
-        # Agregar a resultados
-        results.append(result)
+            # Agregar a resultados
+            results.append(result)
+            mark("primer resultado")
     
     # Convertir a DataFrame
     results_df = pd.DataFrame(results)
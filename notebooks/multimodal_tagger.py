@@ -1,22 +1,38 @@
-import pandas as pd
 import numpy as np
 import os
-import torch
-from transformers import ClapModel, ClapProcessor, ClapConfig
-from sklearn.neighbors import NearestNeighbors
+import sys
 from tqdm.auto import tqdm
-import matplotlib.pyplot as plt
-import librosa
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "AI"))
+from audio_prefetch import DEFAULT_WORKERS, embed_files
+from message_embedding_store import MessageEmbeddingStore
+from startup_profile import lazy_import, mark, profile_stage
+from tag_embedding_store import DEFAULT_STORE_DIR, TagEmbeddingStore
+from tag_index import TagIndex, as_index
+from waveform_cache import create_waveform_cache, to_float32
+
+# Las librerías pesadas se importan al usarse por primera vez (ver AI/startup_profile.py)
+pd = lazy_import("pandas")
+torch = lazy_import("torch")
+transformers = lazy_import("transformers")
+librosa = lazy_import("librosa")
+plt = lazy_import("matplotlib.pyplot")
+onnx_backend = lazy_import("onnx_backend")
 
 class ClapTagger:
-    def __init__(self, model_name="laion/clap-htsat-unfused", device=None):
+    def __init__(self, model_name="laion/clap-htsat-unfused", device=None, backend="torch"):
         """
         Inicializador del tagger basado en CLAP
         
         Args:
             model_name: Nombre del modelo CLAP a usar
             device: Dispositivo (cuda o cpu)
+            backend: "torch" o "onnx" (ONNX Runtime en CPU, ver AI/onnx_backend.py)
         """
+        if backend not in ("torch", "onnx"):
+            raise ValueError(f"Backend desconocido: {backend}")
+        self.backend = backend
+        
         # Configurar dispositivo
         if device is None:
             self.device = "cuda" if torch.cuda.is_available() else "cpu"
@@ -27,40 +43,84 @@ class ClapTagger:
         
         # Cargar modelo CLAP
         print(f"Cargando modelo CLAP: {model_name}...")
-        self.model = ClapModel.from_pretrained(model_name).to(self.device)
-        self.processor = ClapProcessor.from_pretrained(model_name)
+        with profile_stage(f"CLAP {model_name}"):
+            if backend == "onnx":
+                self.model = onnx_backend.OnnxClapEncoder(model_name)
+                self.processor = self.model.processor
+            else:
+                self.model = transformers.ClapModel.from_pretrained(model_name).to(self.device)
+                self.processor = transformers.ClapProcessor.from_pretrained(model_name)
         self.model_name = model_name
+        # Audio decodificado compartido con los demás taggers si WAVEFORM_CACHE_DIR está definido (ver AI/waveform_cache.py)
+        self.waveform_cache = create_waveform_cache()
+        # Embeddings de audio por mensaje, para volver a etiquetar sin pasar por CLAP
+        self.audio_store = MessageEmbeddingStore(f"clap_audio_{model_name}" + ("_onnx" if backend == "onnx" else ""))
             
         print("Inicialización completada")
     
+    def decode_audio(self, audio_path):
+        """Cargar audio mono a 48 kHz (se llama desde los hilos de AI/audio_prefetch.py)"""
+        if self.waveform_cache is not None:
+            # Se decodifica una sola vez por audio y frecuencia, ver AI/waveform_cache.py
+            return to_float32(self.waveform_cache.load_file(audio_path, 48000))
+        # Cargar audio usando librosa para asegurar compatibilidad
+        waveform, sr = librosa.load(audio_path, sr=48000, mono=True)
+        return waveform
+    
+    def get_audio_embeddings(self, waveforms):
+        """Obtener embeddings (normalizados) de un lote de audios a 48 kHz en una sola pasada de CLAP"""
+        if self.backend == "onnx":
+            inputs = self.processor(audios=waveforms, sampling_rate=48000, return_tensors="np")
+            audio_embeddings = self.model.get_audio_features(inputs, batch_size=len(waveforms))
+            return audio_embeddings / np.linalg.norm(audio_embeddings, axis=1, keepdims=True)
+        
+        # Procesar con CLAP
+        # Nota: El procesador espera la forma correcta del audio
+        inputs = self.processor(
+            audios=waveforms,
+            sampling_rate=48000,
+            return_tensors="pt"
+        ).to(self.device)
+        
+        with torch.no_grad():
+            audio_embeddings = self.model.get_audio_features(**inputs)
+            # Normalizar embeddings
+            audio_embeddings = audio_embeddings / torch.norm(audio_embeddings, dim=1, keepdim=True)
+        
+        return audio_embeddings.cpu().numpy()
+    
     def get_audio_embedding(self, audio_path):
         """Obtener embedding de audio usando CLAP"""
         try:
-            # Cargar audio usando librosa para asegurar compatibilidad
             print(f"Cargando audio: {audio_path}")
-            waveform, sr = librosa.load(audio_path, sr=48000, mono=True)
-            
-            # Procesar con CLAP
-            # Nota: El procesador espera la forma correcta del audio
-            inputs = self.processor(
-                audios=waveform,
-                sampling_rate=48000,
-                return_tensors="pt"
-            ).to(self.device)
-            
-            with torch.no_grad():
-                audio_embedding = self.model.get_audio_features(**inputs)
-                # Normalizar embeddings
-                audio_embedding = audio_embedding / torch.norm(audio_embedding, dim=1, keepdim=True)
-            
-            return audio_embedding.cpu().numpy()[0]
+            return self.get_audio_embeddings([self.decode_audio(audio_path)])[0]
         except Exception as e:
             print(f"Error al procesar {audio_path}: {str(e)}")
             return None
     
+    def embed_audio_files(self, audio_paths, batch_size=8, workers=DEFAULT_WORKERS, message_ids=None):
+        """
+        Embeddings de `audio_paths`, decodificando los siguientes audios en paralelo
+        mientras CLAP procesa los actuales. Devuelve (ruta, embedding o None) según
+        se calculan. El procesador de CLAP lleva todos los audios a la misma forma
+        (recorta o repite hasta 10 s), así que cualquier lote vale.
+        Con `message_ids`, los embeddings se guardan por mensaje y los ya guardados
+        no se recalculan (ver AI/message_embedding_store.py).
+        """
+        compute = lambda paths: embed_files(paths, self.decode_audio, self.get_audio_embeddings,
+                                            batch_size=batch_size, length=lambda waveform: 0, workers=workers)
+        if message_ids is None:
+            return compute(audio_paths)
+        return self.audio_store.load_or_compute_stream(message_ids, audio_paths, compute)
+    
     def get_text_embedding(self, text):
         """Obtener embedding de texto usando CLAP"""
         try:
+            if self.backend == "onnx":
+                inputs = self.processor(text=text, return_tensors="np")
+                text_embedding = self.model.get_text_features(inputs)
+                return text_embedding[0] / np.linalg.norm(text_embedding[0])
+            
             # Procesar texto con CLAP
             inputs = self.processor(text=text, return_tensors="pt").to(self.device)
             with torch.no_grad():
@@ -100,129 +160,69 @@ class ClapTagger:
         
         return processed_tags
     
-    def calculate_tag_embeddings(self, tags):
-        """Calcular embeddings para todas las etiquetas"""
-        tag_embeddings = []
-        
-        print("Calculando embeddings para etiquetas...")
-        for tag in tqdm(tags):
-            embedding = self.get_text_embedding(tag)
-            if embedding is not None:
-                tag_embeddings.append(embedding)
-            else:
-                # Si no se pudo obtener embedding, agregar un vector de ceros
-                if len(tag_embeddings) > 0:
-                    tag_embeddings.append(np.zeros_like(tag_embeddings[0]))
-                else:
-                    # Dimensión del embedding de CLAP
-                    tag_embeddings.append(np.zeros(512))
+    def get_text_embeddings(self, texts):
+        """Obtener embeddings (normalizados) de una lista de textos en una sola pasada de CLAP"""
+        if self.backend == "onnx":
+            inputs = self.processor(text=texts, padding=True, return_tensors="np")
+            text_embeddings = self.model.get_text_features(inputs, batch_size=len(texts))
+            return text_embeddings / np.linalg.norm(text_embeddings, axis=1, keepdims=True)
         
-        return np.array(tag_embeddings)
+        inputs = self.processor(text=texts, padding=True, return_tensors="pt").to(self.device)
+        with torch.no_grad():
+            text_embeddings = self.model.get_text_features(**inputs)
+            text_embeddings = text_embeddings / torch.norm(text_embeddings, dim=1, keepdim=True)
+        return text_embeddings.cpu().numpy()
     
-    def save_tag_embeddings(self, tag_embeddings, tags, save_dir, model_name=None):
+    def calculate_tag_embeddings(self, tags, batch_size=64):
         """
-        Guardar embeddings de etiquetas en un archivo
-        
-        Args:
-            tag_embeddings: Array de embeddings
-            tags: Lista de etiquetas correspondientes
-            save_dir: Directorio donde guardar
-            model_name: Nombre del modelo para el nombre del archivo
+        Calcular embeddings para todas las etiquetas, por lotes de `batch_size`.
+        Las etiquetas se ordenan por número de tokens para que cada lote tenga
+        poco relleno. Si un lote falla, sus etiquetas se calculan una a una; si alguna
+        sigue fallando se lanza un error, para que no se guarde nada en el almacén y se
+        vuelva a intentar en la siguiente ejecución.
         """
-        if model_name is None:
-            model_name = self.model_name.replace('/', '_')
-        
-        # Crear directorio si no existe
-        os.makedirs(save_dir, exist_ok=True)
-        
-        # Guardar embeddings
-        np.save(os.path.join(save_dir, f"tag_embeddings_{model_name}.npy"), tag_embeddings)
+        tag_embeddings = [None] * len(tags)
         
-        # Guardar etiquetas correspondientes
-        with open(os.path.join(save_dir, f"tags_{model_name}.txt"), 'w', encoding='utf-8') as f:
-            f.write('\n'.join(tags))
-        
-        print(f"Embeddings de etiquetas guardados en {save_dir}")
+        print("Calculando embeddings para etiquetas...")
+        lengths = [len(ids) for ids in self.processor.tokenizer(list(tags))["input_ids"]]
+        order = sorted(range(len(tags)), key=lambda i: lengths[i])
+        for start in tqdm(range(0, len(order), batch_size)):
+            batch = order[start:start + batch_size]
+            try:
+                embeddings = self.get_text_embeddings([tags[i] for i in batch])
+            except Exception as e:
+                print(f"Error en el lote de {len(batch)} etiquetas, se calculan una a una: {e}")
+                embeddings = [self.get_text_embedding(tags[i]) for i in batch]
+            for i, embedding in zip(batch, embeddings):
+                tag_embeddings[i] = embedding
+        
+        failed = [tag for tag, e in zip(tags, tag_embeddings) if e is None]
+        if failed:
+            raise RuntimeError(f"No se pudieron calcular los embeddings de {len(failed)} etiquetas: {failed[:10]}")
+        return np.array(tag_embeddings)
     
-    def load_tag_embeddings(self, load_dir, model_name=None, tags=None):
+    def find_similar_tags(self, audio_embedding, tag_embeddings, tags, k=5):
         """
-        Cargar embeddings de etiquetas desde un archivo
-        
-        Args:
-            load_dir: Directorio desde donde cargar
-            model_name: Nombre del modelo para el nombre del archivo
-            tags: Lista de etiquetas actuales para verificar consistencia
-            
-        Returns:
-            tuple: (embeddings, lista de etiquetas)
+        Encontrar etiquetas más similares a un audio (distancia coseno).
+        `tag_embeddings` puede ser un TagIndex ya construido, para no rehacerlo en cada audio.
         """
-        if model_name is None:
-            model_name = self.model_name.replace('/', '_')
-        
-        embeddings_file = os.path.join(load_dir, f"tag_embeddings_{model_name}.npy")
-        tags_file = os.path.join(load_dir, f"tags_{model_name}.txt")
-        
-        # Verificar que ambos archivos existen
-        if not os.path.exists(embeddings_file) or not os.path.exists(tags_file):
-            print(f"No se encontraron embeddings guardados en {load_dir}")
-            return None, None
-        
-        # Cargar etiquetas guardadas
-        with open(tags_file, 'r', encoding='utf-8') as f:
-            saved_tags = f.read().splitlines()
-        
-        # Si se proporcionaron etiquetas, verificar que coincidan con las guardadas
-        if tags is not None:
-            if len(tags) != len(saved_tags) or set(tags) != set(saved_tags):
-                print("Las etiquetas actuales no coinciden con las guardadas. Recalculando embeddings...")
-                return None, None
-        
-        # Cargar embeddings
-        try:
-            embeddings = np.load(embeddings_file)
-            print(f"Embeddings de etiquetas cargados desde {embeddings_file}")
-            return embeddings, saved_tags
-        except Exception as e:
-            print(f"Error al cargar embeddings: {e}")
-            return None, None
-    
-    def find_similar_tags(self, audio_embedding, tag_embeddings, tags, k=5):
-        """Encontrar etiquetas más similares a un audio"""
-        # Crear modelo KNN
-        knn = NearestNeighbors(n_neighbors=min(k, len(tags)), metric='cosine')
-        knn.fit(tag_embeddings)
-        
-        # Encontrar los k vecinos más cercanos
-        distances, indices = knn.kneighbors(audio_embedding.reshape(1, -1))
-        
-        # Obtener las etiquetas correspondientes
-        nearest_tags = [tags[idx] for idx in indices[0]]
-        
-        return nearest_tags, distances[0]
+        return as_index(tags, tag_embeddings).nearest(audio_embedding, k)
 
-def load_or_calculate_tag_embeddings(tagger, tags, tmp_dir):
+def load_or_calculate_tag_embeddings(tagger, tags, tmp_dir=None):
     """
-    Intenta cargar embeddings guardados o los calcula si no existen
+    Carga los embeddings de las etiquetas desde el almacén compartido
+    (AI/tag_embedding_store.py), calculando solo las etiquetas nuevas
     
     Args:
         tagger: Instancia de ClapTagger
         tags: Lista de etiquetas
-        tmp_dir: Directorio para guardar/cargar embeddings temporales
+        tmp_dir: Directorio del almacén (por defecto AI/embeddings)
         
     Returns:
         np.array: Embeddings de etiquetas
     """
-    # Intentar cargar embeddings guardados
-    tag_embeddings, saved_tags = tagger.load_tag_embeddings(tmp_dir, tags=tags)
-    
-    # Si no se pudieron cargar, calcularlos
-    if tag_embeddings is None:
-        tag_embeddings = tagger.calculate_tag_embeddings(tags)
-        
-        # Guardar para uso futuro
-        tagger.save_tag_embeddings(tag_embeddings, tags, tmp_dir)
-    
-    return tag_embeddings
+    store = TagEmbeddingStore(f"clap_{tagger.model_name}_{tagger.backend}", tmp_dir or DEFAULT_STORE_DIR)
+    return store.get(tags, tagger.calculate_tag_embeddings)
 
 def process_audios_with_clap(audio_dir, tags_file, output_file, tmp_dir=None, model_name="laion/clap-htsat-unfused", batch_size=10):
     """
@@ -245,10 +245,9 @@ def process_audios_with_clap(audio_dir, tags_file, output_file, tmp_dir=None, mo
     print(f"Se cargaron {len(tags)} etiquetas únicas")
     
     # Calcular o cargar embeddings de etiquetas
-    if tmp_dir:
-        tag_embeddings = load_or_calculate_tag_embeddings(tagger, tags, tmp_dir)
-    else:
-        tag_embeddings = tagger.calculate_tag_embeddings(tags)
+    tag_embeddings = load_or_calculate_tag_embeddings(tagger, tags, tmp_dir)
+    # Índice normalizado, construido una vez para todos los audios
+    tag_index = TagIndex(tags, tag_embeddings)
     
     # Listar archivos de audio
     audio_files = [f for f in os.listdir(audio_dir) if f.endswith(('.mp3', '.wav', '.ogg'))]
@@ -258,16 +257,13 @@ def process_audios_with_clap(audio_dir, tags_file, output_file, tmp_dir=None, mo
     results = []
     
     print("\nProcesando archivos de audio...")
-    for idx, file_name in enumerate(tqdm(audio_files)):
-        audio_path = os.path.join(audio_dir, file_name)
-        
-        # Verificar que el archivo existe
-        if not os.path.exists(audio_path):
-            print(f"Archivo no encontrado: {audio_path}, omitiendo...")
-            continue
-            
-        # Obtener embedding de audio
-        audio_embedding = tagger.get_audio_embedding(audio_path)
+    # Los audios se decodifican en paralelo mientras CLAP calcula los embeddings
+    audio_paths = [os.path.join(audio_dir, file_name) for file_name in audio_files]
+    # El nombre del fichero (sin extensión) identifica al mensaje en el almacén de embeddings
+    message_ids = [os.path.splitext(file_name)[0] for file_name in audio_files]
+    audio_embeddings = tagger.embed_audio_files(audio_paths, message_ids=message_ids)
+    for idx, (audio_path, audio_embedding) in enumerate(tqdm(audio_embeddings, total=len(audio_paths))):
+        file_name = os.path.basename(audio_path)
         
         if audio_embedding is None:
             print(f"No se pudo obtener embedding para {file_name}, omitiendo...")
@@ -275,7 +271,7 @@ def process_audios_with_clap(audio_dir, tags_file, output_file, tmp_dir=None, mo
         
         # Encontrar etiquetas similares
         nearest_tags, distances = tagger.find_similar_tags(
-            audio_embedding, tag_embeddings, tags, k=5)
+            audio_embedding, tag_index, tags, k=5)
         
         # Calcular similitudes
         similarities = [1 - distance for distance in distances]
@@ -292,6 +288,7 @@ def process_audios_with_clap(audio_dir, tags_file, output_file, tmp_dir=None, mo
         
         # Agregar a resultados
         results.append(result)
+        mark("primer resultado")
         
         # Mostrar progreso detallado cada cierto número de archivos
         if (idx + 1) % batch_size == 0 or idx == len(audio_files) - 1:
@@ -1,10 +1,19 @@
-import pandas as pd
 import numpy as np
-from sentence_transformers import SentenceTransformer
-from sklearn.neighbors import NearestNeighbors
 import os
-from transformers import pipeline
-import torch
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "AI"))
+from startup_profile import lazy_import, mark, profile_stage
+from tag_embedding_store import TagEmbeddingStore
+from tag_index import TagIndex, as_index
+from tagging import text_embeddings_key
+
+# Las librerías pesadas se importan al usarse por primera vez (ver AI/startup_profile.py)
+pd = lazy_import("pandas")
+torch = lazy_import("torch")
+transformers = lazy_import("transformers")
+sentence_transformers = lazy_import("sentence_transformers")
+quantization = lazy_import("quantization")
 
 # 1. Cargar y preprocesar las etiquetas de tags_text.txt
 def load_and_preprocess_tags(file_path):
@@ -29,9 +38,10 @@ def transcribe_audio(audio_file, asr_model=None):
     if asr_model is None:
         # Inicializar el modelo ASR si no se proporciona
         device = "cuda" if torch.cuda.is_available() else "cpu"
-        asr_model = pipeline("automatic-speech-recognition", 
-                           model="openai/whisper-large-v3",
-                           device=device)
+        with profile_stage("ASR openai/whisper-large-v3"):
+            asr_model = transformers.pipeline("automatic-speech-recognition", 
+                                              model="openai/whisper-large-v3",
+                                              device=device)
     
     # Transcribir el audio
     result = asr_model(audio_file)
@@ -54,28 +64,23 @@ def get_transcription(mp3_file, transcriptions_csv):
         return None
 
 # 4. Calcular embeddings con modelo mejorado
-def compute_embeddings(texts, model_name='paraphrase-multilingual-mpnet-base-v2'):
-    # Cargar modelo
-    model = SentenceTransformer(model_name)
+def compute_embeddings(texts, model_name='paraphrase-multilingual-mpnet-base-v2', quantize=None):
+    # Cargar modelo (quantize="int8": encoder cuantizado en CPU, ver AI/quantization.py)
+    with profile_stage(f"texto {model_name}"):
+        if quantize:
+            model = quantization.quantized_sentence_transformer(model_name)
+        else:
+            model = sentence_transformers.SentenceTransformer(model_name)
     
     # Calcular embeddings
     embeddings = model.encode(texts)
     
     return embeddings
 
-# 5. Encontrar etiquetas usando KNN
+# 5. Encontrar etiquetas por distancia coseno
+# (tag_embeddings puede ser un TagIndex ya construido, para no rehacerlo en cada transcripción)
 def find_knn_tags(tag_embeddings, text_embedding, tags, k=5):
-    # Crear modelo KNN
-    knn = NearestNeighbors(n_neighbors=k, metric='cosine')
-    knn.fit(tag_embeddings)
-    
-    # Encontrar los k vecinos más cercanos
-    distances, indices = knn.kneighbors(text_embedding.reshape(1, -1))
-    
-    # Obtener las etiquetas correspondientes
-    nearest_tags = [tags[idx] for idx in indices[0]]
-    
-    return nearest_tags, distances[0]
+    return as_index(tags, tag_embeddings).nearest(text_embedding, k)
 
 if __name__ == "__main__":
     # Rutas de archivos
@@ -103,17 +108,26 @@ if __name__ == "__main__":
     asr_model = None
     if use_direct_transcription:
         print("\nCargando modelo ASR Whisper...")
-        asr_model = pipeline("automatic-speech-recognition", 
-                           model="openai/whisper-large-v3",
-                           device=device)
+        with profile_stage("ASR openai/whisper-large-v3"):
+            asr_model = transformers.pipeline("automatic-speech-recognition", 
+                                              model="openai/whisper-large-v3",
+                                              device=device)
     
     # Inicializar el modelo de embeddings mejorado
     print("\nCargando modelo de embeddings mejorado...")
-    model = SentenceTransformer('paraphrase-multilingual-mpnet-base-v2')
+    quantize = os.environ.get("TAGGER_QUANTIZE")  # "int8" para el encoder cuantizado
+    with profile_stage("texto paraphrase-multilingual-mpnet-base-v2"):
+        if quantize:
+            model = quantization.quantized_sentence_transformer('paraphrase-multilingual-mpnet-base-v2')
+        else:
+            model = sentence_transformers.SentenceTransformer('paraphrase-multilingual-mpnet-base-v2')
     
     # Calcular embeddings para todas las etiquetas
     print("Calculando embeddings para las etiquetas...")
-    tag_embeddings = model.encode(tags)
+    store_key = text_embeddings_key('paraphrase-multilingual-mpnet-base-v2', "torch", quantize)
+    tag_embeddings = TagEmbeddingStore(store_key).get(tags, model.encode)
+    # Índice normalizado, construido una vez para todas las transcripciones
+    tag_index = TagIndex(tags, tag_embeddings)
     
     # Crear DataFrame para resultados
     results = []
@@ -144,7 +158,7 @@ if __name__ == "__main__":
         transcription_embedding = model.encode(transcription)
         
         # Encontrar etiquetas más cercanas
-        nearest_tags, distances = find_knn_tags(tag_embeddings, transcription_embedding, tags, k=5)
+        nearest_tags, distances = find_knn_tags(tag_index, transcription_embedding, tags, k=5)
         
         # Calcular similitudes
         similarities = [1 - distance for distance in distances]
@@ -162,6 +176,7 @@ if __name__ == "__main__":
         
         # Agregar a resultados
         results.append(result)
+        mark("primer resultado")
     
     # Convertir a DataFrame
     results_df = pd.DataFrame(results)